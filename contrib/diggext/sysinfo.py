@@ -177,16 +177,14 @@ def discover_hardware(ip):
     }
 
 def update_server(server, info):
-    server.del_attrs(key='memory')
-    server.del_attrs(key='disk')
-    server.del_attrs(key='processor')
-    server.del_attrs(key='system')
-
+    attrs = {}
     for itemtype in info:
         if itemtype == 'network': continue
         for i, item in enumerate(info[itemtype]):
             for subkey, value in item.items():
-                server.set_attr(key=itemtype, subkey=subkey, value=value, number=i)
+                attrs[(itemtype, i, subkey)] = value
+
+    server.set_attrs(attrs, replace_keys=['memory', 'disk', 'processor', 'system'])
 
     for ifnum in range(0, 2):
         ifname = 'eth%i' % ifnum
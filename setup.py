@@ -31,9 +31,11 @@ setuptools.setup(
             'clusto = clusto.script_helper:main',
             'clusto-allocate = clusto.commands.allocate:main',
             'clusto-attr = clusto.commands.attr:main',
+            'clusto-closure = clusto.commands.closure:main',
             'clusto-console = clusto.commands.console:main',
             'clusto-deallocate = clusto.commands.deallocate:main',
             'clusto-info = clusto.commands.info:main',
+            'clusto-ipam-report = clusto.commands.ipam_report:main',
             'clusto-list-pool = clusto.commands.list_pool:main',
             'clusto-pool = clusto.commands.pool:main',
             'clusto-reboot = clusto.commands.reboot:main',
@@ -5,12 +5,18 @@ from clusto.drivers import DRIVERLIST, TYPELIST, Driver, ClustoMeta, IPManager
 from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy import create_engine
-from sqlalchemy import select, and_
+from sqlalchemy import select, and_, event
 from sqlalchemy.pool import SingletonThreadPool
 
 from clusto import drivers
+from clusto import audit
+from clusto import cache
+from clusto import containment
+from clusto import closure
+from clusto.util import batch
 
 import collections
+import contextlib
 import threading
 import logging.config
 import logging
@@ -31,11 +37,21 @@ def connect(config, echo=False):
     @param config: the config object
     """
 
-    SESSION.configure(bind=create_engine(config.get('clusto', 'dsn'),
-                                         echo=echo,
-                                         poolclass=SingletonThreadPool,
-                                         pool_recycle=600
-                                         ))
+    engine = create_engine(config.get('clusto', 'dsn'),
+                           echo=echo,
+                           poolclass=SingletonThreadPool,
+                           pool_recycle=600
+                           )
+
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', _sqlite_connect)
+        SESSION.clusto_sql_regexp = True
+    else:
+        SESSION.clusto_sql_regexp = engine.dialect.name in ('mysql', 'postgresql')
+
+    SESSION.clusto_for_update = engine.dialect.name in ('mysql', 'postgresql')
+
+    SESSION.configure(bind=engine)
 
     SESSION.clusto_version = None
 
@@ -44,6 +60,27 @@ def connect(config, echo=False):
     else:
         SESSION.clusto_versioning_enabled = False
 
+    # Reserve counter values this many at a time (see schema.CounterBlocks)
+    if config.has_option('clusto', 'counter_block_size'):
+        SESSION.clusto_counter_block_size = config.getint('clusto',
+                                                          'counter_block_size')
+    else:
+        SESSION.clusto_counter_block_size = 1
+    Counter.blocks.clear()
+
+    # Lock resource managers while allocating (see ResourceManager.lock)
+    if config.has_option('clusto', 'allocation_locking'):
+        SESSION.clusto_allocation_locking = config.getboolean(
+            'clusto', 'allocation_locking')
+    else:
+        SESSION.clusto_allocation_locking = False
+
+    # Maintain the entity_closure table (see clusto.closure)
+    if config.has_option('clusto', 'closure'):
+        SESSION.clusto_closure_enabled = config.getboolean('clusto', 'closure')
+    else:
+        SESSION.clusto_closure_enabled = False
+
     # Set the log level from config, default is WARNING
     if config.has_option('clusto', 'loglevel'):
         rootlog = logging.getLogger()
@@ -52,25 +89,28 @@ def connect(config, echo=False):
 
     # Setup audit logging to a file
     if config.has_option('clusto', 'auditlog'):
-        auditlog = logging.getLogger('clusto.audit')
-        auditlog.propagate = False
-        auditlog.setLevel(logging.INFO)
-        logfile = config.get('clusto', 'auditlog')
-        handler = logging.handlers.WatchedFileHandler(logfile)
-        handler.setFormatter(logging.Formatter(
-            '%(asctime)s %(name)s %(levelname)s %(message)s',
-            '%Y-%m-%d %H:%M:%S'
-        ))
-        auditlog.addHandler(handler)
+        if config.has_option('clusto', 'auditlog_format'):
+            auditlog_format = config.get('clusto', 'auditlog_format')
+        else:
+            auditlog_format = 'text'
+        audit.configure(config.get('clusto', 'auditlog'), auditlog_format)
+    else:
+        audit.configure(None)
+
+    # Setup the shared attribute cache (see clusto.cache)
+    cache.configure(config)
+
+
+def _sqlite_regexp(pattern, value):
+    if value is None:
+        return False
+    return re.match(pattern, value) is not None
 
-    try:
-        memcache_servers = config.get('clusto', 'memcached').split(',')
-#       Memcache should only be imported if we're actually using it, yes?
-        import memcache
-        logging.info('Memcache server list: %s' % config.get('clusto', 'memcached'))
-        SESSION.memcache = memcache.Client(memcache_servers, debug=0)
-    except:
-        SESSION.memcache = None
+
+def _sqlite_connect(dbapi_connection, connection_record):
+    """Give sqlite connections the REGEXP operator."""
+
+    dbapi_connection.create_function('regexp', 2, _sqlite_regexp)
 
 
 def checkDBcompatibility(dbver):
@@ -95,15 +135,50 @@ def init_clusto():
 
 
 def flush():
-    """Flush changes made to clusto objects to the database."""
+    """Flush changes made to clusto objects to the database.
+
+    Nothing is sent to the database when there are no pending changes.
+    """
 
-    SESSION.flush()
+    session = SESSION()
+    stats = flush_stats(session)
+    flushed = stats['flushed']
+    session.flush()
+    if stats['flushed'] == flushed:
+        stats['skipped'] += 1
+
+
+def set_read_only(read_only=True):
+    """Turn autoflush off (or back on) for the current session.
+
+    Meant for code that only reads, like request handlers, so queries don't
+    check the session for changes first.  Writes still flush themselves and
+    clusto.flush() still writes pending changes.  Returns the previous
+    setting.
+    """
+
+    session = SESSION()
+    previous = not session.autoflush
+    session.autoflush = not read_only
+    return previous
+
+
+@contextlib.contextmanager
+def read_only(read_only=True):
+    """Context manager that runs a block with set_read_only()."""
+
+    previous = set_read_only(read_only)
+    try:
+        yield
+    finally:
+        set_read_only(previous)
 
 
 def clear():
     """Clear the changes made to objects in the current session. """
 
     SESSION.expunge_all()
+    attr_cache().invalidate()
     if hasattr(SESSION(), "TRANSACTIONCOUNTER"):
       del SESSION().TRANSACTIONCOUNTER
 
@@ -185,16 +260,19 @@ def get_entities(names=(), clusto_types=(), clusto_drivers=(), attrs=()):
     return [Driver(entity) for entity in query.all()]
 
 
-def get_from_pools(pools, clusto_types=(), clusto_drivers=(), search_children=True):
+def get_from_pools(pools, clusto_types=(), clusto_drivers=(), search_children=True,
+                   operator='intersection'):
     return get_from_entities(
         entities=pools,
         clusto_types=clusto_types,
         clusto_drivers=clusto_drivers,
         search_children=search_children,
-        assert_driver=drivers.Pool
+        assert_driver=drivers.Pool,
+        operator=operator,
     )
 
-def get_from_entities(entities, clusto_types=(), clusto_drivers=(), search_children=True, assert_driver=None):
+def get_from_entities(entities, clusto_types=(), clusto_drivers=(), search_children=True,
+                      assert_driver=None, operator='intersection'):
     """Get entitis that are in all the given entities
 
     parameters:
@@ -202,38 +280,31 @@ def get_from_entities(entities, clusto_types=(), clusto_drivers=(), search_child
       clusto_types - list of Drivers or strings; clusto types to filter on
       clusto_drivers - list of Drivers or strings; clusto drivers to filter on
       assert_driver - if you want to be "strict" about what entity drivers to join
-    """
+      operator - 'intersection' (the default), 'union' for entities in any of
+                 the given entities or 'difference' for the ones in the first
+                 but none of the others
 
-    ent_names = []
-    ent_types = []
+    The set operation runs in the database, so only the resulting entities
+    are loaded.
+    """
 
     for e in entities:
-        if isinstance(e, basestring):
-            ent_names.append(u'%s' % e)
-        else:
-            if assert_driver: 
-                if isinstance(e, assert_driver):
-                    ent_types.append(e)
-                else:
-                    raise TypeError("%s is neither a string or a %s." % (str(e), assert_driver,))
-            else:
-                ent_types.append(e)
+        if (assert_driver and not isinstance(e, basestring)
+            and not isinstance(e, assert_driver)):
+            raise TypeError("%s is neither a string or a %s." % (str(e), assert_driver,))
 
-    ets = ent_types
-    for ent_name in ent_names:
-        if assert_driver:
-            ets.append(get_by_name(ent_name, assert_driver=assert_driver))
-        else:
-            ets.append(get_by_name(ent_name))
+    # in the given order, difference keeps what's in the first one
+    ets = [get_by_name(e, assert_driver=assert_driver)
+           if isinstance(e, basestring) else e
+           for e in entities]
 
-    resultsets = []
-    for e in ets:
-        contents = set(e.contents(clusto_types=clusto_types,
-                                  clusto_drivers=clusto_drivers,
-                                  search_children=search_children))
-        resultsets.append(contents)
+    entity_ids = containment.members([e.entity.entity_id for e in ets],
+                                     operator=operator,
+                                     search_children=search_children,
+                                     clusto_types=clusto_types,
+                                     clusto_drivers=clusto_drivers)
 
-    return reduce(set.intersection, resultsets)
+    return set(containment.load_drivers(entity_ids))
 
 
 def get_by_name(name, assert_driver=None):
@@ -262,7 +333,7 @@ def get_by_name(name, assert_driver=None):
         raise
 
 
-def get_by_names(names):
+def get_by_names(names, chunk_size=500):
     """Return a list of entities matching the given list of names.
 
     This will return the entities in the same order as the passed argument,
@@ -270,21 +341,124 @@ def get_by_names(names):
 
     parameters:
       name - list of strings; names of the entities
+      chunk_size - maximum number of names per query
+    """
+
+    return list(iter_by_names(names, chunk_size))
+
+
+def iter_by_names(names, chunk_size=500):
+    """Yield the entities matching the given names as they're looked up.
+
+    Like get_by_names() but the names are queried chunk_size at a time and
+    the Drivers (or None for names that don't exist) of each chunk are
+    yielded before the next chunk is queried.
+
+    parameters:
+      names - iterable of strings; names of the entities
+      chunk_size - maximum number of names per query
+    """
+
+    for chunk in batch(names, chunk_size):
+        chunk = [unicode(name) for name in chunk]
+
+        found = {}
+        for entity in Entity.query().filter(Entity.name.in_(set(chunk))):
+            found[entity.name] = Driver(entity)
+
+        for name in chunk:
+            yield found.get(name)
+
+
+def prefetch_attrs(drivers, keys=(), subkeys=(), chunk_size=500):
+    """Load the attributes of many drivers at once and attach them.
+
+    The attributes of all the given drivers are fetched with one
+    entity_id IN (...) query per chunk_size drivers.  When no keys or subkeys
+    are given the complete attribute lists end up in the session attribute
+    cache, otherwise the matching attributes are attached to each driver
+    and used by Driver.attrs() for queries on those keys/subkeys.
+
+    parameters:
+      drivers - list of Drivers
+      keys - list of strings; only fetch attributes with these keys
+      subkeys - list of strings; only fetch attributes with these subkeys
+      chunk_size - maximum number of entities per query
     """
 
-    unicode_names = [unicode(name) for name in names]
+    keys = tuple(unicode(k) for k in keys)
+    subkeys = tuple(unicode(k) for k in subkeys)
+    complete = not keys and not subkeys
+    session_cache = attr_cache()
+
+    by_id = {}
+    for d in drivers:
+        by_id.setdefault(d.entity.entity_id, []).append(d)
+
+    for chunk in batch(by_id.keys(), chunk_size):
+        ids = list(chunk)
+        query = Attribute.query().filter(Attribute.entity_id.in_(ids))
+        if keys:
+            query = query.filter(Attribute.key.in_(keys))
+        if subkeys:
+            query = query.filter(Attribute.subkey.in_(subkeys))
+
+        found = dict((entity_id, []) for entity_id in ids)
+        for attr in query.order_by(Attribute.attr_id):
+            found[attr.entity_id].append(attr)
+
+        for entity_id, attrs in found.iteritems():
+            if complete:
+                session_cache.set(entity_id, attrs)
+            else:
+                for d in by_id[entity_id]:
+                    d._prefetched_attrs = (keys, subkeys, attrs,
+                                           session_cache.stamp(entity_id))
+
+    return drivers
 
-    entities = Entity.query().filter(Entity.name.in_(unicode_names)).all()
 
-    retvals = [None for x in xrange(len(names))]
+def attr_records(entity_ids, key=(), value=(), number=(), subkey=(),
+                 ignore_hidden=True, sort_by_keys=True, regex=False,
+                 clusto_types=None, clusto_drivers=None):
+    """Return read-only records of the attributes of many entities at once.
+
+    Takes the same filter arguments as Driver.attr_filter().  When a
+    clusto.cache backend is configured the complete attribute lists are
+    read through it and filtered in memory.  Otherwise the filter is
+    compiled into the SQL query whenever possible (see
+    Driver.attr_filter_criteria).
+
+    Returns a dict of entity_id -> list of AttributeRecords.
+
+    parameters:
+      entity_ids - list of entity ids
+    """
+
+    Driver = drivers.base.Driver
+    filters = dict(key=key, value=value, number=number, subkey=subkey,
+                   ignore_hidden=ignore_hidden, sort_by_keys=sort_by_keys,
+                   regex=regex, clusto_types=clusto_types,
+                   clusto_drivers=clusto_drivers)
+
+    flush()
+    if cache.usable():
+        # the complete lists are cached, filter those
+        records = AttributeRecord.build(
+            cache.fetch('attrs', entity_ids, AttributeRecord.rows))
+        criteria = None
+    else:
+        criteria = Driver.attr_filter_criteria(**filters)
+        records = AttributeRecord.select(entity_ids, criteria or ())
 
-    for entity in entities:
-        try:
-            retvals[names.index(entity.name)] = Driver(entity)
-        except:
-            pass
+    if criteria is None:
+        for entity_id, attrs in records.iteritems():
+            records[entity_id] = Driver.attr_filter(attrs, **filters)
+    elif sort_by_keys:
+        for attrs in records.itervalues():
+            attrs.sort()
 
-    return retvals
+    return records
 
 
 get_by_attr = drivers.base.Driver.get_by_attr
@@ -511,6 +685,7 @@ def commit():
 
 
 def disconnect():
+    attr_cache().invalidate()
     SESSION.close()
 
 def delete_entity(entity):
@@ -0,0 +1,243 @@
+"""Clusto audit log
+
+Changes to entities, attributes and counters are captured as small
+structured records (ids, keys and raw column values) and put on an
+in-process queue.  A background thread formats them and appends them in
+batches to the configured audit log file, either as text lines or as JSON
+lines.
+
+When no audit log is configured the module level sink is None and callers
+skip building records altogether:
+
+>>> if audit.sink:
+>>>     audit.attribute('create', attr)
+"""
+
+import Queue
+import atexit
+import datetime
+import logging
+import os
+import threading
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from sqlalchemy.orm.attributes import instance_state
+
+
+log = logging.getLogger('clusto.audit')
+
+# the active AuditSink, None when auditing is disabled
+sink = None
+
+# entity_id -> name of every entity seen while auditing is enabled, so
+# records can name entities without loading them
+names = {}
+MAX_NAMES = 100000
+_listening = []
+
+VALUE_COLUMNS = ('int_value', 'string_value', 'datetime_value', 'relation_id')
+ATTR_COLUMNS = ('attr_id', 'key', 'subkey', 'number', 'datatype') + VALUE_COLUMNS
+# columns left out of text records when they're empty
+SKIP_EMPTY = ('attr_id',) + VALUE_COLUMNS
+
+
+class AuditSink(object):
+    """Queue audit records and write them from a background thread."""
+
+    def __init__(self, filename, format='text', batch_size=500):
+
+        if format not in ('text', 'json'):
+            raise ValueError("audit log format must be 'text' or 'json'")
+
+        self.filename = os.path.abspath(filename)
+        self.format = format
+        self.batch_size = batch_size
+        self.queue = Queue.Queue()
+        self.stream = None
+        self.stat = None
+
+        self.thread = threading.Thread(target=self._run,
+                                       name='clusto-audit')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, record):
+        self.queue.put(record)
+
+    def flush(self):
+        """Block until every queued record has been written."""
+
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    def _run(self):
+
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            records = [r for r in batch if r is not None]
+            try:
+                if records:
+                    self._write([self._format(r) for r in records])
+            except Exception:
+                log.exception('failed writing %d audit records', len(records))
+            finally:
+                for r in batch:
+                    self.queue.task_done()
+
+            if len(records) != len(batch):
+                if self.stream:
+                    self.stream.close()
+                return
+
+    def _format(self, record):
+        timestamp, event, entity_id, name, fields = record
+        when = datetime.datetime.fromtimestamp(timestamp)
+
+        if self.format == 'json':
+            data = dict(fields)
+            data.update(time=when.isoformat(), event=event,
+                        entity=name, entity_id=entity_id)
+            return json.dumps(data, default=str, sort_keys=True) + '\n'
+
+        parts = ['entity=%s' % (name if name is not None else '#%s' % entity_id)]
+        parts.extend('%s=%s' % (key, val) for key, val in fields
+                     if val is not None or key not in SKIP_EMPTY)
+
+        return '%s clusto.audit INFO %s %s\n' % (
+            when.strftime('%Y-%m-%d %H:%M:%S'), event, ' '.join(parts))
+
+    def _write(self, lines):
+
+        # reopen the file when it got rotated, like WatchedFileHandler
+        try:
+            stat = os.stat(self.filename)
+            stat = (stat.st_dev, stat.st_ino)
+        except OSError:
+            stat = None
+
+        if self.stream is None or stat != self.stat:
+            if self.stream:
+                self.stream.close()
+            self.stream = open(self.filename, 'a')
+            st = os.fstat(self.stream.fileno())
+            self.stat = (st.st_dev, st.st_ino)
+
+        self.stream.write(''.join(line.encode('utf-8')
+                                  if isinstance(line, unicode) else line
+                                  for line in lines))
+        self.stream.flush()
+
+
+def _remember(target, context=None, attrs=None):
+    if sink is None:
+        return
+    if len(names) > MAX_NAMES:
+        names.clear()
+    entity_id = target.__dict__.get('entity_id')
+    if entity_id is not None:
+        names[entity_id] = target.__dict__.get('name')
+
+
+def _inserted(mapper, connection, target):
+    _remember(target)
+
+
+def configure(filename=None, format='text'):
+    """Start writing audit records to filename, or stop if it's None."""
+
+    global sink
+
+    from sqlalchemy import event
+    from clusto.schema import Entity
+
+    if sink is not None:
+        sink.close()
+        sink = None
+
+    names.clear()
+
+    if filename:
+        # listeners can't be removed again, _remember is a no-op while
+        # auditing is disabled
+        if not _listening:
+            event.listen(Entity, 'load', _remember)
+            event.listen(Entity, 'refresh', _remember)
+            event.listen(Entity, 'after_insert', _inserted)
+            _listening.append(True)
+        sink = AuditSink(filename, format)
+
+
+def _identity(obj):
+    """Return the primary key of a mapped object without loading it."""
+
+    key = instance_state(obj).key
+    return key and key[1][0]
+
+
+def _put(event, entity, fields, entity_id=None):
+    name = None
+    if entity is not None:
+        state = entity.__dict__
+        name = state.get('name')
+        entity_id = state.get('entity_id') or _identity(entity)
+    if name is None:
+        name = names.get(entity_id)
+    sink.put((time.time(), event, entity_id, name, fields))
+
+
+def entity(action, entity):
+    """Record an Entity being created or deleted."""
+
+    state = entity.__dict__
+    _put('%s entity' % action, entity,
+         [('driver', state.get('driver')),
+          ('type', state.get('type'))])
+
+
+def attribute(action, attr, entity=None):
+    """Record an Attribute being created, set or deleted."""
+
+    state = dict(attr.__dict__)
+    state.setdefault('attr_id', _identity(attr))
+    if entity is None:
+        entity = state.get('entity')
+    attribute_row(action, entity, state, state.get('entity_id'))
+
+
+def attribute_row(action, entity, row, entity_id=None):
+    """Record an attribute given as a dict of column values."""
+
+    _put('%s attribute' % action, entity,
+         [(name, row.get(name)) for name in ATTR_COLUMNS],
+         entity_id)
+
+
+def counter(action, counter, value):
+    """Record a Counter being created, incremented or deleted."""
+
+    state = counter.__dict__
+    _put('%s counter' % action, state.get('entity'),
+         [('attr_key', state.get('attr_key')),
+          ('value', value)],
+         state.get('entity_id'))
+
+
+@atexit.register
+def _shutdown():
+    if sink is not None:
+        sink.flush()
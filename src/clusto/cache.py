@@ -0,0 +1,292 @@
+"""Clusto read cache
+
+The raw attribute rows read by clusto.attr_records() can be kept in a
+cache shared between sessions, either in process (LocalCache) or in
+memcached (MemcacheCache).  Entries are plain tuples of column values
+stored per entity, never ORM objects.  Writes delete the entries of the
+entities they touch, which never requires reading anything.
+
+The cache is only used when versioning is enabled, which counts every
+commit (see clusto.schema.count_commit).  Every cached value is stamped
+with the commit count at the time it was read, before reading it, and is
+only used while no other commit has been counted.  So neither another
+process' writes, which a local cache never hears about, nor a value read
+before a write but stored after the write deleted it, outlive the next
+check of the count.  The count is re-read with one primary key lookup at
+most every cache_check_interval milliseconds (see VersionClock), so
+several processes see each other's changes within that interval without
+sharing a cache server.  VersionedStore applies the same rule to
+process-local caches of derived data.
+
+The backend is chosen in the [clusto] config section:
+
+  cache = local | memcached | none
+  cache_size = 10000      (local only, number of entities)
+  cache_ttl = 60          (seconds, default 60, 0 to keep entries until
+                           evicted)
+  memcached = 127.0.0.1:11211,...
+  cache_check_interval = 1000   (milliseconds)
+
+Setting only memcached (as older configs do) selects the memcached
+backend.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+
+log = logging.getLogger('clusto.cache')
+
+# the active CacheBackend, None when caching is disabled
+backend = None
+
+
+class CacheBackend(object):
+    """Interface of the cache backends
+
+    Keys are strings, values anything picklable.
+    """
+
+    def get_multi(self, keys):
+        """Return a dict with the values of the keys that were found."""
+
+        raise NotImplementedError()
+
+    def set_multi(self, mapping):
+        raise NotImplementedError()
+
+    def delete_multi(self, keys):
+        raise NotImplementedError()
+
+
+class LocalCache(CacheBackend):
+    """In-process LRU cache with an optional time to live."""
+
+    def __init__(self, size=10000, ttl=0):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get_multi(self, keys):
+
+        found = {}
+        now = time.time()
+        with self.lock:
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry is None:
+                    continue
+                expires, value = entry
+                if expires and expires < now:
+                    continue
+                # move to the most recently used end
+                self.entries[key] = entry
+                found[key] = value
+        return found
+
+    def set_multi(self, mapping):
+
+        expires = self.ttl and time.time() + self.ttl
+        with self.lock:
+            for key, value in mapping.iteritems():
+                self.entries.pop(key, None)
+                self.entries[key] = (expires, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete_multi(self, keys):
+
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+
+class MemcacheCache(CacheBackend):
+    """Cache in memcached, one round trip per get/set/delete batch."""
+
+    def __init__(self, servers, ttl=0, prefix='clusto:'):
+
+        import memcache
+
+        self.client = memcache.Client(servers, debug=0)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get_multi(self, keys):
+        return self.client.get_multi(keys, key_prefix=self.prefix)
+
+    def set_multi(self, mapping):
+        self.client.set_multi(mapping, time=self.ttl, key_prefix=self.prefix)
+
+    def delete_multi(self, keys):
+        self.client.delete_multi(keys, key_prefix=self.prefix)
+
+
+class VersionClock(object):
+    """The commit count of the database, read at most every interval.
+
+    stamp() returns a token for the current count (and database) that
+    cached values get stamped with.  It returns None when the count can't
+    be relied on: when versioning, which does the counting, is disabled,
+    while viewing an older version and inside a transaction (which may
+    hold changes that are not committed yet).
+
+    The count is taken as transactions commit rather than the versions
+    numbered as they begin, so a transaction that began before the latest
+    version but commits after it still moves the clock.
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.commits = None
+        self.checked = 0
+        self.reads = 0
+        self.connection = 0
+
+    def reset(self):
+        """Forget the count, clusto connected to another database."""
+
+        self.commits = None
+        self.connection += 1
+
+    def stamp(self):
+
+        from clusto.schema import SESSION, commit_count
+
+        if (not SESSION.clusto_versioning_enabled
+            or SESSION.clusto_version is not None
+            or SESSION().transaction):
+            return None
+
+        now = time.time()
+        if self.commits is None or now - self.checked >= self.interval:
+            self.commits = SESSION.execute(commit_count()).scalar()
+            self.checked = now
+            self.reads += 1
+
+        return (self.connection, self.commits)
+
+    def touch(self):
+        """Re-read the count on next use, this process just committed."""
+
+        self.checked = 0
+
+
+clock = VersionClock()
+
+
+class VersionedStore(object):
+    """Process-local cache of values only valid until the next commit.
+
+    Values are dropped as soon as the clock moves past the count they
+    were stored at.  Nothing is cached when the clock can't tell (see
+    VersionClock.stamp).
+    """
+
+    def __init__(self, size=1000):
+        self.entries = LocalCache(size)
+
+    def get(self, key, default=None):
+
+        version = clock.stamp()
+        if version is None:
+            return default
+
+        entry = self.entries.get_multi([key]).get(key)
+        if entry is None or entry[0] != version:
+            return default
+        return entry[1]
+
+    def set(self, key, value):
+
+        version = clock.stamp()
+        if version is not None:
+            self.entries.set_multi({key: (version, value)})
+
+    def clear(self):
+        self.entries.delete_multi(self.entries.entries.keys())
+
+
+def configure(config):
+    """Set up the backend from the [clusto] section of a config."""
+
+    global backend
+
+    def option(name, default=None):
+        if config.has_option('clusto', name):
+            return config.get('clusto', name)
+        return default
+
+    kind = option('cache')
+    if kind is None:
+        kind = 'memcached' if option('memcached') else 'none'
+    ttl = int(option('cache_ttl', 60))
+    clock.interval = int(option('cache_check_interval', 1000)) / 1000.0
+    clock.reset()
+
+    if kind == 'none':
+        backend = None
+    elif kind == 'local':
+        backend = LocalCache(int(option('cache_size', 10000)), ttl)
+    elif kind == 'memcached':
+        servers = option('memcached', '127.0.0.1:11211').split(',')
+        log.info('Memcache server list: %s', ','.join(servers))
+        backend = MemcacheCache(servers, ttl)
+    else:
+        raise ValueError("Unknown cache backend %r" % kind)
+
+    return backend
+
+
+def usable():
+    """Can the current session read from and fill the cache.
+
+    Only when cached values can be stamped with the commit count, see
+    VersionClock.stamp().
+    """
+
+    return backend is not None and clock.stamp() is not None
+
+
+def _key(kind, ident):
+    return '%s:%s' % (kind, ident)
+
+
+def fetch(kind, idents, loader):
+    """Return the cached values of idents, loading the missing ones.
+
+    loader is called with the list of idents that weren't cached and has
+    to return a dict of ident -> value.  Returns a dict ident -> value.
+    """
+
+    idents = list(idents)
+    if not usable():
+        return loader(idents)
+
+    # stamped before loading, values that a concurrent write deletes before
+    # they're stored carry the count preceding that write
+    version = clock.stamp()
+    keys = dict((_key(kind, ident), ident) for ident in idents)
+    found = {}
+    for key, (stamp, value) in backend.get_multi(keys.keys()).iteritems():
+        if stamp == version:
+            found[keys[key]] = value
+
+    missing = [ident for ident in idents if ident not in found]
+    if missing:
+        loaded = loader(missing)
+        backend.set_multi(dict((_key(kind, ident), (version, value))
+                               for ident, value in loaded.iteritems()))
+        found.update(loaded)
+
+    return found
+
+
+def expire(kind, idents):
+    """Drop the cached values of idents."""
+
+    if backend is not None and idents:
+        backend.delete_multi([_key(kind, ident) for ident in idents])
@@ -0,0 +1,256 @@
+"""Materialized containment closure
+
+With closure enabled in the [clusto] section of the config the
+entity_closure table holds a row for every entity and each of the entities
+containing it, directly (depth 1) or not, at the smallest depth it's
+contained at.  The rows are kept current whenever _contains attributes are
+added or deleted, in the same transaction, so "everything under X" and "is
+X inside Y" are single indexed lookups (see clusto.containment.walk).
+
+Rows are versioned like attributes: replaced rows get a deleted_at_version
+(or are deleted without versioning) and new ones the working version.
+
+Databases created before the table existed, or used without closure
+enabled, are filled with rebuild() (clusto closure rebuild) and compared
+with the _contains attributes by check() (clusto closure check).
+"""
+
+import logging
+
+import clusto
+from clusto.schema import SESSION, ATTR_TABLE, ENTITY_CLOSURE_TABLE
+from clusto.schema import working_version
+from clusto.util import batch
+
+from sqlalchemy import select, and_
+
+
+log = logging.getLogger('clusto.closure')
+
+
+def enabled():
+    """Is the closure table maintained (and used)."""
+
+    return SESSION.clusto_closure_enabled
+
+
+def _live_edges(session, child_ids=None):
+    """Return {child_id: set(parent_ids)} of the current _contains attributes.
+
+    All of them if child_ids is None.
+    """
+
+    a = ATTR_TABLE
+    criteria = [a.c.key == u'_contains', a.c.deleted_at_version == None]
+
+    parents = {}
+    if child_ids is None:
+        chunks = [None]
+    else:
+        chunks = batch(list(child_ids), 500)
+
+    for chunk in chunks:
+        where = list(criteria)
+        if chunk is not None:
+            where.append(a.c.relation_id.in_(list(chunk)))
+        query = select([a.c.relation_id, a.c.entity_id], and_(*where))
+        for child_id, parent_id in session.execute(query):
+            parents.setdefault(child_id, set()).add(parent_id)
+
+    return parents
+
+
+def _live_rows(session, column, ids):
+    """Return the current rows whose column (a table column) is in ids."""
+
+    c = ENTITY_CLOSURE_TABLE
+    rows = []
+    for chunk in batch(list(ids), 500):
+        query = select([c.c.closure_id, c.c.ancestor_id, c.c.descendant_id,
+                        c.c.depth],
+                       and_(column.in_(list(chunk)),
+                            c.c.deleted_at_version == None))
+        rows.extend(session.execute(query))
+    return rows
+
+
+def _compute(nodes, parents, outside):
+    """Return {entity_id: {ancestor_id: depth}} for the entities in nodes.
+
+    parents maps the nodes to their direct parents and outside the parents
+    that aren't in nodes to their (already known) ancestors.  Like
+    containment.walk() entities on a cycle are their own ancestors, at the
+    length of the cycle.
+    """
+
+    ancestors = dict((n, {}) for n in nodes)
+    limit = clusto.containment.MAX_CONTAINMENT_DEPTH
+
+    # shortest paths, repeated until nothing changes (at most len(nodes)
+    # rounds, usually as many as the hierarchy is deep)
+    changed = True
+    while changed:
+        changed = False
+        for node in nodes:
+            found = {}
+            for parent in parents.get(node, ()):
+                above = ancestors.get(parent)
+                if above is None:
+                    above = outside.get(parent, {})
+                for ancestor, depth in [(parent, 0)] + above.items():
+                    if depth >= limit:
+                        continue
+                    if depth + 1 < found.get(ancestor, limit + 1):
+                        found[ancestor] = depth + 1
+            if found != ancestors[node]:
+                ancestors[node] = found
+                changed = True
+
+    return ancestors
+
+
+def _write(session, existing, computed):
+    """Make the current rows of the computed entities match computed.
+
+    existing is a list of the current rows of those entities.  Returns the
+    number of rows deleted and inserted.
+    """
+
+    c = ENTITY_CLOSURE_TABLE
+
+    stale = []
+    kept = set()
+    for closure_id, ancestor_id, descendant_id, depth in existing:
+        if computed.get(descendant_id, {}).get(ancestor_id) == depth:
+            kept.add((ancestor_id, descendant_id))
+        else:
+            stale.append(closure_id)
+
+    rows = [(ancestor_id, descendant_id, depth)
+            for descendant_id, ancestors in computed.iteritems()
+            for ancestor_id, depth in ancestors.iteritems()
+            if (ancestor_id, descendant_id) not in kept]
+
+    if not stale and not rows:
+        return 0
+
+    version = session.execute(working_version()).scalar()
+
+    for chunk in batch(stale, 500):
+        where = c.c.closure_id.in_(list(chunk))
+        if SESSION.clusto_versioning_enabled:
+            session.execute(c.update().where(where).values(
+                deleted_at_version=version))
+        else:
+            session.execute(c.delete().where(where))
+
+    if rows:
+        session.execute(c.insert(), [dict(ancestor_id=a, descendant_id=d,
+                                          depth=depth, version=version)
+                                     for a, d, depth in sorted(rows)])
+
+    return len(stale) + len(rows)
+
+
+def update(session, entity_ids):
+    """Recompute the closure of entity_ids and of everything they contain.
+
+    Called with the children of the _contains attributes added or deleted,
+    inside the transaction that changed them.
+    """
+
+    entity_ids = set(entity_ids)
+    if not entity_ids:
+        return 0
+
+    c = ENTITY_CLOSURE_TABLE
+
+    # only the moved entities and what's below them can have new ancestors
+    nodes = set(entity_ids)
+    nodes.update(row[2] for row in _live_rows(session, c.c.ancestor_id,
+                                              entity_ids))
+
+    parents = _live_edges(session, nodes)
+
+    above = set(p for ps in parents.itervalues() for p in ps) - nodes
+    outside = dict((p, {}) for p in above)
+    for closure_id, ancestor_id, descendant_id, depth in \
+            _live_rows(session, c.c.descendant_id, above):
+        outside[descendant_id][ancestor_id] = depth
+
+    computed = _compute(nodes, parents, outside)
+    existing = _live_rows(session, c.c.descendant_id, nodes)
+
+    return _write(session, existing, computed)
+
+
+def _expected(session):
+    parents = _live_edges(session)
+    return _compute(set(parents), parents, {})
+
+
+def rebuild():
+    """Fill the closure table from the current _contains attributes.
+
+    Creates the table if it's missing.  Rows that don't match the
+    attributes are replaced; with versioning they're kept with a
+    deleted_at_version, but rows from before the rebuild may not describe
+    the containment of older versions correctly.
+
+    Returns the number of rows deleted and inserted.
+    """
+
+    ENTITY_CLOSURE_TABLE.create(SESSION.bind, checkfirst=True)
+
+    clusto.begin_transaction()
+    try:
+        session = SESSION()
+        c = ENTITY_CLOSURE_TABLE
+        existing = session.execute(
+            select([c.c.closure_id, c.c.ancestor_id, c.c.descendant_id,
+                    c.c.depth], c.c.deleted_at_version == None)).fetchall()
+
+        computed = _expected(session)
+        for row in existing:
+            computed.setdefault(row[2], {})
+
+        changes = _write(session, existing, computed)
+        if changes:
+            SESSION.flushed.add(c)
+        clusto.commit()
+    except Exception, x:
+        clusto.rollback_transaction()
+        raise x
+
+    log.info("Rebuilt entity closure, %d rows changed", changes)
+    return changes
+
+
+def check():
+    """Compare the closure table with the current _contains attributes.
+
+    Returns a list of (ancestor_id, descendant_id, expected_depth,
+    found_depth) for every row that's missing (found_depth is None), extra
+    (expected_depth is None) or at the wrong depth.  An empty list means
+    the table is consistent.
+    """
+
+    session = SESSION()
+    c = ENTITY_CLOSURE_TABLE
+
+    found = {}
+    for ancestor_id, descendant_id, depth in session.execute(
+            select([c.c.ancestor_id, c.c.descendant_id, c.c.depth],
+                   c.c.deleted_at_version == None)):
+        found[(ancestor_id, descendant_id)] = depth
+
+    expected = {}
+    for descendant_id, ancestors in _expected(session).iteritems():
+        for ancestor_id, depth in ancestors.iteritems():
+            expected[(ancestor_id, descendant_id)] = depth
+
+    problems = []
+    for pair in sorted(set(found) | set(expected)):
+        if found.get(pair) != expected.get(pair):
+            problems.append(pair + (expected.get(pair), found.get(pair)))
+    return problems
@@ -122,6 +122,7 @@ class Allocate(script_helper.Script):
         self.info('Searching for servers in "%s", this may take a while' % parent.name)
 
         unallocated = [ _ for _ in parent.contents(clusto_types=[drivers.servers.BasicServer], search_children=True) ]
+        clusto.prefetch_attrs(unallocated, keys=['ip', 'system', 'disk'])
         unallocated = [ _ for _ in unallocated if _ in pool and _.get_ips() ]
         self.debug('The unallocated list size is %d' % len(unallocated))
         if len(unallocated) < number:
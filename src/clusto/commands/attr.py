@@ -94,7 +94,10 @@ class Attr(script_helper.Script):
         return self.obj.del_attrs(**kwargs)
 
     def run_show(self, kwargs):
-        attrs = self.obj.attrs(**kwargs)
+        if kwargs.pop('merge_container_attrs', False):
+            attrs = self.obj.attrs(merge_container_attrs=True, **kwargs)
+        else:
+            attrs = self.obj.attr_records(**kwargs)
         attrs.sort(key=lambda _: (_.key, _.number, _.subkey, _.value))
         result = []
         for attr in attrs:
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- mode: python; sh-basic-offset: 4; indent-tabs-mode: nil; coding: utf-8 -*-
+# vim: tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8
+
+import sys
+
+import clusto
+from clusto import script_helper
+
+
+class Closure(script_helper.Script):
+    '''
+    Rebuilds the entity_closure table from the containment of every entity,
+    or checks that it matches it.
+    '''
+
+    def __init__(self):
+        script_helper.Script.__init__(self)
+
+    def _add_arguments(self, parser):
+        parser.add_argument('action', choices=['rebuild', 'check'],
+            help='rebuild: create and fill the table, check: report rows '
+                 'that are missing, extra or at the wrong depth')
+
+    def run(self, args):
+        if args.action == 'rebuild':
+            changes = clusto.closure.rebuild()
+            self.info('%d closure rows changed' % changes)
+            return 0
+
+        problems = clusto.closure.check()
+        for ancestor_id, descendant_id, expected, found in problems:
+            print '%d %d expected %s found %s' % (ancestor_id, descendant_id,
+                                                  expected, found)
+        if problems:
+            self.error('%d closure rows are inconsistent' % len(problems))
+            return 1
+        return 0
+
+
+def main():
+    closure, args = script_helper.init_arguments(Closure)
+    return(closure.run(args))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -92,22 +92,27 @@ class Info(script_helper.Script):
             return 0
         item_list = []
         self.debug('Fetching the list of items: %s' % ','.join(args.items))
+        objs = []
         for item in args.items:
             obj = clusto.get(item)
             if not obj:
                 self.warn("The item %s couldn't be found" % item)
                 continue
-            obj = obj[0]
+            objs.append(obj[0])
+        records = clusto.attr_records([_.entity.entity_id for _ in objs])
+        clusto.prefetch_attrs(objs, keys=['ip'])
+        for obj in objs:
             self.debug('Object found! %s' % obj)
             item_attrs = {
                 'name': obj.name,
                 'type': obj.type,
             }
+            attrs = records[obj.entity.entity_id]
 #           Fetch system attrs
-            for attr in obj.attrs(key='system'):
+            for attr in obj.attr_filter(attrs, key='system'):
                 item_attrs[attr.subkey] = attr.value
 #           fetch description(s)
-            values = obj.attrs(key='description')
+            values = obj.attr_filter(attrs, key='description')
             if values:
                 item_attrs['description'] = [ _.value for _ in values]
             else:
@@ -126,7 +131,7 @@ class Info(script_helper.Script):
                 if values:
                     item_attrs['ip'] = [ _ for _ in values ]
 #           fetch mac(s)
-            values = [ _ for _ in obj.attrs(key='port-nic-eth') if _.subkey.find('mac') != -1 ]
+            values = [ _ for _ in obj.attr_filter(attrs, key='port-nic-eth') if _.subkey.find('mac') != -1 ]
             if values:
                 for value in values:
                     item_attrs['mac%d' % value.number] = value.value
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- mode: python; sh-basic-offset: 4; indent-tabs-mode: nil; coding: utf-8 -*-
+# vim: tabstop=4 softtabstop=4 expandtab shiftwidth=4 fileencoding=utf-8
+
+import sys
+
+import clusto
+from clusto import script_helper
+
+
+class IpamReport(script_helper.Script):
+    '''
+    Reports the size, allocated and free addresses of every ip manager's
+    subnet, computed with a few queries for all of them.
+    '''
+
+    def __init__(self):
+        script_helper.Script.__init__(self)
+
+    def _add_arguments(self, parser):
+        parser.add_argument('--min-utilization', type=float, default=0.0,
+            help='Only show subnets at least this full, in percent '
+                 '(defaults to 0)')
+
+    def run(self, args):
+        report = [subnet for subnet in clusto.IPManager.utilization_report()
+                  if subnet['utilization'] >= args.min_utilization]
+
+        print '%-20s %-20s %8s %8s %8s %8s %7s' % (
+            'name', 'network', 'size', 'used', 'free', 'largest', 'util%')
+        for subnet in report:
+            print '%-20s %-20s %8d %8d %8d %8d %7.1f' % (
+                subnet['name'], subnet['network'], subnet['size'],
+                subnet['used'], subnet['free'],
+                subnet['largest_free_block'], subnet['utilization'])
+        return 0
+
+
+def main():
+    report, args = script_helper.init_arguments(IpamReport)
+    return(report.run(args))
+
+if __name__ == '__main__':
+    sys.exit(main())
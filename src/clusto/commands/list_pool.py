@@ -11,7 +11,8 @@ from clusto import script_helper
 
 class ListPool(script_helper.Script):
     '''
-    Lists servers that are part of two given pools.
+    Lists servers that are part of all the given pools (or any of them, or
+    the first but none of the others).
     '''
 
     def __init__(self):
@@ -24,29 +25,31 @@ class ListPool(script_helper.Script):
             help='Search resursively on both pools (defaults to False)')
         parser.add_argument('--type', default=None,
             help='Restrict results to the given type')
+        parser.add_argument('--operator', default='intersection',
+            choices=clusto.containment.OPERATORS,
+            help='How to combine the pools: servers in all of them '
+                 '(intersection, the default), in any of them (union) or '
+                 'in the first but none of the others (difference)')
         parser.add_argument('pool', nargs='+', metavar='pool',
             help='Pool(s) to query')
 
     def run(self, args):
-        serverset = None
-        for pool in args.pool:
-            pool = clusto.get_by_name(pool)
-            contents = pool.contents(search_children=args.recursive)
-            if args.type:
-                contents = [x for x in contents if x.type == args.type]
-            contents = set(contents)
+        serverset = clusto.get_from_entities(
+            args.pool,
+            clusto_types=[args.type] if args.type else (),
+            search_children=args.recursive,
+            operator=args.operator)
 
-            if serverset is None:
-                serverset = contents
-            else:
-                serverset = serverset.intersection(pool)
+        if not args.names:
+            # the ips of all the servers at once
+            ips = clusto.IPManager.get_ips_for(serverset)
 
-        for server in serverset:
+        for server in sorted(serverset):
             if args.names:
                 print server.name
             else:
                 try:
-                    ip = server.get_ips()
+                    ip = ips[server]
                     ip.sort(key=lambda x: IP(x))
                 except Exception, e:
                     self.debug(e)
@@ -0,0 +1,605 @@
+"""Which entities contain which
+
+walk() follows the _contains attributes from some entities up or down
+and members() combines the contents of several entities, each with one
+recursive query where the database supports them, or one lookup in the
+entity_closure table when that's enabled (see clusto.closure).
+
+A ContainmentIndex holds every parent/child edge of clusto (the _contains
+attributes) so long running services can answer tree questions without
+querying the database:
+
+>>> index = ContainmentIndex()
+>>> index.children(pool.entity.entity_id)
+>>> index.ancestors(server.entity.entity_id)
+
+Entities are numbered densely and the edges kept in integer arrays.  The
+index remembers the clusto version it's current at; refresh() replays the
+_contains attributes created or deleted since, with one query.  Without
+versioning refresh() rebuilds the whole index.
+"""
+
+import array
+import collections
+import logging
+import threading
+
+import clusto
+from clusto.schema import SESSION, ATTR_TABLE, ENTITY_TABLE, latest_version
+from clusto.schema import Entity, Attribute
+from clusto.util import batch
+
+from sqlalchemy import select, and_, or_, text
+
+
+log = logging.getLogger('clusto.containment')
+
+
+# containment is followed at most this many levels deep, which also ends the
+# walk through cycles
+MAX_CONTAINMENT_DEPTH = 64
+
+
+def recursive_queries():
+    """Can the database run WITH RECURSIVE queries.
+
+    sqlite from 3.8.3, MySQL from 8.0 (MariaDB from 10.2) and PostgreSQL.
+    """
+
+    dialect = clusto.SESSION.bind.dialect
+
+    if dialect.name == 'sqlite':
+        return dialect.dbapi.sqlite_version_info >= (3, 8, 3)
+    elif dialect.name == 'mysql':
+        version = dialect.server_version_info
+        if not version:
+            return False
+        if 'MariaDB' in version:
+            return version >= (10, 2)
+        return version >= (8,)
+    elif dialect.name == 'postgresql':
+        return True
+
+    return False
+
+
+def _version_sql(alias, params):
+    """Entity._version_args() / Attribute._version_args() as SQL text."""
+
+    if clusto.SESSION.clusto_version is None:
+        return '%s.deleted_at_version IS NULL' % alias
+
+    params['clusto_version'] = clusto.SESSION.clusto_version
+    return ('%(a)s.version <= :clusto_version AND '
+            '(%(a)s.deleted_at_version IS NULL OR '
+            '%(a)s.deleted_at_version > :clusto_version)' % {'a': alias})
+
+
+def _in_sql(column, name, values, params):
+    """Return "column IN (:name_0, ...)" and add the values to params."""
+
+    names = []
+    for i, value in enumerate(values):
+        params['%s_%d' % (name, i)] = value
+        names.append(':%s_%d' % (name, i))
+    return '%s IN (%s)' % (column, ', '.join(names))
+
+
+def _names(values, get_name):
+    return values and [get_name(n) for n in values]
+
+
+def _entity_filters(types, drivers, params):
+    """SQL text keeping the current entities e of the given types/drivers."""
+
+    filters = [_version_sql('e', params)]
+    for values, column in ((types, 'e.type'), (drivers, 'e.driver')):
+        if values:
+            filters.append(_in_sql(column, column[2:], values, params))
+    return ' AND '.join(filters)
+
+
+def walk(entity_ids, up=False, clusto_types=None, clusto_drivers=None,
+         through_types=None, max_depth=None):
+    """Walk the _contains attributes from entity_ids.
+
+    Returns a list of (entity_id, depth) of everything contained in the
+    given entities (or containing them if up is True), each entity once at
+    the smallest depth it's found at, ordered by depth.  The entities at
+    the end of the walk are filtered by clusto_types and clusto_drivers,
+    the ones in between aren't.  If through_types is given the walk only
+    continues past entities of those types.
+
+    With the closure table the walk is one indexed lookup, otherwise
+    databases with recursive queries do it in one query, others with one
+    query per level.
+    """
+
+    if not entity_ids:
+        return []
+
+    clusto.flush()
+
+    if max_depth is None or max_depth > MAX_CONTAINMENT_DEPTH:
+        max_depth = MAX_CONTAINMENT_DEPTH
+
+    args = (entity_ids, up,
+            _names(clusto_types, clusto.get_type_name),
+            _names(clusto_drivers, clusto.get_driver_name),
+            _names(through_types, clusto.get_type_name),
+            max_depth)
+
+    if use_closure() and not through_types:
+        return _walk_closure(*args)
+    if recursive_queries():
+        return _walk_query(*args)
+    return _walk_levels(*args)
+
+
+def use_closure():
+    """Can the closure table answer queries about the current version."""
+
+    return (clusto.SESSION.clusto_closure_enabled
+            and clusto.SESSION.clusto_version is None)
+
+
+def _closure_sql(start, start_ids, params):
+    """The closure rows of start_ids as root_id, entity_id and depth."""
+
+    follow = {'ancestor_id': 'descendant_id',
+              'descendant_id': 'ancestor_id'}[start]
+    return """
+            SELECT l.%s AS root_id, l.%s AS entity_id, l.depth AS depth
+            FROM entity_closure l
+            WHERE %s AND l.deleted_at_version IS NULL""" % (
+        start, follow, _in_sql('l.' + start, 'start', start_ids, params))
+
+
+def _walk_closure(entity_ids, up, types, drivers, through_types, max_depth):
+
+    params = {'max_depth': max_depth}
+    query = """
+        SELECT e.entity_id, MIN(c.depth)
+        FROM (%s) c JOIN entities e ON e.entity_id = c.entity_id
+        WHERE c.depth <= :max_depth AND %s
+        GROUP BY e.entity_id
+        ORDER BY 2, 1""" % (
+        _closure_sql('descendant_id' if up else 'ancestor_id', entity_ids,
+                     params),
+        _entity_filters(types, drivers, params))
+
+    return [tuple(row) for row in clusto.SESSION.execute(text(query), params)]
+
+
+def _walk_query(entity_ids, up, types, drivers, through_types, max_depth):
+
+    # built as text because sqlalchemy 0.7 orders the positional parameters
+    # of CTEs wrongly.  Columns are qualified so that key needs no quoting.
+    if up:
+        start, follow = 'relation_id', 'entity_id'
+    else:
+        start, follow = 'entity_id', 'relation_id'
+
+    params = {'key': u'_contains', 'max_depth': max_depth}
+
+    through = ''
+    if through_types:
+        through = 'JOIN entities t ON t.entity_id = c.entity_id AND %s' % (
+            _in_sql('t.type', 'through', through_types, params))
+
+    query = """
+        WITH RECURSIVE clusto_containment(entity_id, depth) AS (
+            SELECT a.%(follow)s, 1
+            FROM entity_attrs a
+            WHERE a.key = :key AND %(start_ids)s AND %(version)s
+          UNION
+            SELECT a.%(follow)s, c.depth + 1
+            FROM entity_attrs a JOIN clusto_containment c
+              ON a.%(start)s = c.entity_id %(through)s
+            WHERE a.key = :key AND c.depth < :max_depth AND %(version)s
+        )
+        SELECT e.entity_id, MIN(c.depth), MAX(c.depth)
+        FROM clusto_containment c JOIN entities e ON e.entity_id = c.entity_id
+        WHERE %(filters)s
+        GROUP BY e.entity_id
+        ORDER BY 2, 1""" % {
+        'start': start,
+        'follow': follow,
+        'start_ids': _in_sql('a.' + start, 'start', entity_ids, params),
+        'version': _version_sql('a', params),
+        'through': through,
+        'filters': _entity_filters(types, drivers, params),
+        }
+
+    result = clusto.SESSION.execute(text(query), params)
+
+    # python 2's sqlite3 returns no description for WITH queries without rows
+    if not result.returns_rows:
+        return []
+
+    found = []
+    deepest = 0
+    for entity_id, depth, last in result:
+        found.append((entity_id, depth))
+        deepest = max(deepest, last)
+
+    if deepest == MAX_CONTAINMENT_DEPTH:
+        # entities keep being found at every depth on a cycle
+        log.warning("Containment of entities %s is cyclic or deeper than %d",
+                    entity_ids, MAX_CONTAINMENT_DEPTH)
+
+    return found
+
+
+def _walk_levels(entity_ids, up, types, drivers, through_types, max_depth):
+
+    if up:
+        start, follow = Attribute.relation_id, Attribute.entity_id
+    else:
+        start, follow = Attribute.entity_id, Attribute.relation_id
+
+    def select_ids(column, by, ids, criteria):
+        found = set()
+        for chunk in batch(ids, 500):
+            query = clusto.SESSION.query(column).filter(
+                and_(by.in_(list(chunk)), *criteria))
+            found.update(row[0] for row in query)
+        return found
+
+    contains = [Attribute.key == u'_contains'] + Attribute._version_args()
+
+    depths = {}
+    frontier = list(entity_ids)
+    depth = 0
+    while frontier and depth < max_depth:
+        depth += 1
+        frontier = [i for i in select_ids(follow, start, frontier, contains)
+                    if i not in depths]
+        for entity_id in frontier:
+            depths[entity_id] = depth
+
+        if through_types and frontier:
+            frontier = list(select_ids(Entity.entity_id, Entity.entity_id,
+                                       frontier,
+                                       [Entity.type.in_(through_types)]))
+
+    criteria = Entity._version_args()
+    if types:
+        criteria.append(Entity.type.in_(types))
+    if drivers:
+        criteria.append(Entity.driver.in_(drivers))
+
+    found = select_ids(Entity.entity_id, Entity.entity_id, depths.keys(),
+                       criteria)
+    return sorted(((i, depths[i]) for i in found),
+                  key=lambda (entity_id, depth): (depth, entity_id))
+
+
+OPERATORS = ('intersection', 'union', 'difference')
+
+
+def members(entity_ids, operator='intersection', search_children=True,
+            clusto_types=None, clusto_drivers=None):
+    """Return the ids of the entities in entity_ids combined by operator.
+
+    operator is one of:
+      intersection - the entities in all of entity_ids
+      union - the entities in any of them
+      difference - the entities in the first but in none of the others
+
+    With search_children entities count as being in an entity if they're
+    anywhere in its contents, otherwise only if directly contained.  The
+    results are filtered by clusto_types and clusto_drivers.
+
+    The set operation runs in the database so only the resulting ids are
+    read, sorted.
+    """
+
+    if operator not in OPERATORS:
+        raise ValueError("operator must be one of %s" % ', '.join(OPERATORS))
+
+    # a root given twice counts once, in SQL as in the python fallback
+    roots = []
+    for entity_id in entity_ids:
+        if entity_id not in roots:
+            roots.append(entity_id)
+    entity_ids = roots
+
+    if not entity_ids:
+        return []
+
+    clusto.flush()
+
+    types = _names(clusto_types, clusto.get_type_name)
+    drivers = _names(clusto_drivers, clusto.get_driver_name)
+
+    closure = search_children and use_closure()
+
+    if search_children and not closure and not recursive_queries():
+        found = [set(entity_id for entity_id, depth in
+                     _walk_levels([root], False, types, drivers, None,
+                                  MAX_CONTAINMENT_DEPTH))
+                 for root in entity_ids]
+        if operator == 'difference':
+            return sorted(found[0].difference(*found[1:]))
+        return sorted(getattr(set, operator)(*found))
+
+    params = {'key': u'_contains', 'max_depth': MAX_CONTAINMENT_DEPTH}
+    direct = """
+            SELECT a.entity_id AS root_id, a.relation_id AS entity_id, 1 AS depth
+            FROM entity_attrs a
+            WHERE a.key = :key AND %s AND %s""" % (
+        _in_sql('a.entity_id', 'root', entity_ids, params),
+        _version_sql('a', params))
+
+    if closure:
+        source = ''
+        members = '(%s)' % _closure_sql('ancestor_id', entity_ids, params)
+    elif search_children:
+        source = """
+        WITH RECURSIVE clusto_members(root_id, entity_id, depth) AS (%s
+          UNION
+            SELECT c.root_id, a.relation_id, c.depth + 1
+            FROM entity_attrs a JOIN clusto_members c
+              ON a.entity_id = c.entity_id
+            WHERE a.key = :key AND c.depth < :max_depth AND %s
+        )""" % (direct, _version_sql('a', params))
+        members = 'clusto_members'
+    else:
+        source = ''
+        members = '(%s)' % direct
+
+    if operator == 'intersection':
+        params['roots'] = len(entity_ids)
+        having = 'HAVING COUNT(DISTINCT c.root_id) = :roots'
+    elif operator == 'difference':
+        params['first'] = entity_ids[0]
+        having = ('HAVING SUM(CASE WHEN c.root_id = :first THEN 1 ELSE 0 END) > 0 '
+                  'AND SUM(CASE WHEN c.root_id = :first THEN 0 ELSE 1 END) = 0')
+    else:
+        having = ''
+
+    query = """%s
+        SELECT e.entity_id
+        FROM %s c JOIN entities e ON e.entity_id = c.entity_id
+        WHERE %s
+        GROUP BY e.entity_id
+        %s
+        ORDER BY e.entity_id""" % (source, members,
+                                   _entity_filters(types, drivers, params),
+                                   having)
+
+    result = clusto.SESSION.execute(text(query), params)
+
+    # python 2's sqlite3 returns no description for WITH queries without rows
+    if not result.returns_rows:
+        return []
+
+    return [row[0] for row in result]
+
+
+def load_drivers(entity_ids):
+    """Return Drivers for the entities in entity_ids, in that order."""
+
+    entities = {}
+    for ids in batch(entity_ids, 500):
+        for entity in Entity.query().filter(Entity.entity_id.in_(list(ids))):
+            entities[entity.entity_id] = entity
+
+    return [clusto.Driver(entities[i]) for i in entity_ids if i in entities]
+
+
+class ContainmentIndex(object):
+    """The parent/child relationships of all entities."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._build()
+
+    def _build(self):
+
+        # read the version first, changes made while reading the edges get
+        # replayed again by the next refresh(), which is harmless as edges
+        # are keyed by their _contains attribute
+        version = SESSION.execute(latest_version()).scalar()
+
+        self._ids = []
+        self._slots = {}
+        self._children = []
+        self._parents = []
+        self._edges = {}
+        self.names = {}
+        self.types = {}
+        self._sizes = {}
+
+        a = ATTR_TABLE
+        parents = ENTITY_TABLE.alias()
+        children = ENTITY_TABLE.alias()
+        query = select([a.c.attr_id,
+                        parents.c.entity_id, parents.c.name, parents.c.type,
+                        children.c.entity_id, children.c.name, children.c.type],
+                       and_(a.c.key == u'_contains',
+                            a.c.deleted_at_version == None,
+                            parents.c.deleted_at_version == None,
+                            children.c.deleted_at_version == None),
+                       from_obj=[a.join(parents,
+                                        parents.c.entity_id == a.c.entity_id)
+                                  .join(children,
+                                        children.c.entity_id == a.c.relation_id)])
+
+        for row in SESSION.execute(query):
+            attr_id, parent_id, child_id = row[0], row[1], row[4]
+            self._add_entity(*row[1:4])
+            self._add_entity(*row[4:7])
+            self._add_edge(parent_id, child_id, attr_id)
+
+        self.version = version
+
+    def _add_entity(self, entity_id, name, clusto_type):
+
+        if entity_id in self._slots:
+            return
+        self._slots[entity_id] = len(self._ids)
+        self._ids.append(entity_id)
+        self._children.append(array.array('l'))
+        self._parents.append(array.array('l'))
+        self.names[entity_id] = name
+        self.types[entity_id] = clusto_type
+
+    def _add_edge(self, parent_id, child_id, attr_id):
+
+        # an entity can be inserted more than once, the edge lasts while any
+        # of its _contains attributes do
+        edge = self._slots[parent_id], self._slots[child_id]
+        attr_ids = self._edges.setdefault(edge, set())
+        if not attr_ids:
+            parent, child = edge
+            self._children[parent].append(child)
+            self._parents[child].append(parent)
+        attr_ids.add(attr_id)
+
+    def _remove_edge(self, parent_id, child_id, attr_id):
+
+        edge = self._slots.get(parent_id), self._slots.get(child_id)
+        attr_ids = self._edges.get(edge)
+        if not attr_ids or attr_id not in attr_ids:
+            return
+        attr_ids.remove(attr_id)
+        if not attr_ids:
+            del self._edges[edge]
+            parent, child = edge
+            self._children[parent].remove(child)
+            self._parents[child].remove(parent)
+
+    def refresh(self):
+        """Apply the containment changes made since the index was built.
+
+        Returns the number of _contains attributes replayed.
+        """
+
+        with self.lock:
+            if not SESSION.clusto_versioning_enabled:
+                self._build()
+                return len(self.names)
+
+            version = SESSION.execute(latest_version()).scalar()
+            if version == self.version:
+                return 0
+
+            a = ATTR_TABLE
+            query = select([a.c.attr_id, a.c.entity_id, a.c.relation_id,
+                            a.c.deleted_at_version],
+                           and_(a.c.key == u'_contains',
+                                or_(a.c.version > self.version,
+                                    a.c.deleted_at_version > self.version))
+                           ).order_by(a.c.attr_id)
+            changes = SESSION.execute(query).fetchall()
+
+            new = set(entity_id for row in changes
+                      for entity_id in row[1:3]) - set(self._slots)
+            for ids in batch(list(new), 500):
+                e = ENTITY_TABLE
+                for row in SESSION.execute(select([e.c.entity_id, e.c.name,
+                                                   e.c.type],
+                                                  e.c.entity_id.in_(list(ids)))):
+                    self._add_entity(*row)
+
+            for attr_id, parent_id, child_id, deleted in changes:
+                if deleted is None:
+                    self._add_edge(parent_id, child_id, attr_id)
+                else:
+                    self._remove_edge(parent_id, child_id, attr_id)
+
+            self._sizes.clear()
+            self.version = version
+
+        return len(changes)
+
+    def __contains__(self, entity_id):
+        return entity_id in self._slots
+
+    def children(self, entity_id):
+        """Return the ids of the entities entity_id directly contains."""
+
+        slot = self._slots.get(entity_id)
+        if slot is None:
+            return []
+        return [self._ids[i] for i in self._children[slot]]
+
+    def parents(self, entity_id):
+        """Return the ids of the entities directly containing entity_id."""
+
+        slot = self._slots.get(entity_id)
+        if slot is None:
+            return []
+        return [self._ids[i] for i in self._parents[slot]]
+
+    def _walk(self, slot, edges):
+        """Yield (slot, depth) reachable from slot, each once, nearest first."""
+
+        seen = set([slot])
+        queue = collections.deque([(slot, 0)])
+        while queue:
+            current, depth = queue.popleft()
+            for following in edges[current]:
+                if following not in seen:
+                    seen.add(following)
+                    queue.append((following, depth + 1))
+                    yield following, depth + 1
+
+    def subtree_size(self, entity_id):
+        """Return the number of entities entity_id contains, directly or not.
+
+        Entities reachable along several paths are counted once.
+        """
+
+        slot = self._slots.get(entity_id)
+        if slot is None:
+            return 0
+
+        size = self._sizes.get(slot)
+        if size is None:
+            size = sum(1 for found in self._walk(slot, self._children))
+            self._sizes[slot] = size
+        return size
+
+    def descendants(self, entity_id):
+        """Return (entity_id, depth) of everything entity_id contains."""
+
+        slot = self._slots.get(entity_id)
+        if slot is None:
+            return []
+        return [(self._ids[s], depth)
+                for s, depth in self._walk(slot, self._children)]
+
+    def ancestors(self, entity_id):
+        """Return (entity_id, depth) of the entities containing entity_id.
+
+        Like Driver.ancestors() the direct parents are at depth 1 and every
+        ancestor is listed once.
+        """
+
+        slot = self._slots.get(entity_id)
+        if slot is None:
+            return []
+        return [(self._ids[s], depth)
+                for s, depth in self._walk(slot, self._parents)]
+
+    def common_ancestors(self, *entity_ids):
+        """Return the ids of the entities containing all of entity_ids.
+
+        The nearest (by the largest of their depths) come first.
+        """
+
+        common = None
+        for entity_id in entity_ids:
+            depths = dict(self.ancestors(entity_id))
+            if common is None:
+                common = depths
+            else:
+                common = dict((a, max(depth, depths[a]))
+                              for a, depth in common.iteritems()
+                              if a in depths)
+
+        return [a for a, depth in sorted((common or {}).items(),
+                                         key=lambda (a, depth): (depth, a))]
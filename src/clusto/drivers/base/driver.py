@@ -5,14 +5,17 @@ A Driver provides an interface to an Entity and its Attributes.
 
 import re
 import logging
+import datetime
 
 import clusto
 from clusto.schema import Entity, Attribute
 from clusto.exceptions import DriverException, NameException
 from clusto.util import batch
+from clusto import containment
 
 from clusto.drivers.base.clustodriver import ClustoDriver, DRIVERLIST
-from sqlalchemy import and_, not_
+from sqlalchemy import and_, not_, select, cast
+from sqlalchemy.dialects.mysql import BINARY
 
 try:
     import simplejson as json
@@ -20,6 +23,56 @@ except:
     import json
 
 
+# escapes, extensions and POSIX classes whose meaning differs between python
+# and MySQL or PostgreSQL regular expressions
+_unportable_regexp = re.compile(r'\\[0-9A-Za-z]|\(\?|\[[:.=]')
+
+
+def _regexp(column, pattern):
+    """Return an SQL clause matching column against a python style regex.
+
+    Like re.match() the pattern is anchored at the start of the value.
+    Returns None if the backend has no regular expression operator, or the
+    pattern might match differently there than in python.
+    """
+
+    if not clusto.SESSION.clusto_sql_regexp:
+        return None
+
+    dialect = clusto.SESSION.bind.dialect.name
+    pattern = unicode(pattern)
+    if dialect == 'sqlite':
+        # clusto.connect() registers a re.match() based REGEXP function
+        return column.op('REGEXP')(pattern)
+    elif _unportable_regexp.search(pattern):
+        return None
+    elif dialect == 'mysql':
+        # BINARY makes the match case sensitive, like python's
+        return column.op('REGEXP BINARY')(u'^(%s)' % pattern)
+    elif dialect == 'postgresql':
+        return column.op('~')(u'^(%s)' % pattern)
+
+    return None
+
+
+def _equals(column, value):
+    """Return an SQL clause comparing a string column to value exactly.
+
+    MySQL compares strings by the column's collation, which by default
+    ignores case and trailing spaces.  There the plain comparison, which
+    can use the column's index, is narrowed down by a binary one.
+    """
+
+    clause = column == value
+    if clusto.SESSION.bind.dialect.name == 'mysql':
+        clause = and_(clause, cast(column, BINARY) == value)
+    return clause
+
+
+# (entity_id, depth) of the ancestors of entities, see Driver._ancestor_ids
+_ancestor_ids = clusto.cache.VersionedStore()
+
+
 class Driver(object):
     """Base Driver.
 
@@ -182,19 +235,49 @@ class Driver(object):
                                 "Attribute names may not contain periods or "
                                 "comas." % key)
 
+    def _property_values(self):
+        """Return the values of the property attributes of this entity.
+
+        All of them are read with one query on first use and kept on the
+        driver until any attribute of the entity changes.
+        """
+
+        entity_id = self.entity.entity_id
+        version = clusto.SESSION.clusto_version
+        cache = clusto.attr_cache()
+        stamp = None
+        if ((version is None or isinstance(version, (int, long)))
+            and cache.scope() is not None):
+            stamp = (version, cache.stamp(entity_id))
+
+        cached = self.__dict__.get('_property_cache')
+        if stamp is not None and cached and cached[0] == stamp:
+            return cached[1]
+
+        values = {}
+        for attr in Attribute.query().filter(and_(
+                Attribute.entity_id == entity_id,
+                Attribute.subkey == u'property')).order_by(Attribute.attr_id):
+            values.setdefault(attr.key, attr.value)
+
+        if stamp is not None:
+            self.__dict__['_property_cache'] = (stamp, values)
+        return values
+
     def __getattr__(self, name):
         if name in self._properties:
-            attr = self.attr_query(name, subkey='property')
-            if not attr:
+            values = self._property_values()
+            if name not in values:
                 return self._properties[name]
             else:
-                return attr[0].value
+                return values[name]
         else:
             raise AttributeError("Attribute %s does not exist." % name)
 
     def __setattr__(self, name, value):
 
         if name in self._properties:
+            self.__dict__.pop('_property_cache', None)
             self.set_attr(name, value, subkey='property')
         else:
             object.__setattr__(self, name, value)
@@ -423,67 +506,260 @@ class Driver(object):
 
         return list(result)
 
+    @classmethod
+    def attr_filter_criteria(cls, key=(), value=(), number=(),
+                             subkey=(), ignore_hidden=True,
+                             sort_by_keys=True,
+                             regex=False,
+                             clusto_types=None,
+                             clusto_drivers=None,
+                             ):
+        """Compile attr_filter() arguments into SQL criteria on Attribute.
+
+        Returns a list of criteria that select the same attributes
+        attr_filter() would keep, or None if the arguments can't be expressed
+        in SQL (regex on backends without REGEXP support, regex or
+        json/float values) and the attributes have to be filtered in memory.
+        """
+
+        criteria = []
+
+        for val, column in ((key, Attribute.key), (subkey, Attribute.subkey)):
+            if val is ():
+                continue
+            if regex:
+                clause = _regexp(column, val)
+                if clause is None:
+                    return None
+                criteria.append(clause)
+            else:
+                if isinstance(val, str):
+                    val = unicode(val)
+                if val is None:
+                    criteria.append(column == None)  # noqa
+                else:
+                    criteria.append(_equals(column, val))
+
+        if value is not ():
+            if regex or value is None:
+                return None
+            elif isinstance(value, (bool, int, long)):
+                criteria.extend([Attribute.datatype == 'int',
+                                 Attribute.int_value == value])
+            elif isinstance(value, basestring):
+                criteria.extend([Attribute.datatype == 'string',
+                                 _equals(Attribute.string_value,
+                                         unicode(value))])
+            elif isinstance(value, datetime.datetime):
+                criteria.extend([Attribute.datatype == 'datetime',
+                                 Attribute.datetime_value == value])
+            elif isinstance(value, (Driver, Entity)):
+                entity = value.entity if isinstance(value, Driver) else value
+                criteria.append(Attribute.relation_id == entity.entity_id)
+            else:
+                return None
+
+        if number is not ():
+            if isinstance(number, bool) or number is None:
+                if number:
+                    criteria.append(Attribute.number != None)  # noqa
+                else:
+                    criteria.append(Attribute.number == None)  # noqa
+            elif isinstance(number, (int, long)):
+                criteria.append(Attribute.number == number)
+            else:
+                raise TypeError("number must be either a boolean or an integer.")
+
+        if key and key.startswith('_'):
+            ignore_hidden = False
+
+        if ignore_hidden:
+            criteria.append(not_(Attribute.key.like(u'@_%', escape=u'@')))
+
+        for names, column, get_name in ((clusto_drivers, Entity.driver, clusto.get_driver_name),
+                                        (clusto_types, Entity.type, clusto.get_type_name)):
+            if not names:
+                continue
+            related = select([Entity.entity_id],
+                             and_(column.in_([get_name(n) for n in names]),
+                                  *Entity._version_args()))
+            criteria.extend([Attribute.datatype == 'relation',
+                             Attribute.relation_id.in_(related)])
+
+        return criteria
+
+    @staticmethod
+    def _attr_query_key(args, kwargs):
+        """Return a hashable key for a set of attrs() arguments or None."""
+
+        def hashable(val):
+            if isinstance(val, Driver):
+                return ('entity', val.entity.entity_id)
+            elif isinstance(val, Entity):
+                return ('entity', val.entity_id)
+            elif isinstance(val, (list, tuple)) and val != ():
+                return tuple(hashable(v) for v in val)
+            return val
+
+        try:
+            query_key = (tuple(hashable(a) for a in args),
+                         tuple(sorted((k, hashable(v)) for k, v in kwargs.items())))
+            hash(query_key)
+        except TypeError:
+            return None
+
+        return query_key
+
+    def _filtered_attrs(self, args, kwargs):
+        """Return the attributes of this entity matching attr_filter() args.
+
+        Attributes attached by clusto.prefetch_attrs() or a full attribute
+        list in the session cache are filtered in memory.  Otherwise the
+        filter is compiled into the SQL query (see attr_filter_criteria) and
+        its result is cached for the session.
+        """
+
+        bound = dict(zip(('key', 'value', 'number', 'subkey', 'ignore_hidden',
+                          'sort_by_keys', 'regex'), args))
+        bound.update(kwargs)
+        key = bound.get('key', ())
+        subkey = bound.get('subkey', ())
+        regex = bound.get('regex', False)
+
+        prefetched = self.__dict__.get('_prefetched_attrs')
+        cache = clusto.attr_cache()
+        entity_id = self.entity.entity_id
+
+        if prefetched:
+            keys, subkeys, attrs, stamp = prefetched
+
+            if stamp != cache.stamp(entity_id):
+                del self._prefetched_attrs
+            elif ((not keys or (not regex and key in keys))
+                  and (not subkeys or (not regex and subkey in subkeys))):
+                return self.attr_filter(attrs, *args, **kwargs)
+
+        if entity_id in cache:
+            return self.attr_filter(cache.get(entity_id), *args, **kwargs)
+
+        narrowed = (any(bound.get(n, ()) is not ()
+                        for n in ('key', 'value', 'number', 'subkey'))
+                    or bound.get('clusto_types') or bound.get('clusto_drivers'))
+        criteria = None
+        if narrowed:
+            criteria = self.attr_filter_criteria(*args, **kwargs)
+
+        if criteria is None:
+            # read (and cache) the whole list and filter that
+            return self.attr_filter(self.entity.attrs, *args, **kwargs)
+
+        query_key = self._attr_query_key(args, kwargs)
+        attrs = None
+        if query_key is not None:
+            attrs = cache.get(entity_id, query_key)
+
+        if attrs is None:
+            attrs = Attribute.query().filter(
+                Attribute.entity_id == entity_id).filter(
+                and_(*criteria)).order_by(Attribute.attr_id).all()
+            if query_key is not None:
+                cache.set(entity_id, attrs, query_key)
+
+        if bound.get('sort_by_keys', True):
+            attrs = sorted(attrs)
+
+        return attrs
+
     def _itemize_attrs(self, attrlist):
         return [(x.keytuple, x.value) for x in attrlist]
 
     def attrs(self, *args, **kwargs):
         """Return attributes for this entity.
 
-        (filters whole attribute list as opposed to querying the db directly)
+        Accepts the same filter arguments as attr_filter().  The filter is
+        run against a cached or prefetched attribute list when there is one,
+        and pushed into the database query otherwise.
         """
 
         merge_container_attrs = kwargs.pop('merge_container_attrs', False)
-        ignore_memcache = kwargs.pop('ignore_memcache', False)
-
-        if clusto.SESSION.memcache and not ignore_memcache:
-            logging.debug('Pulling info from memcache when possible for %s' % self.name)
-            k = None
-            if 'key' in kwargs:
-                k = kwargs['key']
-            else:
-                if len(args) > 1:
-                    k = args[0]
-            if k:
-#               This is hackish, need to find another way to know if we should cache things or not
-                if not k.startswith('_'):
-                    if 'subkey' in kwargs and kwargs['subkey'] is not None:
-                        memcache_key = str('%s.%s.%s' % (self.name, k, kwargs['subkey']))
-                    else:
-                        memcache_key = str('%s.%s' % (self.name, k))
-                    logging.debug('memcache key: %s' % memcache_key)
-                    attrs = clusto.SESSION.memcache.get(memcache_key)
-                    if not attrs:
-                        attrs = self.attr_filter(self.entity.attrs, *args, **kwargs)
-                        if attrs:
-                            clusto.SESSION.memcache.set(memcache_key, attrs)
-                else:
-                    attrs = self.attr_filter(self.entity.attrs, *args, **kwargs)
-            else:
-                logging.debug('We cannot cache attrs without a key at least')
-                attrs = self.attr_filter(self.entity.attrs, *args, **kwargs)
-        else:
-            attrs = self.attr_filter(self.entity.attrs, *args, **kwargs)
+        kwargs.pop('ignore_memcache', None)
 
         if merge_container_attrs:
-            kwargs['merge_container_attrs'] = merge_container_attrs
-            kwargs['ignore_memcache'] = ignore_memcache
-            parent_entity_ids = [parent.entity.entity_id for parent in self.parents()]
-            while parent_entity_ids:
-                parent_attrs = Attribute.query().filter(
-                    Attribute.entity_id.in_(parent_entity_ids)).all()
-                attrs.extend(parent_attrs)
-                grandparent_contains_attributes = Attribute.query().filter(
-                    Attribute.relation_id.in_(parent_entity_ids)).filter(
-                    Attribute.key == '_contains').all()
-                parent_entity_ids = [a.entity_id for a in grandparent_contains_attributes]
-            kwargs.pop('merge_container_attrs')
-            kwargs.pop('ignore_memcache')
-            attrs = self.attr_filter(attrs, *args, **kwargs)
+            return self.effective_attrs(*args, **kwargs)
+
+        return self._filtered_attrs(args, kwargs)
+
+    def _ancestor_ids(self):
+        """Return (entity_id, depth) of the ancestors of this entity.
+
+        The list is kept until the clusto version changes.
+        """
+
+        entity_id = self.entity.entity_id
+        found = _ancestor_ids.get(entity_id)
+        if found is None:
+            found = containment.walk([entity_id], up=True)
+            _ancestor_ids.set(entity_id, found)
+
+        return found
+
+    def effective_attrs(self, *args, **kwargs):
+        """Return the attributes of this entity and of its ancestors.
+
+        Accepts the same filter arguments as attr_filter().  The attributes
+        are ordered by inheritance depth, the entity's own first, then its
+        parents', its grandparents' and so on, so the first of a key is the
+        one that applies.  With sort_by_keys (the default) they're sorted
+        by key keeping that order.
+
+        Only the matching attributes of the whole ancestor chain are read,
+        with one query.
+        """
+
+        depths = dict(self._ancestor_ids())
+        depths[self.entity.entity_id] = 0
+
+        bound = dict(zip(('key', 'value', 'number', 'subkey', 'ignore_hidden',
+                          'sort_by_keys', 'regex'), args))
+        bound.update(kwargs)
+
+        criteria = self.attr_filter_criteria(*args, **kwargs)
+        attrs = []
+        for ids in batch(depths.keys(), 500):
+            query = Attribute.query().filter(Attribute.entity_id.in_(list(ids)))
+            if criteria:
+                query = query.filter(and_(*criteria))
+            attrs.extend(query)
+
+        attrs.sort(key=lambda a: (depths[a.entity_id], a.attr_id))
+
+        if criteria is None:
+            return self.attr_filter(attrs, *args, **kwargs)
+
+        if bound.get('sort_by_keys', True):
+            attrs = sorted(attrs)
+
         return attrs
 
+    def attr_records(self, *args, **kwargs):
+        """Return read-only records of the attributes of this entity.
+
+        Accepts the same filter arguments as attr_filter().  The records are
+        read without the ORM (see clusto.attr_records) which makes this the
+        cheaper choice for code that only displays attributes.
+        """
+
+        entity_id = self.entity.entity_id
+        return clusto.attr_records([entity_id], *args, **kwargs)[entity_id]
+
     def attr_values(self, *args, **kwargs):
         """Return the values of the attributes that match the given arguments"""
 
+        if clusto.cache.usable() and not kwargs.get('merge_container_attrs'):
+            kwargs.pop('merge_container_attrs', None)
+            kwargs.pop('ignore_memcache', None)
+            return [k.value for k in self.attr_records(*args, **kwargs)]
+
         return [k.value for k in self.attrs(*args, **kwargs)]
 
     def attr_value(self, *args, **kwargs):
@@ -591,6 +867,15 @@ class Driver(object):
         numbering by default.
         """
 
+        key, value, number, subkey = self._attr_row(key, value, number, subkey)
+
+        self.expire(key=key)
+        return self.entity.add_attr(key, value, subkey=subkey, number=number)
+
+    def _attr_row(self, key, value=(), number=(), subkey=()):
+        """Validate add_attr() arguments and return a (key, value, number,
+        subkey) tuple for Attribute.insert_many()."""
+
         if isinstance(key, Attribute):
             raise Exception("Unsupported Operation.  You can no longer add an attribute directly")
 
@@ -606,8 +891,116 @@ class Driver(object):
         if subkey is ():
             subkey = None
 
-        self.expire(key=key)
-        return self.entity.add_attr(key, value, subkey=subkey, number=number)
+        return (key, value, number, subkey)
+
+    def _write_attrs(self, rows, deletes=()):
+        """Delete and insert the given attributes in one transaction.
+
+        Rows numbered True get consecutive numbers from the key's counter.
+        """
+
+        try:
+            clusto.begin_transaction()
+
+            Attribute.delete_many(list(deletes))
+
+            auto_numbered = {}
+            for row in rows:
+                if row[2] is True:
+                    auto_numbered[row[0]] = auto_numbered.get(row[0], 0) + 1
+
+            numbers = {}
+            for key, count in auto_numbered.items():
+                # the counter holds the last number used
+                numbers[key] = iter([n + 1 for n in
+                                     clusto.Counter.take(self.entity, key,
+                                                         count, default=-1)])
+
+            inserts = []
+            for key, value, number, subkey in rows:
+                if number is True:
+                    number = numbers[key].next()
+                elif isinstance(number, clusto.Counter):
+                    number = number.next()
+                inserts.append((key, value, number, subkey))
+
+            Attribute.insert_many(self.entity, inserts)
+
+            clusto.commit()
+        except Exception, x:
+            clusto.rollback_transaction()
+            raise x
+
+        for key in set(row[0] for row in rows) | set(a.key for a in deletes):
+            self.expire(key=key)
+
+    def add_attrs(self, attrs):
+        """Add several attributes at once.
+
+        attrs is a list of dicts of add_attr() keyword arguments or of tuples
+        in add_attr() argument order.  All the names are validated before
+        anything is written, and the attributes are inserted with a single
+        executemany inside one transaction.
+        """
+
+        rows = []
+        for attr in attrs:
+            if isinstance(attr, dict):
+                rows.append(self._attr_row(**attr))
+            else:
+                rows.append(self._attr_row(*attr))
+
+        self._write_attrs(rows)
+
+    def set_attrs(self, attrs, replace_keys=()):
+        """Set several attributes at once, like set_attr() does for one.
+
+        attrs maps attribute keys to values.  A key is either a plain
+        attribute key or a (key, subkey) or (key, number, subkey) tuple, the
+        number defaulting to False (no number) as with set_attr().
+
+        Attributes that already hold the given value are left alone; the
+        others are deleted and re-added.  Any other attribute whose key is
+        listed in replace_keys is deleted as well.  Everything is checked
+        before anything is written, and written with one delete statement
+        and one executemany inside one transaction.
+        """
+
+        current = self.entity.attrs
+        keep = set()
+        deletes = []
+        rows = []
+
+        for spec, value in attrs.items():
+            if isinstance(spec, basestring):
+                key, number, subkey = spec, False, None
+            elif len(spec) == 2:
+                (key, subkey), number = spec, False
+            else:
+                key, number, subkey = spec
+
+            row = self._attr_row(key, value, number, subkey)
+
+            matches = self.attr_filter(current, key=key, number=number,
+                                       subkey=subkey, ignore_hidden=False)
+            if len(matches) > 1:
+                raise DriverException("cannot set an attribute when args match more than one value")
+
+            if matches and matches[0].value == value:
+                keep.add(matches[0].attr_id)
+                continue
+
+            deletes.extend(matches)
+            rows.append(row)
+
+        deleted = set(a.attr_id for a in deletes)
+        for attr in current:
+            if (attr.key in replace_keys and attr.attr_id not in keep
+                and attr.attr_id not in deleted):
+                deletes.append(attr)
+
+        if rows or deletes:
+            self._write_attrs(rows, deletes)
 
     def del_attrs(self, *args, **kwargs):
         "delete attribute with the given key and value optionally value also"
@@ -643,31 +1036,13 @@ class Driver(object):
         return attr
 
     def expire(self, *args, **kwargs):
-        """Expires the memcache value (if using memcache) of this object"""
-
-        key = None
-        if 'key' in kwargs:
-            key = kwargs['key']
-        subkey = None
-        if 'subkey' in kwargs:
-            subkey = kwargs['subkey']
-        if clusto.SESSION.memcache:
-            attrs = self.attrs(key=key, subkey=subkey)
-            memcache_keys = []
-            for attr in attrs:
-                mk = self.name
-                mk += '.%s' % attr.key
-                if subkey is None:
-                    memcache_keys.append(str(mk))
-                if attr.subkey:
-                    mk += '.%s' % attr.subkey
-                memcache_keys.append(str(mk))
-            memcache_keys = set(memcache_keys)
-            for mk in memcache_keys:
-                logging.debug('Expiring %s' % mk)
-                clusto.SESSION.memcache.delete(mk)
-        else:
-            logging.debug('Not using memcache, not expiring anything.')
+        """Drop this entity's attributes from the shared clusto.cache
+
+        Writes do this on commit already.  Doesn't read anything, the
+        arguments are accepted for compatibility and ignored.
+        """
+
+        clusto.cache.expire('attrs', [self.entity.entity_id])
 
     def has_attr(self, *args, **kwargs):
         """return True if this list has an attribute with the given key"""
@@ -754,6 +1129,11 @@ class Driver(object):
         >>> A.contents()
         [B, C]
 
+        With search_children=True the contents of the contents are included
+        too, each Entity once, nearest first.  Filtering by clusto_types and
+        clusto_drivers applies to the returned Entities, not to the ones the
+        search passes through.
+
         """
 
         if 'search_children' in kwargs:
@@ -761,9 +1141,16 @@ class Driver(object):
         else:
             search_children = False
 
+        if (search_children and not args
+            and not set(kwargs) - set(['clusto_types', 'clusto_drivers'])):
+            found = containment.walk([self.entity.entity_id], **kwargs)
+            return containment.load_drivers([entity_id
+                                             for entity_id, depth in found])
+
         contents = self._get_contents(*args, **kwargs)
 
         if search_children:
+            # other attribute filters are applied one level at a time
             # We want to prune our search so that children that do not have children do not need to
             # be searched. To do so, we query for children that have a _contains attribute, and only
             # call .contents() on those children.
@@ -789,23 +1176,45 @@ class Driver(object):
         return contents
 
     def parents(self, **kwargs):
-        """Return a list of Things that contain _this_ Thing. """
+        """Return a list of Things that contain _this_ Thing.
+
+        With search_parents=True all the ancestors are returned, see
+        ancestors().
+        """
 
         search_parents = kwargs.pop('search_parents', False)
 
         if search_parents:
-            parents = self.parents(**kwargs)
-            allparents = self.parents()
-            for thing in allparents:
-                allparents.extend(thing.parents())
-
-            for thing in allparents:
-                parents.extend(thing.parents(**kwargs))
+            parents = [d for d, depth in self.ancestors(**kwargs)]
         else:
             parents = self.referencers('_contains', **kwargs)
 
         return parents
 
+    def ancestors(self, clusto_types=None, clusto_drivers=None,
+                  through_types=None, max_depth=None):
+        """Return the Things containing this Thing, directly or not.
+
+        Returns a list of (driver, depth) tuples, nearest first, where the
+        direct parents are at depth 1.  Every ancestor is listed once, even
+        if it's reachable along several paths or around a cycle.
+
+        clusto_types and clusto_drivers filter the returned ancestors.  The
+        search continues past ancestors of any type unless through_types is
+        given, and stops after max_depth levels.
+        """
+
+        found = containment.walk([self.entity.entity_id], up=True,
+                             clusto_types=clusto_types,
+                             clusto_drivers=clusto_drivers,
+                             through_types=through_types,
+                             max_depth=max_depth)
+        depths = dict(found)
+
+        return [(d, depths[d.entity.entity_id])
+                for d in containment.load_drivers([entity_id
+                                                   for entity_id, depth in found])]
+
     def siblings(self, parent_filter=None, parent_kwargs=None,
                  additional_pools=None, **kwargs):
         """Return a list of Things that have the same parents as me.
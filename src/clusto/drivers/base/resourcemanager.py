@@ -1,8 +1,13 @@
 
 import clusto
-from clusto.schema import Counter
+from clusto.schema import Counter, Attribute, Entity, SESSION, and_, func
+from clusto.schema import ENTITY_TABLE, ALLOCATION_LOCK_TABLE, select
 from clusto.drivers.base import Driver, ClustoMeta
+from clusto.drivers.base.clustodriver import DRIVERLIST
 from clusto.exceptions import ResourceException
+from clusto.util import batch
+
+from sqlalchemy.orm import aliased
 
 
 
@@ -46,6 +51,20 @@ class ResourceManager(Driver):
                              % self.name)
 
 
+    def allocator_many(self, things):
+        """return an unused resource for each of the given things.
+
+        The default calls allocator() for each.  None of the picks are
+        recorded in between, so allocators choosing from what's recorded
+        would pick the same resource each time; allocate_many() records
+        each allocator() pick before the next instead, unless a manager
+        that can pick several distinct resources at once (e.g. from one
+        counter reservation) overrides this.
+        """
+
+        return [self.allocator(thing) for thing in things]
+
+
     def ensure_type(self, resource, number=True, thing=None):
         """checks the type of a given resourece
 
@@ -114,8 +133,19 @@ class ResourceManager(Driver):
         thing.del_attrs(self._attr_name, number=number, subkey=key, value=value)
 
 
+    def additional_attr_values(self, thing, resource, number):
+        """return (subkey, value) pairs of the attributes that are added to
+        a thing along with a resource."""
+
+        return []
+
+
     def additional_attrs(self, thing, resource, number):
-        pass
+
+        for subkey, value in self.additional_attr_values(thing, resource,
+                                                         number):
+            thing.add_attr(self._attr_name, value, number=number,
+                           subkey=subkey)
 
 
     def post_automatic_allocation(self, thing, resource, number):
@@ -126,6 +156,36 @@ class ResourceManager(Driver):
         pass
 
     
+    def lock(self):
+        """Lock this resource manager until the current transaction ends.
+
+        Other transactions locking it wait for this one to commit or roll
+        back, so the resource picked and recorded in between can't be
+        picked by them too.  allocate() does this with allocation_locking
+        set in the config.
+
+        The manager's entity row is selected FOR UPDATE where the database
+        supports it, elsewhere the manager's row in the allocation_locks
+        table is written.  With MySQL's default REPEATABLE READ isolation
+        the lock has to be taken before the transaction's first read, or
+        that read's snapshot hides allocations committed while waiting.
+        """
+
+        clusto.flush()
+        entity_id = self.entity.entity_id
+        if SESSION.clusto_for_update:
+            e = ENTITY_TABLE
+            SESSION.execute(select([e.c.entity_id], e.c.entity_id == entity_id,
+                                   for_update=True))
+            return
+
+        t = ALLOCATION_LOCK_TABLE
+        result = SESSION.execute(t.update().where(t.c.entity_id == entity_id)
+                                 .values(holds=t.c.holds + 1))
+        if not result.rowcount:
+            SESSION.execute(t.insert().values(entity_id=entity_id, holds=1))
+        SESSION.flushed.add(t)
+
     def allocate(self, thing, resource=(), number=True, force=False):
         """allocates a resource element to the given thing.
 
@@ -144,6 +204,9 @@ class ResourceManager(Driver):
             if not isinstance(thing, Driver):
                 raise TypeError("thing is not of type Driver")
 
+            if SESSION.clusto_allocation_locking:
+                self.lock()
+
             if resource is ():
                 # allocate a new resource
                 resource, number = self.allocator(thing)
@@ -156,12 +219,11 @@ class ResourceManager(Driver):
 
             if self._record_allocations:
                 if number == True:
-                    c = Counter.get(ClustoMeta().entity, self._attr_name)
                     attr = thing.add_attr(self._attr_name,
                                           resource,
-                                          number=c.value
+                                          number=Counter.take(ClustoMeta().entity,
+                                                              self._attr_name)[0]
                                           )
-                    c.next()
                 else:
                     attr = thing.add_attr(self._attr_name, resource, number=number)
                     
@@ -191,6 +253,202 @@ class ResourceManager(Driver):
         return attr #resource
 
 
+    def allocate_many(self, things, resources=None, force=False):
+        """allocates a resource to each of the given things in one
+        transaction.
+
+        resources - a list of resources for the things, in the same order.
+                    Without it new resources are picked with
+                    allocator_many() if the manager overrides it, or
+                    recorded one by one as allocator() picks them.
+
+        The resources are numbered with one counter reservation and all the
+        resource, manager and additional attributes are written with one
+        executemany (see Attribute.insert_rows()).  The allocation hooks
+        run after the commit, for each thing.
+
+        returns the resource attributes in the order of things.
+        """
+
+        things = list(things)
+        for thing in things:
+            if not isinstance(thing, Driver):
+                raise TypeError("thing is not of type Driver")
+        if not things:
+            return []
+
+        if resources is not None and len(resources) != len(things):
+            raise ResourceException("Got %d resources for %d things."
+                                    % (len(resources), len(things)))
+
+        try:
+            clusto.begin_transaction()
+
+            if SESSION.clusto_allocation_locking:
+                self.lock()
+
+            if resources is None:
+                auto_allocated = True
+                if (self.allocator_many.im_func is
+                    ResourceManager.allocator_many.im_func):
+                    # allocator() only avoids the allocations recorded so
+                    # far, so each is recorded before the next is picked
+                    picked = []
+                    attrs = []
+                    for thing in things:
+                        picked.append(self.allocator(thing))
+                        attrs.extend(self._record_many([thing], picked[-1:]))
+                else:
+                    picked = self.allocator_many(things)
+                    attrs = None
+            else:
+                auto_allocated = False
+                picked = [self.ensure_type(resource, True, thing)
+                          for thing, resource in zip(things, resources)]
+                if not force:
+                    for resource, number in picked:
+                        if not self.available(resource, number):
+                            raise ResourceException("Requested resource %s is not available." % resource)
+                attrs = None
+
+            if len(set(r for r, n in picked)) != len(picked):
+                raise ResourceException("Resources for %s are not unique."
+                                        % self.name)
+
+            if attrs is None:
+                attrs = self._record_many(things, picked)
+
+            clusto.commit()
+        except Exception, x:
+            clusto.rollback_transaction()
+            raise
+
+        for thing, (resource, number) in zip(things, picked):
+            thing.expire()
+            if auto_allocated:
+                self.post_automatic_allocation(thing, resource, number)
+            self.post_allocation(thing, resource, number)
+
+        return attrs
+
+
+    def _record_many(self, things, picked):
+        """add the attributes of the picked (resource, number) of each of
+        things, returns the resource attributes (all None if this manager
+        doesn't record allocations)."""
+
+        if not self._record_allocations:
+            return [None] * len(things)
+
+        numbers = iter(Counter.take(ClustoMeta().entity,
+                                    self._attr_name,
+                                    len([n for r, n in picked
+                                         if n == True])))
+        numbered = [(resource, numbers.next() if number == True
+                     else number)
+                    for resource, number in picked]
+
+        # managers overriding additional_attrs() add theirs one by one
+        custom = (self.additional_attrs.im_func is not
+                  ResourceManager.additional_attrs.im_func)
+
+        rows = []
+        for thing, (resource, number) in zip(things, numbered):
+            rows.append((thing.entity, self._attr_name, resource,
+                         number, None))
+            rows.append((thing.entity, self._attr_name, self.entity,
+                         number, 'manager'))
+            if not custom:
+                rows.extend((thing.entity, self._attr_name, value,
+                             number, subkey)
+                            for subkey, value in
+                            self.additional_attr_values(thing, resource,
+                                                        number))
+        Attribute.insert_rows(rows)
+
+        if custom:
+            for thing, (resource, number) in zip(things, numbered):
+                self.additional_attrs(thing, resource, number)
+
+        return self._resource_attrs_by_number(things,
+                                              [n for r, n in numbered])
+
+
+    def _resource_attrs_by_number(self, things, numbers):
+        """return the resource attribute numbered numbers[i] of things[i],
+        for each thing, read with one query (per 500)."""
+
+        wanted = [(thing.entity.entity_id, number)
+                  for thing, number in zip(things, numbers)]
+
+        found = {}
+        for chunk in batch(wanted, 500):
+            chunk = list(chunk)
+            query = Attribute.query().filter(and_(
+                Attribute.entity_id.in_(list(set(e for e, n in chunk))),
+                Attribute.key == unicode(self._attr_name),
+                Attribute.number.in_([n for e, n in chunk]),
+                Attribute.subkey == None))
+            for attr in query:
+                found[(attr.entity_id, attr.number)] = attr
+
+        return [found.get(key) for key in wanted]
+
+
+    def deallocate_many(self, things, resources=None):
+        """deallocates the resources of this manager from the given things
+        in one transaction.
+
+        resources - a list of resources to deallocate, one per thing (in the
+                    same order).  Without it all the things' resources from
+                    this manager are deallocated.
+
+        The resources are found with one query and all their attributes
+        are deleted together (see Attribute.delete_many()).
+        """
+
+        things = list(things)
+        if resources is not None:
+            if len(resources) != len(things):
+                raise ResourceException("Got %d resources for %d things."
+                                        % (len(resources), len(things)))
+            wanted = set((thing.entity.entity_id,
+                          self.ensure_type(resource, thing=thing)[0])
+                         for thing, resource in zip(things, resources))
+
+        numbers = set()
+        for res, manager in self.resource_attrs(things):
+            if manager != self.entity:
+                continue
+            if resources is None or (res.entity_id, res.value) in wanted:
+                numbers.add((res.entity_id, res.number))
+
+        if not numbers:
+            return
+
+        try:
+            clusto.begin_transaction()
+
+            attrs = []
+            for chunk in batch(sorted(numbers), 500):
+                chunk = list(chunk)
+                query = Attribute.query().filter(and_(
+                    Attribute.entity_id.in_(list(set(e for e, n in chunk))),
+                    Attribute.key == unicode(self._attr_name),
+                    Attribute.number.in_(list(set(n for e, n in chunk)))))
+                attrs.extend(attr for attr in query
+                             if (attr.entity_id, attr.number) in numbers)
+            Attribute.delete_many(attrs)
+
+            clusto.commit()
+        except Exception, x:
+            clusto.rollback_transaction()
+            raise
+
+        for thing in things:
+            thing.expire()
+
+
     def deallocate(self, thing, resource=(), number=True):
         """deallocates a resource from the given thing."""
 
@@ -198,9 +456,8 @@ class ResourceManager(Driver):
         clusto.begin_transaction()
         try:
             if resource is ():                      
-                for res in self.resources(thing):
-                    res_mgr = self.get_resource_manager(res)
-                    if res_mgr != self:
+                for res, manager in self.resource_attrs([thing]):
+                    if manager != self.entity:
                         continue
                     thing.del_attrs(self._attr_name, number=res.number)
 
@@ -247,12 +504,57 @@ class ResourceManager(Driver):
     def get_resource_manager(cls, resource_attr):
         """Return the resource manager for a given resource_attr"""
 
-        thing = Driver(resource_attr.entity)
-        
-        return thing.attr_value(key=resource_attr.key,
-                                subkey='manager',
-                                number=resource_attr.number)
-        
+        manager = aliased(Attribute)
+        entity = Entity.query().filter(and_(
+            Entity.entity_id == manager.relation_id,
+            manager.entity_id == resource_attr.entity_id,
+            manager.key == resource_attr.key,
+            manager.subkey == u'manager',
+            manager.number == resource_attr.number,
+            *Attribute._version_args(manager))).first()
+
+        return entity and Driver(entity)
+
+    @classmethod
+    def resource_attrs(cls, things):
+        """Return (resource attribute, manager Entity) pairs for the
+        resources the given things have from resource managers of this class
+        (or its subclasses).
+
+        A resource is a resource attribute in a resource manager.  The
+        resources of all the things are read with one joined query (per 500
+        things), ordered by thing and number.
+        """
+
+        ids = [Driver.ensure_driver(thing).entity.entity_id for thing in things]
+        if not ids:
+            return []
+
+        drivers = [name for name, driver in DRIVERLIST.items()
+                   if issubclass(driver, cls)]
+
+        manager = aliased(Attribute)
+        criteria = [manager.key == unicode(cls._attr_name),
+                    manager.subkey == u'manager',
+                    Attribute.entity_id == manager.entity_id,
+                    Attribute.key == manager.key,
+                    Attribute.number == manager.number,
+                    Attribute.subkey == None,
+                    Entity.entity_id == manager.relation_id,
+                    Entity.driver.in_(drivers)]
+        criteria.extend(Attribute._version_args(manager))
+        criteria.extend(Attribute._version_args())
+        criteria.extend(Entity._version_args())
+
+        clusto.flush()
+        found = []
+        for chunk in batch(ids, 500):
+            query = SESSION.query(Attribute, Entity).filter(and_(
+                manager.entity_id.in_(list(chunk)), *criteria))
+            found.extend(query.order_by(Attribute.entity_id, Attribute.number,
+                                        Attribute.attr_id))
+
+        return found
 
     @classmethod
     def resources(cls, thing):
@@ -261,23 +563,45 @@ class ResourceManager(Driver):
 
         A resource is a resource attribute in a resource manager.
         """
-        
-        attrs = [x for x in thing.attrs(cls._attr_name, subkey='manager') 
-                 if isinstance(Driver(x.value), cls)]
-
-        res = []
 
-        for attr in attrs:
-            t=thing.attrs(cls._attr_name, number=attr.number, subkey=None)
-            res.extend(t)
+        return [attr for attr, manager in cls.resource_attrs([thing])]
 
 
-        return res
+    @classmethod
+    def _stats_by_id(cls, entity_ids):
+        """Return {entity_id: stats()} for the resource managers with the
+        given entity_ids, counted with one grouped query (per 500)."""
+
+        stats = dict((i, {'count': 0, 'things': 0}) for i in entity_ids)
+
+        clusto.flush()
+        for chunk in batch(list(entity_ids), 500):
+            query = SESSION.query(Attribute.relation_id,
+                                  func.count(Attribute.attr_id),
+                                  func.count(Attribute.entity_id.distinct())
+                                  ).filter(and_(
+                Attribute.relation_id.in_(list(chunk)),
+                Attribute.key == unicode(cls._attr_name),
+                Attribute.subkey == u'manager',
+                *Attribute._version_args())).group_by(Attribute.relation_id)
+            for entity_id, count, things in query:
+                stats[entity_id] = {'count': count, 'things': things}
+
+        return stats
+
+    def stats(self):
+        """Return a dict of the number of resources allocated from this
+        manager (count) and of the things holding them (things).
+
+        Both are counted in the database.
+        """
 
+        entity_id = self.entity.entity_id
+        return self._stats_by_id([entity_id])[entity_id]
 
     @property
     def count(self):
         """Return the number of resources used."""
 
-        return len(self.references(self._attr_name, self, subkey='manager'))
+        return self.stats()['count']
 
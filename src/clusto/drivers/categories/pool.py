@@ -52,18 +52,18 @@ class Pool(Driver):
 
     @classmethod
     def get_pools(cls, obj, allPools=True):
+        """Return the Pools obj is in, nearest first.
 
-        d = cls.ensure_driver(obj, "obj must be either an Entity or a Driver.")
-
+        With allPools the Pools those Pools are in are included too, each
+        Pool once.
+        """
 
-        pools = [Driver(a.entity) for a in d.parents()
-                 if isinstance(Driver(a.entity), Pool)]
+        d = cls.ensure_driver(obj, "obj must be either an Entity or a Driver.")
 
-        if allPools:
-            for i in pools:
-                pools.extend(Pool.get_pools(i, allPools=True))
+        ancestors = d.ancestors(clusto_types=[Pool], through_types=[Pool],
+                                max_depth=None if allPools else 1)
 
-        return pools
+        return [p for p, depth in ancestors if isinstance(p, Pool)]
 
 class ExclusivePool(Pool):
     _driver_name = "exclusive_pool"
@@ -81,7 +81,7 @@ class ExclusivePool(Pool):
         it is in NO other pools.
         """
 
-        pools = Pool.get_pools(thing)
+        pools = Pool.get_pools(thing, allPools=False)
         if pools:
             raise PoolException("%s is already in pools %s, cannot insert "
                                 "exclusively." % (thing, pools))
@@ -103,7 +103,12 @@ class UniquePool(Pool):
         A given entity can only be in ONE UniquePool.
         """
 
-        pools = thing.parents(clusto_drivers=[self._driver_name])
+        d = self.ensure_driver(thing,
+                               "Can only insert an Entity or a Driver. "
+                               "Tried to insert %s." % str(type(thing)))
+
+        pools = [p for p, depth in d.ancestors(clusto_drivers=[type(self)],
+                                               max_depth=1)]
         if pools:
             raise PoolException("%s is already in UniquePool(s) %s." %
                                 (thing, pools))
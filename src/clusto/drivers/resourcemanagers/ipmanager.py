@@ -1,11 +1,67 @@
 import clusto
-from clusto.schema import Attribute
+import clusto.cache
+from clusto.schema import Attribute, Entity, SESSION, and_
 
 from clusto.drivers.base import ResourceManager, Driver
 from clusto.exceptions import ResourceNotAvailableException, ResourceTypeException, ResourceException
 
+import bisect
+import itertools
+
 import IPy
 
+
+# SubnetIndex of the ip managers of each driver, see IPManager.subnet_index
+_subnet_indexes = clusto.cache.VersionedStore(size=100)
+
+
+class SubnetIndex(object):
+    """The ranges of a set of ip managers, for finding the ones containing
+    an ip without queries.
+
+    Ranges are (first, last) integers as used by IPManager.  IP ranges are
+    either nested or disjoint, so sorted by start (widest first) every
+    range's enclosing ranges are found by following each range's nearest
+    enclosing one.  A lookup is a binary search followed by that chain.
+    """
+
+    def __init__(self, ranges):
+        """ranges is a list of (first, last, entity_id)."""
+
+        self.ranges = sorted(ranges, key=lambda (first, last, entity_id):
+                             (first, -last, entity_id))
+        self.starts = [r[0] for r in self.ranges]
+        self.enclosing = []
+
+        open_ranges = []
+        for i, (first, last, entity_id) in enumerate(self.ranges):
+            while open_ranges and self.ranges[open_ranges[-1]][1] < first:
+                open_ranges.pop()
+            self.enclosing.append(open_ranges[-1] if open_ranges else None)
+            open_ranges.append(i)
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def find(self, first, last=None):
+        """Return the entity_ids of the ranges containing first to last,
+        narrowest first."""
+
+        if last is None:
+            last = first
+
+        found = []
+        i = bisect.bisect_right(self.starts, first) - 1
+        while i is not None and i >= 0:
+            if self.ranges[i][1] >= last:
+                found.append(self.ranges[i])
+            i = self.enclosing[i]
+
+        return [entity_id for first, last, entity_id in
+                sorted(found, key=lambda (first, last, entity_id):
+                       (last - first, entity_id))]
+
+
 class IPManager(ResourceManager):
     """Resource Manager for IP spaces
     
@@ -38,21 +94,26 @@ class IPManager(ResourceManager):
         net = ip.make_net(netmask)
         return '%s/%i' % (ip.strNormal(), net.prefixlen())
 
+    @classmethod
+    def _make_ipy(cls, baseip, netmask):
+        return IPy.IP(''.join([u'%s' % str(baseip), '/',
+                               u'%s' % netmask]), make_net=True)
+
     @property
     def ipy(self):
-        if not hasattr(self, '__ipy'):
+        # kept along with the properties it was made from, they can change
+        key = (self.baseip, self.netmask)
+        cached = self.__dict__.get('_ipy')
+        if cached is None or cached[0] != key:
+            self._ipy = cached = (key, self._make_ipy(*key))
 
-            self.__ipy = IPy.IP(''.join([u'%s' % str(self.baseip), '/', 
-                                u'%s' % self.netmask]), make_net=True)
-
-
-        return self.__ipy
+        return cached[1]
 
     def ensure_type(self, resource, number=True, thing=None):
         """check that the given ip falls within the range managed by this manager"""
 
         try:
-            if isinstance(resource, int):
+            if isinstance(resource, (int, long)):
                 ip = self._int_to_ipy(resource)
             else:
                 ip = IPy.IP(resource)
@@ -68,62 +129,275 @@ class IPManager(ResourceManager):
         return (self._ipy_to_int(ip), number)
 
 
-    def additional_attrs(self, thing, resource, number):
+    def additional_attr_values(self, thing, resource, number):
 
         resource, number = self.ensure_type(resource, number)
 
-        thing.add_attr(self._attr_name, number=number, subkey='ipstring', value=str(self._int_to_ipy(resource)))
-        thing.add_attr(self._attr_name, number=number, subkey='cidr', value=str(self._int_to_cidr(resource, self.netmask)))
+        return [('ipstring', str(self._int_to_ipy(resource))),
+                ('cidr', str(self._int_to_cidr(resource, self.netmask)))]
         
                      
-    def allocator(self, thing=None):
-        """allocate IPs from this manager"""
+    def allocated(self, first=None, last=None):
+        """Return the sorted integers of the ips allocated between first and
+        last (inclusive, as integers), by default the whole managed range.
+
+        Reads them with one query.
+        """
+
+        if first is None or last is None:
+            network, broadcast = self._range()
+            first = network if first is None else first
+            last = broadcast if last is None else last
+
+        clusto.flush()
+        query = clusto.SESSION.query(Attribute.int_value).filter(and_(
+            Attribute.key == unicode(self._attr_name),
+            Attribute.number != None,
+            Attribute.int_value >= first,
+            Attribute.int_value <= last,
+            *Attribute._version_args())).distinct()
+
+        return sorted(row[0] for row in query)
+
+    def _range(self):
+        """Return the network and broadcast address of the range as integers."""
+
+        return (int(self.ipy.net().int() - self._int_ip_const),
+                int(self.ipy.broadcast().int() - self._int_ip_const))
+
+    @staticmethod
+    def _free_runs(taken, first, last):
+        """Yield the (start, end) runs of integers between first and last
+        (inclusive) that aren't in the sorted list taken."""
+
+        current = first
+        for num in taken[bisect.bisect_left(taken, first):]:
+            if num > last:
+                break
+            if num > current:
+                yield current, num - 1
+            current = max(current, num + 1)
+        if current <= last:
+            yield current, last
+
+    def _free_ips(self, count):
+        """Return count free ips (as integers) in allocation order.
+
+        Searching starts after the last allocated ip (_lastip) and wraps
+        around to the start of the range.  The network, broadcast and
+        gateway addresses are never returned.
+        """
 
         if self.baseip is None:
             raise ResourceTypeException("Cannot generate an IP for an ipManager with no baseip")
 
-        lastip = self.attr_query('_lastip')
-                
-        if not lastip:
-            # I subtract self._int_ip_const to keep in int range
-            startip=int(self.ipy.net().int() + 1) - self._int_ip_const 
-        else:
-            startip = lastip[0].value
-
+        network, broadcast = self._range()
+        first, last = network + 1, broadcast - 1
 
-        
-        ## generate new ips the slow naive way
-        nextip = int(startip)
+        taken = self.allocated(first, last)
         if self.gateway:
-            gateway = IPy.IP(self.gateway).int() - self._int_ip_const
+            bisect.insort(taken, self._ipy_to_int(IPy.IP(self.gateway)))
+
+        lastip = self.attr_values('_lastip')
+        if lastip and first <= lastip[0] <= last:
+            start = lastip[0]
         else:
-            gateway = None
-        endip = self.ipy.broadcast().int() - self._int_ip_const
-
-        for i in range(2):
-            while nextip < endip:
-
-                if nextip == gateway:
-                    nextip += 1
-                    continue
-
-                if self.available(nextip):
-                    self.set_attr('_lastip', nextip)
-                    return self.ensure_type(nextip, True)
-                else:
-                    nextip += 1
-            
-            # check from the beginning again in case an earlier ip
-            # got freed
-                    
-            nextip = int(self.ipy.net().int() + 1)
-            
+            start = first
+
+        free = []
+        runs = itertools.chain(self._free_runs(taken, start, last),
+                               self._free_runs(taken, first, start - 1))
+        for run_start, run_end in runs:
+            free.extend(xrange(run_start,
+                               min(run_end, run_start + count - len(free) - 1) + 1))
+            if len(free) == count:
+                return free
+
         raise ResourceNotAvailableException("out of available ips.")
 
+    @classmethod
+    def _usage(cls, network, broadcast, gateway, taken):
+        """Return the utilization of a range (see utilization()).
+
+        taken is the sorted list of allocated ips (integers), only the ones
+        in the range are counted.
+        """
+
+        first, last = network + 1, broadcast - 1
+        size = max(last - first + 1, 0)
+
+        start = bisect.bisect_left(taken, first)
+        end = bisect.bisect_right(taken, last)
+        used = end - start
+
+        taken = taken[start:end]
+        if gateway is not None and first <= gateway <= last:
+            bisect.insort(taken, gateway)
+        runs = [run_end - run_start + 1 for run_start, run_end
+                in cls._free_runs(taken, first, last)]
+
+        return {'size': size,
+                'used': used,
+                'free': sum(runs),
+                'free_blocks': len(runs),
+                'largest_free_block': max(runs or [0]),
+                'utilization': size and 100.0 * (size - sum(runs)) / size}
+
+    def utilization(self):
+        """Return how much of the range is allocated, as a dict of:
+
+          size - the number of usable addresses (without the network and
+                 broadcast addresses)
+          used - the number of those allocated
+          free - the number that can still be allocated (the gateway can't)
+          free_blocks - the number of runs of free addresses
+          largest_free_block - the length of the longest run
+          utilization - the percentage of size that isn't free
+
+        The allocated addresses are read with one query.
+        """
+
+        if self.baseip is None:
+            raise ResourceTypeException("Cannot compute the utilization of an ipManager with no baseip")
+
+        network, broadcast = self._range()
+        gateway = self.gateway and self._ipy_to_int(IPy.IP(self.gateway))
+        return self._usage(network, broadcast, gateway,
+                           self.allocated(network, broadcast))
+
+    @classmethod
+    def utilization_report(cls):
+        """Return the utilization() of every ip manager with a baseip.
+
+        Each is a dict with the manager's name and network added, sorted by
+        network.  The whole report takes four queries: the managers, their
+        properties, the allocated ips and the resource counts (see
+        ResourceManager.stats()).
+        """
+
+        managers = cls._manager_properties()
+        counts = cls._stats_by_id(managers.keys())
+
+        subnets = []
+        for entity_id, (name, values) in managers.iteritems():
+            if not values['baseip']:
+                continue
+            try:
+                net = cls._make_ipy(values['baseip'], values['netmask'])
+                gateway = values['gateway'] and cls._ipy_to_int(
+                    IPy.IP(values['gateway']))
+            except ValueError:
+                continue
+            subnets.append((cls._ipy_to_int(net.net()),
+                            cls._ipy_to_int(net.broadcast()),
+                            gateway, name, net, entity_id))
+
+        if not subnets:
+            return []
+
+        clusto.flush()
+        query = SESSION.query(Attribute.int_value).filter(and_(
+            Attribute.key == unicode(cls._attr_name),
+            Attribute.number != None,
+            Attribute.int_value >= min(s[0] for s in subnets),
+            Attribute.int_value <= max(s[1] for s in subnets),
+            *Attribute._version_args())).distinct()
+        taken = sorted(row[0] for row in query)
+
+        report = []
+        for network, broadcast, gateway, name, net, entity_id in sorted(subnets):
+            usage = cls._usage(network, broadcast, gateway, taken)
+            usage.update(counts[entity_id])
+            usage.update(name=name, network=net.strNormal())
+            report.append(usage)
+
+        return report
+
+    def allocator(self, thing=None):
+        """allocate IPs from this manager
+
+        The allocated ips of the range are read with one query and the next
+        free one is picked from them.
+        """
+
+        nextip = self._free_ips(1)[0]
+        self.set_attr('_lastip', nextip)
+        return self.ensure_type(nextip, True)
+
+    def allocator_many(self, things):
+        """allocate an IP for each of the things, see allocator()."""
+
+        ips = self._free_ips(len(things))
+        if ips:
+            self.set_attr('_lastip', ips[-1])
+        return [self.ensure_type(nextip, True) for nextip in ips]
+
+    @classmethod
+    def _manager_properties(cls):
+        """Return {entity_id: (name, properties)} of all the ip managers.
+
+        Only the baseip, netmask and gateway properties are read, with two
+        queries.  Missing ones have their default values.
+        """
+
+        clusto.flush()
+        managers = {}
+        for entity_id, name in SESSION.query(Entity.entity_id,
+                                             Entity.name).filter(and_(
+                Entity.driver == cls._driver_name,
+                *Entity._version_args())):
+            managers[entity_id] = (name, dict((key, cls._properties[key])
+                                              for key in ('baseip', 'netmask',
+                                                          'gateway')))
+
+        query = Attribute.query().filter(and_(
+            Attribute.entity_id == Entity.entity_id,
+            Entity.driver == cls._driver_name,
+            Attribute.subkey == u'property',
+            Attribute.key.in_([u'baseip', u'netmask', u'gateway']),
+            *Entity._version_args()))
+        for attr in query:
+            if attr.entity_id in managers:
+                managers[attr.entity_id][1][attr.key] = attr.value
+
+        return managers
+
+    @classmethod
+    def subnet_index(cls):
+        """Return a SubnetIndex of the ranges of all the ip managers.
+
+        It's built from the baseip and netmask properties with two queries
+        and kept until the clusto version changes.  Managers without a
+        baseip accept any ip and cover the whole integer range.
+        """
+
+        index = _subnet_indexes.get(cls._driver_name)
+        if index is not None:
+            return index
+
+        ranges = []
+        for entity_id, (name, values) in cls._manager_properties().iteritems():
+            if not values.get('baseip'):
+                ranges.append((-cls._int_ip_const, 2 ** 128, entity_id))
+                continue
+            try:
+                net = cls._make_ipy(values['baseip'], values['netmask'])
+            except ValueError:
+                # ensure_type() would fail for it anyway
+                continue
+            ranges.append((cls._ipy_to_int(net.net()),
+                           cls._ipy_to_int(net.broadcast()), entity_id))
+
+        index = SubnetIndex(ranges)
+        _subnet_indexes.set(cls._driver_name, index)
+        return index
+
     @classmethod
     def get_ip_managers(cls, ip):
         """return a list of valid ip managers for the given ip.
 
+        The managers are found in subnet_index(), the most specific first.
+
         @param ip: the ip
         @type ip: integer, string, or IPy object
 
@@ -134,14 +408,20 @@ class IPManager(ResourceManager):
             ipman = ip.entity
             return Driver(ipman)
 
-        ipmanagers = []
-        for ipman in clusto.get_entities(clusto_drivers=[cls]):
-            try:
-                ipman.ensure_type(ip)
-                ipmanagers.append(Driver(ipman))
-            except ResourceTypeException:
-                continue
-        return ipmanagers
+        try:
+            if isinstance(ip, (int, long)):
+                ip = cls._int_to_ipy(ip)
+            else:
+                ip = IPy.IP(ip)
+        except ValueError:
+            return []
+
+        entity_ids = cls.subnet_index().find(cls._ipy_to_int(ip.net()),
+                                             cls._ipy_to_int(ip.broadcast()))
+
+        # loaded entities come from the session without a query
+        query = SESSION.query(Entity)
+        return [Driver(query.get(entity_id)) for entity_id in entity_ids]
 
     @classmethod
     def get_ip_manager(cls, ip):
@@ -168,6 +448,47 @@ class IPManager(ResourceManager):
 
         return ret
 
+    @classmethod
+    def get_ips_for(cls, devices):
+        """Return a dict of the ips (strings) of each of the devices.
+
+        All the devices' ips are read with one query, see resource_attrs().
+        """
+
+        devices = [Driver.ensure_driver(d) for d in devices]
+        by_id = dict((d.entity.entity_id, d) for d in devices)
+
+        ips = dict((d, []) for d in devices)
+        for attr, manager in cls.resource_attrs(devices):
+            ips[by_id[attr.entity_id]].append(str(cls._int_to_ipy(attr.value)))
+
+        return ips
+
+    @classmethod
+    def devices_in(cls, cidr):
+        """Return the devices with an ip in the given range, sorted by name.
+
+        The range is turned into a BETWEEN over the integer values of the
+        ip resources, one query using the idx_attrs_key_int_value index.
+
+        @param cidr: the range, e.g. '10.20.0.0/16' (or a single ip)
+        @type cidr: string or IPy object
+        """
+
+        net = IPy.IP(cidr)
+        first, last = cls._ipy_to_int(net.net()), cls._ipy_to_int(net.broadcast())
+
+        clusto.flush()
+        query = SESSION.query(Entity).filter(and_(
+            Attribute.entity_id == Entity.entity_id,
+            Attribute.key == unicode(cls._attr_name),
+            Attribute.number != None,
+            Attribute.int_value.between(first, last),
+            *(Attribute._version_args() + Entity._version_args())))
+
+        return [Driver(entity) for entity in
+                query.distinct().order_by(Entity.name)]
+
     @classmethod
     def get_devices(self, ip):
         subnet = IPManager.get_ip_manager(ip)
@@ -27,9 +27,24 @@ class SimpleNameManager(ResourceManager):
     def allocator(self, thing=None):
         clusto.flush()
 
-        counter = clusto.Counter.get(self.entity, 'next', default=self.next)
+        num = clusto.Counter.take(self.entity, 'next', default=self.next)[0]
 
-        num = str(counter.value)
+        return (self._make_name(num), True)
+
+    def allocator_many(self, things):
+        """allocate a name for each of the things with one counter
+        reservation."""
+
+        clusto.flush()
+
+        nums = clusto.Counter.take(self.entity, 'next', len(things),
+                                   default=self.next)
+
+        return [(self._make_name(num), True) for num in nums]
+
+    def _make_name(self, num):
+
+        num = str(num)
 
         if self.leadingZeros:
             num = num.rjust(self.digits, '0')
@@ -39,11 +54,7 @@ class SimpleNameManager(ResourceManager):
                                              "Max of %d digits and we're at "
                                              "number %s." % (self.digits, num))
         
-        nextname = self.basename + num
-
-        counter.next()
-
-        return (nextname, True)
+        return self.basename + num
         
 
 class SimpleEntityNameManager(SimpleNameManager):    
@@ -92,6 +103,41 @@ class SimpleEntityNameManager(SimpleNameManager):
         return newobj
 
 
+    def allocate_many(self, clustotype, count=None, resources=None):
+        """creates count new objects of the given type, named by this
+        manager, in one transaction.
+
+        resources - a list of names for the new objects instead of count
+                    new ones.
+
+        returns the new objects.
+        """
+
+        if not isinstance(clustotype, type):
+            raise TypeError("thing is not a Driver class")
+
+        try:
+            clusto.begin_transaction()
+
+            if resources is None:
+                names = [name for name, num in
+                         self.allocator_many([None] * (count or 0))]
+            else:
+                names = list(resources)
+
+            newobjs = [clustotype(name) for name in names]
+
+            # names from the counter don't need checking one by one
+            super(SimpleEntityNameManager, self).allocate_many(
+                newobjs, names, force=resources is None)
+
+            clusto.commit()
+        except Exception, x:
+            clusto.rollback_transaction()
+            raise
+
+        return newobjs
+
     def deallocate(self, thing, resource=None, number=True):
         raise Exception("can't deallocate an entity name, delete the entity instead.")
 
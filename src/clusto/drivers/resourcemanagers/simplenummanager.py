@@ -19,19 +19,34 @@ class SimpleNumManager(ResourceManager):
     _record_allocations = True
     _attr_name = "simplenum"
     
+    def _check_maxnum(self, last):
+
+        if self.maxnum and last > self.maxnum:
+            raise SimpleNumManagerException("Out of numbers. "
+                                            "Max of %d reached."
+                                            % (self.maxnum))
+
     def allocator(self, thing=None):
 
+        return self.allocator_many([thing])[0]
+
+    def allocator_many(self, things):
+        """allocate a number for each of the things with one counter
+        reservation."""
+
         clusto.flush()
 
-        counter = clusto.Counter.get(self.entity, 'next', default=self.next)
+        # checked before taking too, so running out doesn't use up numbers
+        count = len(things)
+        if count:
+            self._check_maxnum(clusto.Counter.peek(self.entity, 'next',
+                                                   default=self.next)
+                               + count - 1)
 
-        num = counter.value
-        
-        if self.maxnum and num > self.maxnum:
-            raise SimpleNumManagerException("Out of numbers. "
-                                            "Max of %d reached." 
-                                            % (self.maxnum))
-        
-        counter.next()
-        return (num, True)
+        nums = clusto.Counter.take(self.entity, 'next', count,
+                                   default=self.next)
+
+        if nums:
+            self._check_maxnum(nums[-1])
 
+        return [(num, True) for num in nums]
@@ -15,8 +15,13 @@ import sqlalchemy.sql
 
 import logging
 import sys
+import collections
 import datetime
+import threading
 import clusto
+import clusto.util
+import clusto.cache
+from clusto import audit
 from functools import wraps
 
 try:
@@ -28,7 +33,10 @@ except:
 __all__ = ['ATTR_TABLE', 'Attribute', 'and_', 'ENTITY_TABLE', 'Entity', 'func',
            'METADATA', 'not_', 'or_', 'SESSION', 'select', 'VERSION',
            'latest_version', 'CLUSTO_VERSIONING', 'Counter', 'ClustoVersioning',
-           'working_version', 'OperationalError', 'ClustoEmptyCommit']
+           'working_version', 'OperationalError', 'ClustoEmptyCommit',
+           'AttributeCache', 'attr_cache', 'AttributeRecord', 'flush_stats',
+           'ENTITY_CLOSURE_TABLE', 'ALLOCATION_LOCK_TABLE',
+           'COMMIT_COUNTER_TABLE', 'commit_count', 'count_commit']
 
 
 METADATA = MetaData()
@@ -44,7 +52,6 @@ CLUSTO_VERSIONING = Table('clustoversioning', METADATA,
                           )
 
 logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s')
-audit_log = logging.getLogger('clusto.audit')
 
 class ClustoEmptyCommit(Exception):
     pass
@@ -67,24 +74,228 @@ class ClustoSession(sqlalchemy.orm.interfaces.SessionExtension):
                and not SESSION.flushed:
             raise ClustoEmptyCommit()
 
+        if SESSION.clusto_versioning_enabled:
+            count_commit(session)
+
     def after_commit(self, session):
         SESSION.flushed = set()
+        Counter.blocks.committed()
+        # committing expires every loaded object, cached lists included
+        attr_cache(session).committed()
+
+    def after_rollback(self, session):
+        attr_cache(session).rolled_back()
+        Counter.blocks.rolled_back()
+
+    def before_flush(self, session, flush_context, instances):
+        # only called when there is something to write
+        flush_stats(session)['flushed'] += 1
 
     def after_flush(self, session, flush_context):
         SESSION.flushed.update(x for x in session)
 
+        if SESSION.clusto_closure_enabled:
+            # containment added, deleted (or soft deleted) in this flush
+            moved = [x.relation_id
+                     for objects in (session.new, session.dirty, session.deleted)
+                     for x in objects
+                     if isinstance(x, Attribute) and x.key == u'_contains']
+            if moved:
+                clusto.closure.update(session, moved)
+
+
+def flush_stats(session=None):
+    """Return the flush counters of the given (or current) session.
+
+    flushed - flushes that had changes to write, autoflushes included
+    skipped - clusto.flush() calls with nothing to write
+    """
+
+    if session is None:
+        session = SESSION()
+
+    stats = getattr(session, 'clusto_flush_stats', None)
+    if stats is None:
+        stats = dict(flushed=0, skipped=0)
+        session.clusto_flush_stats = stats
+    return stats
+
 
 SESSION = scoped_session(sessionmaker(autoflush=True, autocommit=True,
                                       extension=ClustoSession()))
 
 
+class AttributeCache(object):
+    """Per-session cache of the live attribute list of each entity.
+
+    Entries are keyed by entity_id, the SESSION.clusto_version they were
+    read at and the commit count at the time (see clusto.cache.clock).
+    Nothing is cached outside of transactions when the clock can't tell
+    the count (without versioning), so long-lived sessions that
+    never commit, like the services', still see other processes' writes.
+    Inside a transaction entries are kept until it commits or rolls back.
+
+    Besides the full attribute list, the results of filtered attribute
+    queries (see Driver.attrs) can be cached under a hashable query key.
+    An entity's entries are dropped whenever one of its attributes is
+    added, changed or deleted, and the whole cache is dropped when the
+    session commits or rolls back.  At most size entries are kept, the
+    oldest are dropped first.
+
+    The ids of the entities written to are collected and their entries in
+    the shared clusto.cache are deleted once the changes are committed.
+    """
+
+    size = 10000
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.written = set()
+        self.hits = 0
+        self.misses = 0
+        self.epoch = 0
+        self.generations = {}
+        self.version_stamp = None
+
+    def _key(self, entity_id, query=None):
+        version = SESSION.clusto_version
+        if version is not None and not isinstance(version, (int, long)):
+            # viewing at an sql expression, nothing stable to key on
+            return None
+
+        stamp = self.scope()
+        if stamp is None:
+            return None
+
+        return (entity_id, version, stamp, query)
+
+    def scope(self):
+        """Return what cached entries are valid for: 'transaction' inside
+        one, otherwise the commit count (see clusto.cache.clock).
+
+        Returns None when nothing may be cached.  Everything is dropped
+        once the count moves on, long-lived sessions would keep the
+        entries of every count otherwise.
+        """
+
+        if SESSION().transaction:
+            # dropped when the transaction ends
+            return 'transaction'
+
+        stamp = clusto.cache.clock.stamp()
+        if stamp is not None and stamp != self.version_stamp:
+            if self.version_stamp is not None:
+                self.invalidate()
+            self.version_stamp = stamp
+        return stamp
+
+    def __contains__(self, entity_id):
+        """Is the full attribute list of the entity cached."""
+
+        return self._key(entity_id) in self.entries
+
+    def get(self, entity_id, query=None):
+        """Return a copy of the cached attribute list or None on a miss."""
+
+        key = self._key(entity_id, query)
+        if key is not None and key in self.entries:
+            self.hits += 1
+            return list(self.entries[key])
+
+        self.misses += 1
+        return None
+
+    def set(self, entity_id, attrs, query=None):
+        key = self._key(entity_id, query)
+        if key is not None:
+            self.entries.pop(key, None)
+            self.entries[key] = list(attrs)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, entity_id=None):
+        """Drop the entries for the given entity_id, or everything."""
+
+        if entity_id is None:
+            self.entries.clear()
+            self.generations.clear()
+            self.epoch += 1
+            return
+
+        self.generations[entity_id] = self.generations.get(entity_id, 0) + 1
+        self.written.add(entity_id)
+        for key in [k for k in self.entries if k[0] == entity_id]:
+            del self.entries[key]
+
+    def committed(self):
+        clusto.cache.clock.touch()
+        clusto.cache.expire('attrs', self.written)
+        self.written.clear()
+        self.invalidate()
+
+    def rolled_back(self):
+        self.written.clear()
+        self.invalidate()
+
+    def stamp(self, entity_id):
+        """Return a token that changes whenever the entity is invalidated.
+
+        Lets data derived from an entity's attributes outside of this cache
+        tell whether it is still current.
+        """
+
+        self.scope()
+        return (self.epoch, self.generations.get(entity_id, 0))
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.entries)}
+
+
+def attr_cache(session=None):
+    """Return the AttributeCache of the given (or current) session."""
+
+    if session is None:
+        session = SESSION()
+
+    cache = getattr(session, 'clusto_attr_cache', None)
+    if cache is None:
+        cache = AttributeCache()
+        session.clusto_attr_cache = cache
+    return cache
+
+
 def latest_version():
     return select([func.coalesce(func.max(CLUSTO_VERSIONING.c.version), 0)])
 
 def working_version():
     return select([func.coalesce(func.max(CLUSTO_VERSIONING.c.version),1)])
 
+def commit_count():
+    return select([func.coalesce(func.max(COMMIT_COUNTER_TABLE.c.commits), 0)])
+
+def count_commit(session):
+    """Count a commit of the session's transaction, right before it's made.
+
+    Unlike versions, which are numbered when transactions begin, the count
+    only moves as transactions commit: the counter row stays locked until
+    this one commits, so once another process reads a count it sees every
+    commit counted up to it.
+    """
+
+    t = COMMIT_COUNTER_TABLE
+    result = session.execute(t.update().where(t.c.counter_id == 1)
+                             .values(commits=t.c.commits + 1))
+    if not result.rowcount:
+        session.execute(t.insert().values(counter_id=1, commits=1))
+
 SESSION.clusto_versioning_enabled = True
+SESSION.clusto_closure_enabled = False
+SESSION.clusto_counter_block_size = 1
+SESSION.clusto_allocation_locking = False
+SESSION.clusto_for_update = False
+SESSION.clusto_sql_regexp = False
 SESSION.clusto_version = None
 SESSION.clusto_user = None
 SESSION.clusto_description = None
@@ -135,6 +346,7 @@ Index('idx_attrs_entity_version',
 
 Index('idx_attrs_key', ATTR_TABLE.c.key)
 Index('idx_attrs_subkey', ATTR_TABLE.c.subkey)
+Index('idx_attrs_key_int_value', ATTR_TABLE.c.key, ATTR_TABLE.c.int_value)
 
 create_index = DDL('CREATE INDEX idx_attrs_str_value on %(table)s (string_value(20))')
 event.listen(ATTR_TABLE, 'after_create', create_index.execute_if(dialect='mysql'))
@@ -155,33 +367,137 @@ COUNTER_TABLE = Table('counters', METADATA,
 
 Index('idx_counter_entity_attr',
       COUNTER_TABLE.c.entity_id,
-      COUNTER_TABLE.c.attr_key)
+      COUNTER_TABLE.c.attr_key,
+      unique=True)
+
+# every (ancestor, descendant) pair of the containment tree, see clusto.closure
+ENTITY_CLOSURE_TABLE = Table('entity_closure', METADATA,
+                             Column('closure_id', Integer, primary_key=True),
+                             Column('ancestor_id', Integer,
+                                    ForeignKey('entities.entity_id'),
+                                    nullable=False),
+                             Column('descendant_id', Integer,
+                                    ForeignKey('entities.entity_id'),
+                                    nullable=False),
+                             Column('depth', Integer, nullable=False),
+                             Column('version', Integer, nullable=False),
+                             Column('deleted_at_version', Integer, default=None),
+                             mysql_engine='InnoDB'
+                             )
+
+Index('idx_closure_ancestor_version',
+      ENTITY_CLOSURE_TABLE.c.ancestor_id,
+      ENTITY_CLOSURE_TABLE.c.version,
+      ENTITY_CLOSURE_TABLE.c.deleted_at_version)
+
+Index('idx_closure_descendant_version',
+      ENTITY_CLOSURE_TABLE.c.descendant_id,
+      ENTITY_CLOSURE_TABLE.c.version,
+      ENTITY_CLOSURE_TABLE.c.deleted_at_version)
+
+# rows locked by allocations on databases without SELECT ... FOR UPDATE,
+# see ResourceManager.lock()
+ALLOCATION_LOCK_TABLE = Table('allocation_locks', METADATA,
+                              Column('entity_id', Integer,
+                                     ForeignKey('entities.entity_id'),
+                                     primary_key=True, autoincrement=False),
+                              Column('holds', Integer, default=0),
+                              mysql_engine='InnoDB'
+                              )
+
+# one row counting the commits made with versioning, see count_commit()
+COMMIT_COUNTER_TABLE = Table('commit_counter', METADATA,
+                             Column('counter_id', Integer, primary_key=True,
+                                    autoincrement=False),
+                             Column('commits', Integer, default=0),
+                             mysql_engine='InnoDB'
+                             )
 
 class ClustoVersioning(object):
     pass
 
+
+class CounterBlocks(threading.local):
+    """Counter values reserved ahead by this thread (hi/lo)
+
+    Counter.take() reserves SESSION.clusto_counter_block_size values of a
+    counter at a time and hands them out from here until they run out.
+    Values that were handed out but not used are skipped for good.
+
+    A block reserved in a transaction that gets rolled back was never
+    reserved, so it's dropped then.
+    """
+
+    def __init__(self):
+        # (entity_id, attr_key): [next value, end of the block]
+        self.blocks = {}
+        # blocks reserved in the current transaction
+        self.pending = set()
+
+    def peek(self, key):
+        """Return the next value of the block of key, or None if it's empty."""
+
+        block = self.blocks.get(key)
+        if block is None or block[0] >= block[1]:
+            return None
+        return block[0]
+
+    def take(self, key, count):
+        """Return count values of the block of key, or None if it's short."""
+
+        block = self.blocks.get(key)
+        if block is None or block[1] - block[0] < count:
+            return None
+        values = range(block[0], block[0] + count)
+        block[0] += count
+        return values
+
+    def add(self, key, start, end):
+        self.blocks[key] = [start, end]
+        self.pending.add(key)
+
+    def committed(self):
+        self.pending.clear()
+
+    def rolled_back(self):
+        for key in self.pending:
+            self.blocks.pop(key, None)
+        self.pending.clear()
+
+    def clear(self):
+        self.blocks.clear()
+        self.pending.clear()
+
+
 class Counter(object):
 
+    blocks = CounterBlocks()
+
     def __init__(self, entity, keyname, start=0):
         self.entity = entity
         self.attr_key = unicode(keyname)
 
         self.value = start
 
-        audit_log.info('create counter entity=%s attr_key=%s value=%s', self.entity.name, self.attr_key, self.value)
+        if audit.sink:
+            audit.counter('create', self, start)
 
         SESSION.add(self)
         SESSION.flush()
 
-    def next(self):
+    def next(self, count=1):
+        """Increment the counter by count and return the new value."""
 
-        self.value = Counter.value + 1
+        self.value = Counter.value + count
         SESSION.flush()
-        audit_log.info('increment counter entity=%s attr_key=%s value=%s', self.entity.name, self.attr_key, self.value)
-        return self.value
+        value = self.value
+        if audit.sink:
+            audit.counter('increment', self, value)
+        return value
 
     def delete(self):
-        audit_log.info('delete counter entity=%s attr_key=%s value=%s', self.entity.name, self.attr_key, self.value)
+        if audit.sink:
+            audit.counter('delete', self, self.__dict__.get('value'))
         SESSION.delete(self)
         SESSION.flush()
 
@@ -197,6 +513,65 @@ class Counter(object):
 
         return ctr
 
+    @classmethod
+    def reserve(cls, entity, keyname, count=1, default=0):
+        """Add count to a counter and return its value from before.
+
+        The counter is created at default if it doesn't exist.  The
+        increment is one UPDATE ... SET value = value + count, read back in
+        the same transaction, so concurrent reservations never overlap.
+        """
+
+        clusto.begin_transaction()
+        try:
+            last = cls.get(entity, keyname, default).next(count)
+            clusto.commit()
+        except Exception, x:
+            clusto.rollback_transaction()
+            raise x
+
+        return last - count
+
+    @classmethod
+    def take(cls, entity, keyname, count=1, default=0):
+        """Return a list of count unused values of a counter.
+
+        The values start at the counter's value, which is then moved past
+        them.  With a counter_block_size above 1 values are reserved that
+        many at a time (see CounterBlocks), so they're unique but not
+        always consecutive between calls.
+        """
+
+        size = SESSION.clusto_counter_block_size
+        if size <= 1 or count >= size:
+            start = cls.reserve(entity, keyname, count, default)
+            return range(start, start + count)
+
+        SESSION.flush()
+        key = (entity.entity_id, unicode(keyname))
+        values = cls.blocks.take(key, count)
+        if values is None:
+            start = cls.reserve(entity, keyname, size, default)
+            cls.blocks.add(key, start, start + size)
+            values = cls.blocks.take(key, count)
+
+        return values
+
+    @classmethod
+    def peek(cls, entity, keyname, default=0):
+        """Return the value take() would return next, without taking it."""
+
+        value = cls.blocks.peek((entity.entity_id, unicode(keyname)))
+        if value is not None:
+            return value
+
+        SESSION.flush()
+        ctr = SESSION.query(cls).filter(and_(cls.entity==entity,
+                                             cls.attr_key==unicode(keyname))).first()
+        if ctr is None:
+            return default
+        return ctr.value
+
     @classmethod
     def query(cls):
         return SESSION.query(cls)
@@ -258,16 +633,18 @@ class Attribute(ProtectedObj):
         self.subkey = subkey
         self.version = working_version()
         if isinstance(number, bool) and number == True:
-            counter = Counter.get(entity, key, default=-1)
-            self.number = counter.next()
+            # the counter holds the last number used
+            self.number = Counter.take(entity, key, default=-1)[0] + 1
         elif isinstance(number, Counter):
             self.number = number.next()
         else:
             self.number = number
 
+        if audit.sink:
+            audit.attribute('create', self, entity)
 
-        audit_log.info('create attribute entity=%s key=%s subkey=%s value=%s number=%s datatype=%s',
-                self.entity.name, self.key, self.subkey, self.value, self.number, self.datatype)
+        # before flushing, which commits when there is no transaction
+        attr_cache().invalidate(entity.entity_id)
         SESSION.add(self)
         SESSION.flush()
 
@@ -387,16 +764,136 @@ class Attribute(ProtectedObj):
 
         setattr(self, value_type, value)
 
-        audit_log.info('set attribute entity=%s key=%s subkey=%s value=%s number=%s datatype=%s',
-                self.entity.name, self.key, self.subkey, self.value, self.number, self.datatype)
+        if self.entity_id is not None:
+            attr_cache().invalidate(self.entity_id)
+
+            if audit.sink:
+                audit.attribute('set', self)
 
     value = property(_get_value, _set_value)
 
+    @classmethod
+    def column_values(cls, value):
+        """Return the datatype and value columns of an attribute row for value."""
+
+        columns = {'datatype': cls.get_type(value),
+                   'int_value': None,
+                   'string_value': None,
+                   'datetime_value': None,
+                   'relation_id': None}
+
+        datatype = columns['datatype']
+        if datatype == 'relation':
+            if not isinstance(value, Entity):
+                value = value.entity
+            columns['relation_id'] = value.entity_id
+        elif datatype == 'int':
+            columns['int_value'] = int(value)
+        elif datatype == 'datetime':
+            columns['datetime_value'] = value
+        else:
+            if datatype == 'json':
+                value = json.dumps(value)
+            if value is not None:
+                value = unicode(value)
+            columns['string_value'] = value
+
+        return columns
+
+    @classmethod
+    def insert_many(cls, entity, attrs):
+        """Insert several attributes of an entity with one executemany.
+
+        attrs is a list of (key, value, number, subkey) tuples where number
+        is an integer or None.  Has to be called inside a transaction.
+        """
+
+        cls.insert_rows([(entity,) + tuple(attr) for attr in attrs])
+
+    @classmethod
+    def insert_rows(cls, attrs):
+        """Insert attributes of any number of entities with one executemany.
+
+        attrs is a list of (entity, key, value, number, subkey) tuples, see
+        insert_many().  Has to be called inside a transaction.
+        """
+
+        if not attrs:
+            return
+
+        SESSION.flush()
+        version = SESSION.execute(working_version()).scalar()
+
+        rows = []
+        entities = {}
+        for entity, key, value, number, subkey in attrs:
+            row = cls.column_values(value)
+            row.update(entity_id=entity.entity_id,
+                       key=unicode(key),
+                       subkey=subkey if subkey is None else unicode(subkey),
+                       number=number,
+                       version=version)
+            rows.append(row)
+            entities[entity.entity_id] = entity
+            if audit.sink:
+                audit.attribute_row('create', entity, row)
+
+        SESSION.execute(ATTR_TABLE.insert(), rows)
+        for entity_id, entity in entities.iteritems():
+            SESSION.flushed.add(entity)
+            attr_cache().invalidate(entity_id)
+
+        if SESSION.clusto_closure_enabled:
+            clusto.closure.update(SESSION(), [row['relation_id'] for row in rows
+                                              if row['key'] == u'_contains'])
+
+    @classmethod
+    def delete_many(cls, attrs):
+        """Delete several attributes with one statement per 500 attributes.
+
+        Has to be called inside a transaction.
+        """
+
+        if not attrs:
+            return
+
+        SESSION.flush()
+        version = SESSION.execute(working_version()).scalar()
+
+        for attr in attrs:
+            if audit.sink:
+                audit.attribute('delete', attr)
+            attr_cache().invalidate(attr.entity_id)
+            SESSION.flushed.add(attr)
+
+        moved = [attr.relation_id for attr in attrs
+                 if attr.key == u'_contains']
+
+        ids = [attr.attr_id for attr in attrs]
+        for chunk in clusto.util.batch(ids, 500):
+            where = ATTR_TABLE.c.attr_id.in_(list(chunk))
+            if SESSION.clusto_versioning_enabled:
+                SESSION.execute(ATTR_TABLE.update().where(where).values(
+                    deleted_at_version=version))
+            else:
+                SESSION.execute(ATTR_TABLE.delete().where(where))
+
+        # the loaded objects don't know about the change
+        for attr in attrs:
+            if SESSION.clusto_versioning_enabled:
+                SESSION.expire(attr)
+            else:
+                SESSION.expunge(attr)
+
+        if SESSION.clusto_closure_enabled:
+            clusto.closure.update(SESSION(), moved)
+
     @ProtectedObj.writer
     def delete(self):
         ### TODO this seems like a hack
-        audit_log.info('delete attribute entity=%s key=%s subkey=%s value=%s number=%s datatype=%s',
-                self.entity.name, self.key, self.subkey, self.value, self.number, self.datatype)
+        if audit.sink:
+            audit.attribute('delete', self)
+        attr_cache().invalidate(self.entity_id)
         if SESSION.clusto_versioning_enabled:
             self.deleted_at_version = working_version()
         else:
@@ -404,7 +901,10 @@ class Attribute(ProtectedObj):
             SESSION.flush()
 
     @classmethod
-    def _version_args(cls):
+    def _version_args(cls, alias=None):
+        # alias: an aliased(Attribute) to build the criteria for instead
+        if alias is not None:
+            cls = alias
         args = []
         del_version_args = [cls.deleted_at_version==None]
         if SESSION.clusto_version != None:
@@ -462,6 +962,142 @@ class Attribute(ProtectedObj):
 
         return SESSION.query(cls).filter(and_(*args))
 
+class AttributeRecord(object):
+    """Read-only copy of an attribute row
+
+    AttributeRecords are read with plain SQL selects instead of through the
+    ORM (see AttributeRecord.select) and carry the key, number, subkey,
+    datatype and decoded value of an attribute.  Relation values are
+    Drivers like Attribute.value.  They're not bound to the session so they
+    can't be changed or deleted.
+    """
+
+    __slots__ = ('attr_id', 'entity_id', 'key', 'number', 'subkey',
+                 'datatype', 'value', 'relation_id')
+
+    COLUMNS = [ATTR_TABLE.c.attr_id, ATTR_TABLE.c.entity_id,
+               ATTR_TABLE.c.key, ATTR_TABLE.c.number, ATTR_TABLE.c.subkey,
+               ATTR_TABLE.c.datatype, ATTR_TABLE.c.int_value,
+               ATTR_TABLE.c.string_value, ATTR_TABLE.c.datetime_value,
+               ATTR_TABLE.c.relation_id]
+
+    def __init__(self, attr_id, entity_id, key, number, subkey, datatype,
+                 value, relation_id=None):
+
+        for name, val in zip(self.__slots__,
+                             (attr_id, entity_id, key, number, subkey,
+                              datatype, value, relation_id)):
+            object.__setattr__(self, name, val)
+
+    def __setattr__(self, name, val):
+        raise AttributeError("%s is read-only" % self.__class__.__name__)
+
+    def __cmp__(self, other):
+
+        if not isinstance(other, (Attribute, AttributeRecord)):
+            raise TypeError("Can only compare equality with an Attribute. "
+                            "Got a %s instead." % (type(other).__name__))
+
+        return cmp(self.key, other.key)
+
+    def __eq__(self, other):
+
+        if not isinstance(other, (Attribute, AttributeRecord)):
+            return False
+
+        return ((self.key == other.key) and (self.subkey == other.subkey) and
+                (self.value == other.value))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+
+        params = ('key', 'value', 'subkey', 'number', 'datatype')
+
+        vals = ((x, getattr(self, x)) for x in params)
+        strs = ("%s=%s" % (key, ("'%s'" % val if isinstance(val, basestring) else '%s' % str(val))) for key, val in vals)
+
+        return "%s(%s)" % (self.__class__.__name__, ','.join(strs))
+
+    @property
+    def is_relation(self):
+        return self.datatype == 'relation'
+
+    @property
+    def keytuple(self):
+        return (self.key, self.number, self.subkey)
+
+    @property
+    def to_tuple(self):
+        return (self.key, self.number, self.subkey, self.value)
+
+    @classmethod
+    def select(cls, entity_ids, criteria=(), chunk_size=500):
+        """Return the attributes of the given entities as AttributeRecords.
+
+        criteria are extra SQL conditions on the attribute columns.  Returns
+        a dict of entity_id -> list of records in attr_id order.
+        """
+
+        return cls.build(cls.rows(entity_ids, criteria, chunk_size),
+                         chunk_size)
+
+    @classmethod
+    def rows(cls, entity_ids, criteria=(), chunk_size=500):
+        """Return the raw attribute rows of the given entities.
+
+        Returns a dict of entity_id -> list of tuples of the COLUMNS values
+        in attr_id order, which is what gets stored in clusto.cache.
+        """
+
+        found = dict((entity_id, []) for entity_id in entity_ids)
+        for chunk in clusto.util.batch(found.keys(), chunk_size):
+            query = select(cls.COLUMNS,
+                           and_(ATTR_TABLE.c.entity_id.in_(list(chunk)),
+                                *(Attribute._version_args() + list(criteria))))
+            for row in SESSION.execute(query.order_by(ATTR_TABLE.c.attr_id)):
+                found[row.entity_id].append(tuple(row))
+
+        return found
+
+    @classmethod
+    def build(cls, rows, chunk_size=500):
+        """Turn the raw rows returned by rows() into AttributeRecords.
+
+        All the relation targets are loaded with one query per chunk_size
+        targets.
+        """
+
+        relation_ids = set(row[9] for entity_rows in rows.itervalues()
+                           for row in entity_rows if row[5] == 'relation')
+        relations = {}
+        for chunk in clusto.util.batch(relation_ids, chunk_size):
+            for entity in Entity.query().filter(
+                    Entity.entity_id.in_(list(chunk))):
+                relations[entity.entity_id] = clusto.drivers.base.Driver(entity)
+
+        found = {}
+        for entity_id, entity_rows in rows.iteritems():
+            records = found[entity_id] = []
+            for (attr_id, entity_id, key, number, subkey, datatype, int_value,
+                 string_value, datetime_value, relation_id) in entity_rows:
+                if datatype == 'relation':
+                    value = relations.get(relation_id)
+                elif datatype == 'int':
+                    value = int(int_value)
+                elif datatype == 'datetime':
+                    value = datetime_value
+                elif datatype == 'json':
+                    value = json.loads(string_value)
+                else:
+                    value = string_value
+
+                records.append(cls(attr_id, entity_id, key, number, subkey,
+                                   datatype, value, relation_id))
+
+        return found
+
 class Entity(ProtectedObj):
     """
     The base object that can be stored and managed in clusto.
@@ -489,7 +1125,8 @@ class Entity(ProtectedObj):
 
         self.version = working_version()
 
-        audit_log.info('create entity %s driver=%s type=%s', self.name, self.driver, self.type)
+        if audit.sink:
+            audit.entity('create', self)
 
         SESSION.add(self)
         SESSION.flush()
@@ -536,7 +1173,13 @@ class Entity(ProtectedObj):
 
     @property
     def attrs(self):
-        return Attribute.query().filter(Attribute.entity==self).all()
+        cache = attr_cache()
+        attrs = cache.get(self.entity_id)
+        if attrs is None:
+            attrs = Attribute.query().filter(Attribute.entity==self).order_by(
+                Attribute.attr_id).all()
+            cache.set(self.entity_id, attrs)
+        return attrs
 
     @property
     def references(self):
@@ -568,8 +1211,10 @@ class Entity(ProtectedObj):
                 SESSION.delete(self)
                 SESSION.flush()
 
+            if audit.sink:
+                audit.entity('delete', self)
+
             clusto.commit()
-            audit_log.info('delete entity %s', self.name)
         except Exception, x:
             clusto.rollback_transaction()
             raise x
@@ -129,6 +129,8 @@ class DHCPServer(object):
             methodname = 'handle_%s' % request.type
             if hasattr(self, methodname):
                 method = getattr(self, methodname)
+                # the session outlives the request, its cache mustn't
+                clusto.attr_cache().invalidate()
                 try:
                     method(request)
                 except:
@@ -177,7 +179,9 @@ class ClustoDHCPServer(DHCPServer):
         
         server = server[0]
 
-        enabled = server.attrs(key='dhcp', subkey='enabled', merge_container_attrs=True)
+        # nearest first, so the first one found applies
+        dhcp = server.effective_attrs(key='dhcp', sort_by_keys=False)
+        enabled = [attr for attr in dhcp if attr.subkey == 'enabled']
         if not enabled or not enabled[0].value:
             log.info('DHCP not enabled for %s' % server.name)
             return
@@ -210,7 +214,9 @@ class ClustoDHCPServer(DHCPServer):
 
         log.info('Sending offer to %s, options: %s' % (server.name, options))
 
-        for attr in server.attrs(key='dhcp', merge_container_attrs=True):
+        # later (farther) containers' options override nearer ones, as they
+        # always have
+        for attr in dhcp:
             options[attr.subkey] = attr.value
 
         response = DHCPResponse(type='offer', offerip=ip['ipstring'], options=options, request=request)
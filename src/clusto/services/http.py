@@ -21,6 +21,46 @@ conf = clusto.script_helper.load_config(os.environ.get('CLUSTOCONFIG', '/etc/clu
 clusto.connect(conf)
 
 
+def read_only(func):
+    '''
+    Run a handler that doesn't change anything with autoflush turned off.
+    '''
+    def handler(*args, **kwargs):
+        with clusto.read_only():
+            return func(*args, **kwargs)
+    handler.__name__ = func.__name__
+    handler.__doc__ = func.__doc__
+    return handler
+
+
+# responses of read-only GET handlers, valid until anything in clusto changes
+responses = clusto.cache.VersionedStore()
+
+
+def cached(func):
+    '''
+    Serve repeated GETs of a read-only handler from the responses cache.
+    '''
+    def handler(self, request, match):
+        if request.method != 'GET':
+            return func(self, request, match)
+
+        key = request.path_qs
+        found = responses.get(key)
+        if found is not None:
+            status, headerlist, body = found
+            return Response(status=status, headerlist=list(headerlist), body=body)
+
+        response = func(self, request, match)
+        if response.status_int == 200:
+            responses.set(key, (response.status, list(response.headerlist),
+                                response.body))
+        return response
+    handler.__name__ = func.__name__
+    handler.__doc__ = func.__doc__
+    return handler
+
+
 def unclusto(obj, prefetch_attrs=None):
     '''
     Convert an object to a representation that can be safely serialized into
@@ -30,7 +70,7 @@ def unclusto(obj, prefetch_attrs=None):
         return obj
     if type(obj) in (list, dict):
         return json.dumps(obj)
-    if isinstance(obj, clusto.Attribute):
+    if isinstance(obj, (clusto.Attribute, clusto.AttributeRecord)):
         return {
             'key': obj.key,
             'value': unclusto(obj.value),
@@ -52,6 +92,29 @@ def unclusto(obj, prefetch_attrs=None):
     return str(obj)
 
 
+def prefetch(objs, prefetch_attrs=None):
+    '''
+    Load the attributes unclusto() will ask for on all the given objects at
+    once instead of with one query per object.
+    '''
+    if not prefetch_attrs:
+        return objs
+    keys = set()
+    subkeys = set()
+    for prefetch_attr in prefetch_attrs:
+        if not prefetch_attr.get('key') or prefetch_attr.get('regex'):
+            keys = None
+        elif keys is not None:
+            keys.add(prefetch_attr['key'])
+        if prefetch_attr.get('subkey') is None or prefetch_attr.get('regex'):
+            subkeys = None
+        elif subkeys is not None:
+            subkeys.add(prefetch_attr['subkey'])
+    drivers = [x for x in objs if isinstance(x, Driver)]
+    clusto.prefetch_attrs(drivers, keys=keys or (), subkeys=subkeys or ())
+    return objs
+
+
 def dumps(request, obj, **kwargs):
     result = json.dumps(obj, indent=2, sort_keys=True, **kwargs)
     if 'callback' in request.params:
@@ -79,7 +142,7 @@ class EntityAPI(object):
         }
 
         attrs = []
-        for x in self.obj.attrs():
+        for x in self.obj.attr_records():
             attrs.append(unclusto(x))
         result['attrs'] = attrs
         result['contents'] = [unclusto(x) for x in self.obj.contents()]
@@ -155,8 +218,15 @@ class EntityAPI(object):
         result = {
             'attrs': []
         }
-        kwargs = dict(request.params.items())
-        for attr in self.obj.attrs(**kwargs):
+        # other parameters, like the JSONP callback, aren't filters
+        kwargs = dict((k, v) for k, v in request.params.items()
+                      if k in ('key', 'value', 'number', 'subkey', 'regex',
+                               'ignore_hidden', 'sort_by_keys'))
+        if request.params.get('merge_container_attrs'):
+            attrs = self.obj.attrs(merge_container_attrs=True, **kwargs)
+        else:
+            attrs = self.obj.attr_records(**kwargs)
+        for attr in attrs:
             result['attrs'].append(unclusto(attr))
         return dumps(request, result)
 
@@ -197,11 +267,13 @@ class EntityAPI(object):
         result['driver'] = self.obj.driver
 
         attrs = []
-        for x in self.obj.attrs():
+        for x in self.obj.attr_records():
             attrs.append(unclusto(x))
         result['attrs'] = attrs
-        result['contents'] = [unclusto(x, prefetch_attrs) for x in self.obj.contents()]
-        result['parents'] = [unclusto(x, prefetch_attrs) for x in self.obj.parents()]
+        contents = prefetch(self.obj.contents(), prefetch_attrs)
+        result['contents'] = [unclusto(x, prefetch_attrs) for x in contents]
+        parents = prefetch(self.obj.parents(), prefetch_attrs)
+        result['parents'] = [unclusto(x, prefetch_attrs) for x in parents]
         result['actions'] = [x for x in dir(self) if not x.startswith('_') and callable(getattr(self, x))]
 
         return dumps(request, result)
@@ -348,7 +420,15 @@ class QueryAPI(object):
             #   prefetch_attrs=[{'key': 'disk', 'subkey': 'make'}, {'key': 'system', 'subkey': 'version'}]
             prefetch_attrs = loads(request, request.params['prefetch_attrs'])
 
-        result = [unclusto(x, prefetch_attrs) for x in clusto.get_from_pools(pools, clusto_types)]
+        operator = request.params.get('operator', 'intersection')
+        if operator not in clusto.containment.OPERATORS:
+            return Response(status=400, body='400 Bad Request\noperator must be one of %s\n'
+                            % ', '.join(clusto.containment.OPERATORS))
+
+        objs = prefetch(list(clusto.get_from_pools(pools, clusto_types,
+                                                   operator=operator)),
+                        prefetch_attrs)
+        result = [unclusto(x, prefetch_attrs) for x in objs]
         return dumps(request, result)
 
     @classmethod
@@ -362,6 +442,21 @@ class QueryAPI(object):
             return Response(status=404, body='404 Not Found\n')
         return dumps(request, unclusto(ipman))
 
+    @classmethod
+    def devices_in(self, request):
+        if not 'cidr' in request.params:
+            return Response(status=400, body='400 Bad Request\nYou must specify a "cidr" parameter\n')
+
+        try:
+            devices = IPManager.devices_in(request.params['cidr'])
+        except ValueError:
+            return Response(status=400, body='400 Bad Request\nInvalid CIDR\n')
+        return dumps(request, [unclusto(x) for x in devices])
+
+    @classmethod
+    def ip_utilization(self, request):
+        return dumps(request, IPManager.utilization_report())
+
 
 class ClustoApp(object):
     def __init__(self):
@@ -392,11 +487,15 @@ class ClustoApp(object):
             'resource': ResourceAPI,
         }
 
+    @cached
+    @read_only
     def default_delegate(self, request, match):
         types = ['/' + x for x in clusto.typelist.keys()]
         types.sort()
         return dumps(request, types)
 
+    @cached
+    @read_only
     def types_delegate(self, request, match):
         objtype = match.groupdict()['objtype']
         result = []
@@ -416,6 +515,8 @@ class ClustoApp(object):
 
         return Response(status=501, body='501 Not Implemented\n')
 
+    @cached
+    @read_only
     def query_delegate(self, request, match):
         querytype = match.groupdict()['querytype']
 
@@ -482,6 +583,8 @@ class ClustoApp(object):
             response = Response(status=404, body='404 Not Found\nInvalid action\n')
         return response
 
+    @cached
+    @read_only
     def search(self, request, match):
         query = request.params.get('q', None)
         if not query:
@@ -500,6 +603,9 @@ class ClustoApp(object):
         request = Request(environ)
         response = Response(status=404, body='404 Not Found\nUnmatched URL\n')
 
+        # the session outlives the request, its cache mustn't
+        clusto.attr_cache().invalidate()
+
         for pattern, handler in self.urls:
             match = pattern.match(request.path_info)
             if match:
@@ -5,3 +5,7 @@ from drivertests import *
 from versioningtests import *
 from countertests import *
 
+from audittests import *
+from cachetests import *
+from containmenttests import *
+from closuretests import *
@@ -0,0 +1,108 @@
+from clusto.test import testbase
+
+import os
+import tempfile
+
+import clusto
+from clusto import audit
+from clusto.drivers import Driver, BasicServer, Pool
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class TestAuditLog(testbase.ClustoTestBase):
+
+    def setUp(self):
+        testbase.ClustoTestBase.setUp(self)
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        audit.configure(None)
+        os.unlink(self.filename)
+        testbase.ClustoTestBase.tearDown(self)
+
+    def records(self):
+        audit.sink.flush()
+        return open(self.filename).read().splitlines()
+
+    def testDisabled(self):
+
+        audit.configure(None)
+        self.assertEqual(audit.sink, None)
+
+        d = Driver('d1')
+        d.add_attr('foo', 1)
+
+        self.assertEqual(os.path.getsize(self.filename), 0)
+
+    def testTextRecords(self):
+
+        audit.configure(self.filename)
+
+        d = Driver('d1')
+        d.add_attr('foo', 1, subkey='bar')
+        d.set_attr('foo', 2, subkey='bar')
+        d.del_attrs('foo')
+
+        lines = self.records()
+
+        self.assertEqual(len(lines), 5)
+        self.assert_(lines[0].endswith(
+            ' clusto.audit INFO create entity entity=d1 driver=entity type=generic'))
+        self.assert_(lines[1].endswith(
+            'create attribute entity=d1 key=foo subkey=bar number=None datatype=int int_value=1'))
+        self.assert_('delete attribute entity=d1 attr_id=' in lines[2])
+        self.assert_(lines[2].endswith('int_value=1'))
+        self.assert_(lines[3].endswith('int_value=2'))
+        self.assert_('delete attribute entity=d1 attr_id=' in lines[4])
+
+    def testJSONRecords(self):
+
+        audit.configure(self.filename, format='json')
+
+        s = BasicServer('s1')
+        s.add_attrs([('foo', 'a'), ('foo', 'b')])
+
+        records = [json.loads(line) for line in self.records()]
+
+        self.assertEqual([r['event'] for r in records],
+                         ['create entity',
+                          'create attribute',
+                          'create attribute'])
+        self.assertEqual([r['string_value'] for r in records[1:]],
+                         ['a', 'b'])
+        self.assertEqual(set(r['entity'] for r in records), set(['s1']))
+        self.assertEqual(records[1]['entity_id'], s.entity.entity_id)
+
+    def testCounterRecords(self):
+
+        audit.configure(self.filename)
+
+        p = Pool('p1')
+        p.add_attr('foo', 'bar', number=True)
+
+        lines = self.records()
+        counters = [l for l in lines if ' counter ' in l]
+
+        self.assertEqual(len(counters), 2)
+        self.assert_(counters[0].endswith('create counter entity=p1 attr_key=foo value=-1'))
+        self.assert_(counters[1].endswith('increment counter entity=p1 attr_key=foo value=0'))
+
+    def testEntityNamesWithoutLoading(self):
+
+        d = Driver('d1')
+        entity_id = d.entity.entity_id
+
+        audit.configure(self.filename)
+        clusto.clear()
+
+        d = clusto.get_by_name('d1')
+        d.add_attr('foo', 1)
+
+        lines = self.records()
+        self.assertEqual(len(lines), 1)
+        self.assert_('entity=d1 ' in lines[0])
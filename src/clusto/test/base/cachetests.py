@@ -0,0 +1,209 @@
+from clusto.test import testbase
+
+import ConfigParser
+import time
+
+import clusto
+from clusto import cache
+from clusto.drivers import BasicServer, Pool
+
+
+
+class TestLocalCache(testbase.ClustoTestBase):
+
+    def testLRU(self):
+
+        c = cache.LocalCache(size=2)
+        c.set_multi({'a': 1, 'b': 2})
+        self.assertEqual(c.get_multi(['a']), {'a': 1})
+
+        c.set_multi({'c': 3})
+        self.assertEqual(c.get_multi(['a', 'b', 'c']), {'a': 1, 'c': 3})
+
+        c.delete_multi(['a'])
+        self.assertEqual(c.get_multi(['a', 'c']), {'c': 3})
+
+    def testTTL(self):
+
+        c = cache.LocalCache(ttl=0.01)
+        c.set_multi({'a': 1})
+        self.assertEqual(c.get_multi(['a']), {'a': 1})
+        time.sleep(0.02)
+        self.assertEqual(c.get_multi(['a']), {})
+
+    def testConfigure(self):
+
+        conf = ConfigParser.ConfigParser()
+        conf.add_section('clusto')
+        self.assertEqual(cache.configure(conf), None)
+
+        conf.set('clusto', 'cache', 'local')
+        conf.set('clusto', 'cache_size', '5')
+        backend = cache.configure(conf)
+        self.assertTrue(isinstance(backend, cache.LocalCache))
+        self.assertEqual(backend.size, 5)
+        self.assertEqual(backend.ttl, 60)
+
+        cache.configure(ConfigParser.ConfigParser())
+
+
+class TestAttrCache(testbase.ClustoTestBase):
+
+    def data(self):
+
+        self.backend = cache.backend = cache.LocalCache()
+
+        p = Pool('p1')
+        for i in range(3):
+            s = BasicServer('s%d' % i)
+            s.add_attr('system', i, subkey='memory')
+            s.add_attr('owner', p)
+
+    def tearDown(self):
+        cache.backend = None
+        testbase.ClustoTestBase.tearDown(self)
+
+    def selects(self):
+        return self.count_statements(
+            lambda statement: statement.startswith('SELECT')
+                              and 'entity_attrs' in statement)
+
+    def testRecordsCached(self):
+
+        servers = clusto.get_by_names(['s0', 's1', 's2'])
+        ids = [s.entity.entity_id for s in servers]
+        statements = self.selects()
+
+        first = clusto.attr_records(ids, key='system')
+        self.assertEqual(len(statements), 1)
+
+        second = clusto.attr_records(ids, key='system')
+        self.assertEqual(len(statements), 1)
+        self.assertEqual([r.value for i in ids for r in second[i]], [0, 1, 2])
+        self.assertEqual([r.to_tuple for i in ids for r in first[i]],
+                         [r.to_tuple for i in ids for r in second[i]])
+
+        self.assertEqual(servers[0].attr_values('owner'),
+                         [clusto.get_by_name('p1')])
+        self.assertEqual(len(statements), 1)
+
+    def testWritesExpire(self):
+
+        s = clusto.get_by_name('s1')
+        self.assertEqual(s.attr_values('system', subkey='memory'), [1])
+
+        s.set_attr('system', 10, subkey='memory')
+        self.assertEqual(self.backend.get_multi(['attrs:%d' % s.entity.entity_id]), {})
+        self.assertEqual(s.attr_values('system', subkey='memory'), [10])
+
+        clusto.begin_transaction()
+        s.add_attr('foo', 'bar')
+        self.assertEqual(s.attr_values('foo'), ['bar'])
+        clusto.rollback_transaction()
+
+        self.assertEqual(s.attr_values('foo'), [])
+
+    def testNotCachedWithoutVersioning(self):
+
+        s = clusto.get_by_name('s1')
+        clusto.SESSION.clusto_versioning_enabled = False
+        try:
+            self.assertEqual(s.attr_values('system', subkey='memory'), [1])
+            self.assertEqual(
+                self.backend.get_multi(['attrs:%d' % s.entity.entity_id]), {})
+        finally:
+            clusto.SESSION.clusto_versioning_enabled = True
+
+    def testLoadRacingWrite(self):
+
+        s = clusto.get_by_name('s1')
+        entity_id = s.entity.entity_id
+
+        def loader(idents):
+            # another session writes after the rows were read, and deletes
+            # the entry before it is stored
+            rows = clusto.AttributeRecord.rows(idents)
+            clusto.get_by_name('s1').set_attr('system', 20, subkey='memory')
+            return rows
+
+        cache.fetch('attrs', [entity_id], loader)
+        self.assertEqual(s.attr_values('system', subkey='memory'), [20])
+
+
+class TestVersionClock(testbase.ClustoTestBase):
+
+    def data(self):
+
+        self.backend = cache.backend = cache.LocalCache()
+        BasicServer('s1').add_attr('system', 1, subkey='memory')
+
+    def tearDown(self):
+        cache.backend = None
+        cache.clock.interval = 1.0
+        testbase.ClustoTestBase.tearDown(self)
+
+    def otherProcessWrites(self, entity_id, value):
+        # bypasses this process' session and caches, like another process
+        clusto.count_commit(clusto.SESSION())
+        clusto.SESSION.execute(clusto.ATTR_TABLE.update().where(
+            clusto.ATTR_TABLE.c.entity_id == entity_id).values(int_value=value))
+
+    def testThrottled(self):
+
+        s = clusto.get_by_name('s1')
+        cache.clock.interval = 60
+        self.assertEqual(s.attr_values('system'), [1])
+        reads = cache.clock.reads
+
+        self.otherProcessWrites(s.entity.entity_id, 2)
+        self.assertEqual(s.attr_values('system'), [1])
+        self.assertEqual(cache.clock.reads, reads)
+
+        cache.clock.interval = 0
+        self.assertEqual(s.attr_values('system'), [2])
+
+    def testLateCommit(self):
+
+        s = clusto.get_by_name('s1')
+        cache.clock.interval = 0
+        self.assertEqual(s.attr_values('system'), [1])
+
+        commits = clusto.SESSION.execute(clusto.commit_count()).scalar()
+        BasicServer('s2')
+        self.assertEqual(clusto.SESSION.execute(clusto.commit_count()).scalar(),
+                         commits + 1)
+
+        # a transaction that began before the latest version commits now
+        version = clusto.get_latest_version_number()
+        self.otherProcessWrites(s.entity.entity_id, 2)
+        self.assertEqual(clusto.get_latest_version_number(), version)
+        self.assertEqual(s.attr_values('system'), [2])
+
+    def testLocalCommitsRevalidate(self):
+
+        s = clusto.get_by_name('s1')
+        cache.clock.interval = 60
+        self.assertEqual(s.attr_values('system'), [1])
+
+        clusto.get_by_name('s1').set_attr('system', 3, subkey='memory')
+        self.assertEqual(s.attr_values('system'), [3])
+
+    def testVersionedStore(self):
+
+        store = cache.VersionedStore()
+        store.set('foo', 'bar')
+        self.assertEqual(store.get('foo'), 'bar')
+
+        clusto.begin_transaction()
+        self.assertEqual(store.get('foo'), None)
+        clusto.rollback_transaction()
+
+        clusto.get_by_name('s1').add_attr('foo', 1)
+        self.assertEqual(store.get('foo'), None)
+
+        clusto.SESSION.clusto_versioning_enabled = False
+        try:
+            store.set('foo', 'bar')
+            self.assertEqual(store.get('foo'), None)
+        finally:
+            clusto.SESSION.clusto_versioning_enabled = True
@@ -0,0 +1,124 @@
+from clusto.test import testbase
+
+import clusto
+from clusto import closure
+from clusto.drivers import Driver, Pool, BasicRack, BasicServer
+from clusto.schema import ENTITY_CLOSURE_TABLE
+
+from sqlalchemy import select
+
+
+class TestClosure(testbase.ClustoTestBase):
+
+    def data(self):
+
+        p1 = Pool('p1')
+        p2 = Pool('p2')
+        d1 = Driver('d1')
+
+        p1.insert(p2)
+        p2.insert(d1)
+
+    def setUp(self):
+        testbase.ClustoTestBase.setUp(self)
+        clusto.SESSION.clusto_closure_enabled = True
+
+    def tearDown(self):
+        clusto.SESSION.clusto_closure_enabled = False
+        testbase.ClustoTestBase.tearDown(self)
+
+    def ids(self, *names):
+        return [clusto.get_by_name(n).entity.entity_id for n in names]
+
+    def rows(self):
+        c = ENTITY_CLOSURE_TABLE
+        query = select([c.c.ancestor_id, c.c.descendant_id, c.c.depth],
+                       c.c.deleted_at_version == None)
+        return sorted(tuple(row) for row in clusto.SESSION.execute(query))
+
+    def testRebuild(self):
+
+        p1, p2, d1 = self.ids('p1', 'p2', 'd1')
+
+        # the data was added before closure was enabled
+        self.assertEqual(self.rows(), [])
+        self.assertEqual(closure.check(),
+                         sorted([(p1, d1, 2, None), (p1, p2, 1, None),
+                                 (p2, d1, 1, None)]))
+
+        self.assertEqual(closure.rebuild(), 3)
+        self.assertEqual(self.rows(),
+                         sorted([(p1, d1, 2), (p1, p2, 1), (p2, d1, 1)]))
+        self.assertEqual(closure.check(), [])
+        self.assertEqual(closure.rebuild(), 0)
+
+    def testMaintained(self):
+
+        closure.rebuild()
+
+        p1, p2, d1 = map(clusto.get_by_name, ('p1', 'p2', 'd1'))
+        p3 = Pool('p3')
+        rack = BasicRack('r1')
+        s1 = BasicServer('s1')
+
+        p3.insert(p1)
+        rack.insert(s1, 5)
+        p2.insert(rack)
+        self.assertEqual(closure.check(), [])
+
+        names = lambda drivers: sorted(d.name for d in drivers)
+        self.assertEqual(names(p3.contents(search_children=True)),
+                         ['d1', 'p1', 'p2', 'r1', 's1'])
+        self.assertEqual([(d.name, depth) for d, depth in s1.ancestors()],
+                         [('r1', 1), ('p2', 2), ('p1', 3), ('p3', 4)])
+
+        p1.remove(p2)
+        self.assertEqual(closure.check(), [])
+        self.assertEqual(names(p3.contents(search_children=True)), ['p1'])
+
+        p1.insert(d1)
+        self.assertEqual(closure.check(), [])
+        self.assertEqual(names(p3.contents(search_children=True)),
+                         ['d1', 'p1'])
+
+        clusto.rename('p2', 'p4')
+        self.assertEqual(closure.check(), [])
+        self.assertEqual(names(s1.parents(search_parents=True)),
+                         ['p4', 'r1'])
+
+        rack.entity.delete()
+        self.assertEqual(closure.check(), [])
+        self.assertEqual(s1.parents(search_parents=True), [])
+
+        self.assertEqual(sorted(d.name for d in
+                                clusto.get_from_pools(['p4', 'p3'],
+                                                      operator='union')),
+                         ['d1', 'p1'])
+
+    def testLookups(self):
+
+        closure.rebuild()
+        p1, p2, d1 = self.ids('p1', 'p2', 'd1')
+
+        statements = self.count_statements()
+
+        self.assertEqual(clusto.containment.walk([p1]), [(p2, 1), (d1, 2)])
+        self.assertEqual(clusto.containment.walk([d1], up=True, max_depth=1),
+                         [(p2, 1)])
+        self.assertEqual(len(statements), 2)
+        self.assertTrue(all('entity_closure' in s for s in statements))
+
+    def testCycle(self):
+
+        closure.rebuild()
+        p1, p2 = map(clusto.get_by_name, ('p1', 'p2'))
+        p2.insert(p1)
+
+        p1_id, p2_id, d1_id = self.ids('p1', 'p2', 'd1')
+        self.assertEqual(closure.check(), [])
+        self.assertEqual(self.rows(),
+                         sorted([(p1_id, d1_id, 2), (p1_id, p2_id, 1),
+                                 (p2_id, d1_id, 1), (p2_id, p1_id, 1),
+                                 (p1_id, p1_id, 2), (p2_id, p2_id, 2)]))
+        self.assertEqual(clusto.containment.walk([p1_id]),
+                         [(p2_id, 1)] + sorted([(p1_id, 2), (d1_id, 2)]))
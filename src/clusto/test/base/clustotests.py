@@ -69,6 +69,106 @@ class TestClusto(testbase.ClustoTestBase):
                           clusto.get_by_name('e1')],
                          clusto.get_by_names(['e3', 'shouldfail', 'e1']))
 
+    def testGetByNamesChunked(self):
+
+        names = ['e3', 'e1', 'nope', 'e3', 'e2']
+        expected = [clusto.get_by_name('e3'), clusto.get_by_name('e1'), None,
+                    clusto.get_by_name('e3'), clusto.get_by_name('e2')]
+
+        self.assertEqual(clusto.get_by_names(names, chunk_size=2), expected)
+
+        results = clusto.iter_by_names(iter(names), chunk_size=2)
+        self.assertEqual(results.next(), expected[0])
+        self.assertEqual(list(results), expected[1:])
+
+
+    def testPrefetchAttrs(self):
+
+        servers = [BasicServer('s%d' % i) for i in range(10)]
+        for n, s in enumerate(servers):
+            s.add_attr('system', n, subkey='memory')
+            s.add_attr('disk', n * 10, number=0, subkey='size')
+            s.add_attr('description', 'server %d' % n)
+
+        servers = clusto.get_by_names(['s%d' % i for i in range(10)])
+        cache = clusto.attr_cache()
+
+        clusto.prefetch_attrs(servers, keys=['system', 'disk'], chunk_size=3)
+        misses = cache.misses
+        self.assertEqual([s.attr_value('system', subkey='memory') for s in servers],
+                         range(10))
+        self.assertEqual([s.attr_value('disk', subkey='size') for s in servers],
+                         [n * 10 for n in range(10)])
+        self.assertEqual(cache.misses, misses)
+
+        # keys that weren't prefetched still get looked up
+        self.assertEqual(servers[3].attr_values('description'), ['server 3'])
+        self.assertEqual(cache.misses, misses + 1)
+
+        clusto.prefetch_attrs(servers)
+        misses = cache.misses
+        self.assertEqual(len(servers[5].attrs()), 3)
+        self.assertEqual(cache.misses, misses)
+
+    def testPrefetchAttrsInvalidatedByWrites(self):
+
+        s1 = BasicServer('s1')
+        s1.add_attr('system', 1, subkey='memory')
+
+        clusto.prefetch_attrs([s1], keys=['system'])
+        s1.set_attr('system', 2, subkey='memory')
+
+        self.assertEqual(s1.attr_value('system', subkey='memory'), 2)
+
+    def testAttrRecords(self):
+
+        servers = [BasicServer('s%d' % i) for i in range(5)]
+        pool = Pool('p1')
+        for n, s in enumerate(servers):
+            s.add_attr('system', n, subkey='memory')
+            s.add_attr('owner', pool)
+            s.add_attr('info', {'n': n})
+
+        ids = [s.entity.entity_id for s in servers]
+        records = clusto.attr_records(ids)
+
+        self.assertEqual(sorted(records.keys()), sorted(ids))
+        for n, s in enumerate(servers):
+            values = dict((r.key, r.value) for r in records[s.entity.entity_id])
+            self.assertEqual(values, {'system': n, 'owner': pool,
+                                      'info': {'n': n}})
+
+        records = clusto.attr_records(ids, key='system')
+        self.assertEqual([[r.value for r in records[i]] for i in ids],
+                         [[n] for n in range(5)])
+
+    def testFlushSkippedWhenClean(self):
+
+        Driver('e4')
+        stats = clusto.flush_stats()
+        flushed, skipped = stats['flushed'], stats['skipped']
+
+        clusto.flush()
+        clusto.get_by_name('e1')
+        clusto.get_by_name('e4')
+
+        self.assertEqual(stats['flushed'], flushed)
+        self.assertTrue(stats['skipped'] >= skipped + 1)
+
+        clusto.get_by_name('e4').add_attr('foo', 1)
+        self.assertTrue(stats['flushed'] > flushed)
+
+    def testReadOnly(self):
+
+        with clusto.read_only():
+            self.assertFalse(clusto.SESSION().autoflush)
+            self.assertEqual(clusto.get_by_name('e1').name, 'e1')
+
+            # writes still go through
+            clusto.get_by_name('e2').add_attr('foo', 1)
+            self.assertEqual(clusto.get_by_name('e2').attr_values('foo'), [1])
+
+        self.assertTrue(clusto.SESSION().autoflush)
 
     def testSimpleRename(self):
 
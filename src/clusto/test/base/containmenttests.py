@@ -0,0 +1,120 @@
+from clusto.test import testbase
+
+import clusto
+from clusto import containment
+from clusto.containment import ContainmentIndex
+from clusto.drivers import Driver, Pool
+
+from sqlalchemy import select, literal
+
+
+
+class TestContainmentIndex(testbase.ClustoTestBase):
+
+    def data(self):
+
+        p1 = Pool('p1')
+        p2 = Pool('p2')
+        p3 = Pool('p3')
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+
+        p1.insert(p2)
+        p1.insert(p3)
+        p2.insert(d1)
+        p3.insert(d1)
+        p3.insert(d2)
+
+    def ids(self, *names):
+        return [clusto.get_by_name(n).entity.entity_id for n in names]
+
+    def testTree(self):
+
+        p1, p2, p3, d1, d2 = self.ids('p1', 'p2', 'p3', 'd1', 'd2')
+        index = ContainmentIndex()
+
+        self.assertEqual(sorted(index.children(p1)), sorted([p2, p3]))
+        self.assertEqual(sorted(index.parents(d1)), sorted([p2, p3]))
+        self.assertEqual(index.children(d1), [])
+        self.assertEqual(index.names[p2], 'p2')
+
+        self.assertEqual(index.subtree_size(p1), 4)
+        self.assertEqual(index.subtree_size(p3), 2)
+
+        self.assertEqual(index.ancestors(d2), [(p3, 1), (p1, 2)])
+        self.assertEqual(index.common_ancestors(d1, d2), [p3, p1])
+        self.assertEqual(index.common_ancestors(p2, d2), [p1])
+
+        driver = clusto.get_by_name('d1')
+        self.assertEqual(sorted(index.ancestors(d1)),
+                         sorted((d.entity.entity_id, depth)
+                                for d, depth in driver.ancestors()))
+
+    def testRefresh(self):
+
+        index = ContainmentIndex()
+
+        p2, p3 = clusto.get_by_name('p2'), clusto.get_by_name('p3')
+        d3 = Driver('d3')
+        p2.insert(d3)
+        p3.remove(clusto.get_by_name('d1'))
+
+        p1, p2, d1, d3 = self.ids('p1', 'p2', 'd1', 'd3')
+
+        statements = self.count_statements()
+
+        self.assertEqual(index.refresh(), 2)
+        self.assertEqual(len(statements), 3)
+
+        self.assertEqual(index.parents(d1), [p2])
+        self.assertEqual(index.ancestors(d3), [(p2, 1), (p1, 2)])
+        self.assertEqual(index.subtree_size(p1), 5)
+        self.assertEqual(index.names[d3], 'd3')
+
+        self.assertEqual(index.refresh(), 0)
+        self.assertEqual(len(statements), 4)
+
+    def testDuplicateEdges(self):
+
+        p3, d2 = clusto.get_by_name('p3'), clusto.get_by_name('d2')
+        p3.entity.add_attr('_contains', d2.entity)
+        clusto.flush()
+
+        p3_id, d2_id = self.ids('p3', 'd2')
+        index = ContainmentIndex()
+        self.assertEqual(index.children(p3_id).count(d2_id), 1)
+
+        # the other _contains attribute still holds d2
+        p3.attrs('_contains', d2)[0].delete()
+        clusto.flush()
+        index.refresh()
+        self.assertEqual(index.parents(d2_id), [p3_id])
+
+        p3.remove(d2)
+        index.refresh()
+        self.assertEqual(index.parents(d2_id), [])
+
+    def testInsertDuringBuild(self):
+
+        p1, d1 = clusto.get_by_name('p1'), clusto.get_by_name('d1')
+        version = clusto.SESSION.execute(clusto.latest_version()).scalar()
+
+        # the edge is committed after the index read the version, but before
+        # it read the edges
+        latest_version = containment.latest_version
+        def read_version():
+            p1.insert(d1)
+            return select([literal(version)])
+        containment.latest_version = read_version
+        try:
+            index = ContainmentIndex()
+        finally:
+            containment.latest_version = latest_version
+
+        p1_id, d1_id = self.ids('p1', 'd1')
+        index.refresh()
+        self.assertEqual(index.children(p1_id).count(d1_id), 1)
+
+        p1.remove(d1)
+        index.refresh()
+        self.assertFalse(d1_id in index.children(p1_id))
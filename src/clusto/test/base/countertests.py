@@ -1,8 +1,11 @@
 from clusto.test import testbase
 
+import clusto
 from clusto.schema import *
 from clusto.drivers.base import *
 
+from sqlalchemy.exc import IntegrityError
+
 class TestClustoCounter(testbase.ClustoTestBase):
 
     def testCounterDefault(self):
@@ -44,3 +47,76 @@ class TestClustoCounter(testbase.ClustoTestBase):
         f = Counter.get(e, 'key2', default=20)
         self.assertEqual(f.value, 20)
 
+
+    def testReserve(self):
+
+        e = Entity('e1')
+
+        self.assertEqual(Counter.reserve(e, 'key1', 5), 0)
+        self.assertEqual(Counter.reserve(e, 'key1', 2), 5)
+        self.assertEqual(Counter.get(e, 'key1').value, 7)
+
+        self.assertEqual(Counter.take(e, 'key2', 3, default=10), [10, 11, 12])
+        self.assertEqual(Counter.get(e, 'key2').value, 13)
+
+    def testUniqueCounter(self):
+
+        e = Entity('e1')
+        Counter(e, 'key1')
+
+        self.assertRaises(IntegrityError, Counter, e, 'key1')
+        SESSION.rollback()
+
+    def testTakeBlocks(self):
+
+        e = Entity('e1')
+        SESSION.clusto_counter_block_size = 10
+        try:
+            self.assertEqual(Counter.take(e, 'key1'), [0])
+            self.assertEqual(Counter.get(e, 'key1').value, 10)
+
+            statements = self.count_statements()
+
+            self.assertEqual(Counter.take(e, 'key1', 2), [1, 2])
+            self.assertEqual(statements, [])
+
+            # a block too short for the request is abandoned
+            self.assertEqual(Counter.take(e, 'key1', 8), range(10, 18))
+            self.assertEqual(Counter.take(e, 'key1', 20), range(20, 40))
+            self.assertEqual(Counter.take(e, 'key1'), [18])
+        finally:
+            SESSION.clusto_counter_block_size = 1
+            Counter.blocks.clear()
+
+    def testBlockRolledBack(self):
+
+        e = Entity('e1')
+        SESSION.clusto_counter_block_size = 10
+        try:
+            clusto.begin_transaction()
+            self.assertEqual(Counter.take(e, 'key1', default=5), [5])
+            clusto.rollback_transaction()
+
+            self.assertEqual(Counter.take(e, 'key1', default=5), [5])
+            self.assertEqual(Counter.take(e, 'key1', default=5), [6])
+        finally:
+            SESSION.clusto_counter_block_size = 1
+            Counter.blocks.clear()
+
+    def testNumberedAttrBlocks(self):
+
+        d = Driver('d1')
+        SESSION.clusto_counter_block_size = 10
+        try:
+            d.add_attr('foo', 'a', number=True)
+            d.add_attr('foo', 'b', number=True)
+            d.set_attrs({('bar', True, None): 'c'})
+            self.assertEqual(sorted(a.number for a in d.attrs('foo')), [0, 1])
+            self.assertEqual([a.number for a in d.attrs('bar')], [0])
+
+            # the counters hold the last number of their blocks
+            self.assertEqual(Counter.get(d.entity, 'foo').value, 9)
+            self.assertEqual(Counter.get(d.entity, 'bar').value, 9)
+        finally:
+            SESSION.clusto_counter_block_size = 1
+            Counter.blocks.clear()
@@ -5,11 +5,13 @@ Test the basic Driver object
 from clusto.test import testbase
 
 import clusto
+from clusto import containment
 from clusto.drivers.base import Driver
 from clusto.drivers import Pool
 from clusto.exceptions import DriverException, NameException
 
 
+
 class TestDriverAttributes(testbase.ClustoTestBase):
 
     def testSetAttrs(self):
@@ -293,6 +295,75 @@ class TestDriverAttributes(testbase.ClustoTestBase):
         self.assertEqual(version+1, clusto.get_latest_version_number())
 
 
+    def testAddAttrs(self):
+
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+
+        version = clusto.get_latest_version_number()
+
+        d1.add_attrs([('foo', 'bar'),
+                      ('foo', 'bar1', True),
+                      dict(key='foo', value='bar2', number=True),
+                      dict(key='baz', value=d2, subkey='rel'),
+                      dict(key='num', value=3, number=7, subkey='x')])
+
+        self.assertEqual(version + 1, clusto.get_latest_version_number())
+        self.assertEqual(sorted(d1.attr_items()),
+                         sorted([(('foo', None, None), 'bar'),
+                                 (('foo', 0, None), 'bar1'),
+                                 (('foo', 1, None), 'bar2'),
+                                 (('baz', None, 'rel'), d2),
+                                 (('num', 7, 'x'), 3)]))
+
+        d1.add_attr('foo', 'bar3', number=True)
+        self.assertEqual(d1.attr_values('foo', number=2), ['bar3'])
+
+    def testAddAttrsValidatesFirst(self):
+
+        d1 = Driver('d1')
+
+        self.assertRaises(NameException, d1.add_attrs,
+                          [('foo', 'bar'), ('bad.key', 'bar')])
+        self.assertEqual(d1.attrs(), [])
+
+    def testSetAttrsBatch(self):
+
+        d1 = Driver('d1')
+        d1.add_attr('system', 1024, subkey='memory')
+        d1.add_attr('system', 'P01', subkey='serial')
+        d1.add_attr('disk', 100, number=0, subkey='size')
+        d1.add_attr('disk', 200, number=1, subkey='size')
+
+        version = clusto.get_latest_version_number()
+
+        d1.set_attrs({('system', 'memory'): 2048,
+                      ('system', 'serial'): 'P01',
+                      ('disk', 0, 'size'): 100,
+                      'foo': 'bar'},
+                     replace_keys=['disk'])
+
+        self.assertEqual(version + 1, clusto.get_latest_version_number())
+        self.assertEqual(sorted(d1.attr_items()),
+                         sorted([(('system', None, 'memory'), 2048),
+                                 (('system', None, 'serial'), 'P01'),
+                                 (('disk', 0, 'size'), 100),
+                                 (('foo', None, None), 'bar')]))
+
+        d1.set_attrs({'foo': 'bar'})
+        self.assertEqual(version + 1, clusto.get_latest_version_number())
+
+    def testSetAttrsMultipleMatches(self):
+
+        d1 = Driver('d1')
+        d1.add_attr('foo', 'bar')
+        d1.add_attr('foo', 'baz')
+
+        self.assertRaises(DriverException, d1.set_attrs,
+                          {'foo': 'qux', 'other': 1})
+        self.assertEqual(d1.attr_values('other'), [])
+
+
 class TestDriverContainerFunctions(testbase.ClustoTestBase):
 
     def testInsert(self):
@@ -367,6 +438,56 @@ class TestDriverContainerFunctions(testbase.ClustoTestBase):
         self.assertEqual(sorted([p2, d1, d2, d3]),
                          sorted(p1.contents(search_children=True)))
 
+    def testSearchChildrenRecursive(self):
+
+        pools = [Pool('p%d' % i) for i in range(5)]
+        for parent, child in zip(pools, pools[1:]):
+            parent.insert(child)
+
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+        pools[4].insert(d1)
+        pools[2].insert(d2)
+        # reachable along two paths and around a cycle
+        pools[1].insert(d1)
+        pools[4].insert(pools[0])
+        # loaded now so that only the search gets counted
+        pools[0].entity.entity_id
+
+        statements = self.count_statements()
+
+        contents = pools[0].contents(search_children=True)
+
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(contents[:3], [pools[1], pools[2], d1])
+        self.assertEqual(sorted(contents), sorted(pools + [d1, d2]))
+        self.assertEqual(sorted(pools[0].contents(clusto_types=[Pool],
+                                                  search_children=True)),
+                         sorted(pools))
+        self.assertEqual(sorted(pools[2].contents(clusto_drivers=[Driver],
+                                                  search_children=True)),
+                         sorted([d1, d2]))
+
+    def testSearchChildrenVersions(self):
+
+        p1 = Pool('p1')
+        p2 = Pool('p2')
+        d1 = Driver('d1')
+        p1.insert(p2)
+        p2.insert(d1)
+
+        version = clusto.get_latest_version_number()
+        p2.remove(d1)
+
+        self.assertEqual(p1.contents(search_children=True), [p2])
+
+        clusto.SESSION.clusto_version = version
+        try:
+            self.assertEqual(sorted(p1.contents(search_children=True)),
+                             sorted([p2, d1]))
+        finally:
+            clusto.SESSION.clusto_version = None
+
     def testMultipleInserts(self):
 
         d1 = Driver('d1')
@@ -419,6 +540,71 @@ class TestDriverContainerFunctions(testbase.ClustoTestBase):
         self.assertEqual(['someval'],
                          d3.attr_values('foo', merge_container_attrs=True))
 
+    def testAncestors(self):
+
+        p1 = Pool('p1')
+        p2 = Pool('p2')
+        p3 = Pool('p3')
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+
+        p1.insert(p2)
+        p2.insert(p3)
+        p3.insert(d2)
+        d2.insert(d1)
+        p1.insert(d1)
+        # p1 is in p3, which is in p1
+        p3.insert(p1)
+
+        expected = [(p1, 1), (d2, 1), (p3, 2), (p2, 3)]
+
+        self.assertEqual(d1.ancestors(), expected)
+        self.assertEqual(d1.ancestors(clusto_types=[Pool]),
+                         [(p1, 1), (p3, 2), (p2, 3)])
+        self.assertEqual(d1.ancestors(clusto_drivers=[Driver]), [(d2, 1)])
+        self.assertEqual(d1.ancestors(max_depth=2), expected[:3])
+        self.assertEqual(sorted(d1.parents(search_parents=True)),
+                         sorted([p1, p2, p3, d2]))
+
+        recursive = containment.recursive_queries
+        containment.recursive_queries = lambda: False
+        try:
+            self.assertEqual(d1.ancestors(), expected)
+            self.assertEqual(d1.ancestors(clusto_types=[Pool],
+                                          through_types=[Pool]),
+                             [(p1, 1), (p3, 2), (p2, 3)])
+        finally:
+            containment.recursive_queries = recursive
+
+    def testEffectiveAttrs(self):
+
+        p1 = Pool('p1')
+        p2 = Pool('p2')
+        d1 = Driver('d1')
+        p1.insert(p2)
+        p2.insert(d1)
+
+        p1.add_attr('dhcp', 1, subkey='enabled')
+        p1.add_attr('dhcp', 'p1-server', subkey='server')
+        p1.add_attr('other', 'p1')
+        p2.add_attr('dhcp', 0, subkey='enabled')
+        d1.add_attr('dhcp', 'd1-server', subkey='server')
+        d1 = clusto.get_by_name('d1')
+
+        self.assertEqual([(a.subkey, a.value) for a in
+                          d1.effective_attrs('dhcp', sort_by_keys=False)],
+                         [('server', 'd1-server'), ('enabled', 0),
+                          ('enabled', 1), ('server', 'p1-server')])
+        self.assertEqual(d1.attr_value('dhcp', subkey='enabled',
+                                       merge_container_attrs=True), 0)
+
+        statements = self.count_statements()
+
+        # the ancestors are remembered, only the attributes are read
+        self.assertEqual([a.value for a in d1.attrs(merge_container_attrs=True)],
+                         ['d1-server', 0, 1, 'p1-server', 'p1'])
+        self.assertEqual(len(statements), 1)
+
 
 class TestDriver(testbase.ClustoTestBase):
 
@@ -485,6 +671,31 @@ class TestDriverProperties(testbase.ClustoTestBase):
         self.assertEqual(d2.propB, 'cat')
         self.assertEqual(d.propB, 'bar')
 
+    def testPropertiesReadInOneQuery(self):
+
+        d = ATestDriver('d')
+        d.propA = 'foo'
+        d.propC = 10
+
+        # not the commit count checks of the cache
+        statements = self.count_statements(
+            lambda statement: statement.startswith('SELECT')
+                              and 'commit_counter' not in statement)
+
+        d = clusto.get_by_name('d')
+        statements[:] = []
+
+        self.assertEqual((d.propA, d.propB, d.propC), ('foo', 'foo', 10))
+        self.assertEqual((d.propA, d.propB, d.propC), ('foo', 'foo', 10))
+        self.assertEqual(len(statements), 1)
+
+        d.propB = 'bar'
+        self.assertEqual((d.propA, d.propB, d.propC), ('foo', 'bar', 10))
+
+        other = clusto.get_by_name('d')
+        other.set_attr('propC', 20, subkey='property')
+        self.assertEqual(d.propC, 20)
+
 
 class TestDriverQueries(testbase.ClustoTestBase):
 
@@ -552,3 +763,188 @@ class TestDriverQueries(testbase.ClustoTestBase):
         d2 = clusto.get_by_name('d2')
         self.assertEqual(set(Driver.get_by_attr(key='a*', glob=True)),
                          set([d1, d2]))
+
+    def testAttrsQueryMatchesFilter(self):
+
+        d1 = clusto.get_by_name('d1')
+        d2 = clusto.get_by_name('d2')
+        cache = clusto.attr_cache()
+
+        filters = [dict(key='a'),
+                   dict(key='a', subkey='z'),
+                   dict(key='a', subkey=None),
+                   dict(number=True),
+                   dict(number=False),
+                   dict(key='a', number=5),
+                   dict(value=1),
+                   dict(value='dee'),
+                   dict(value=d2),
+                   dict(key='_foo'),
+                   dict(key='car', ignore_hidden=False),
+                   dict(key='a.*', regex=True),
+                   dict(key='d', regex=True),
+                   dict(key='d2', clusto_drivers=[Driver]),
+                   dict(key='d3', clusto_types=['pool']),
+                   dict(key='a', sort_by_keys=False),
+                   ]
+
+        for kwargs in filters:
+            cache.invalidate()
+            queried = d1.attrs(**kwargs)
+            self.assertFalse(d1.entity.entity_id in cache)
+
+            filtered = Driver.attr_filter(d1.entity.attrs, **kwargs)
+            self.assertEqual([a.attr_id for a in queried],
+                             [a.attr_id for a in filtered])
+
+    def testAttrRecordsMatchAttrs(self):
+
+        d1 = clusto.get_by_name('d1')
+        d2 = clusto.get_by_name('d2')
+
+        filters = [dict(),
+                   dict(key='a'),
+                   dict(key='a', subkey=None),
+                   dict(key='a', number=5),
+                   dict(value=d2),
+                   dict(key='_foo'),
+                   dict(key='a.*', regex=True),
+                   dict(key='d3', clusto_types=['pool']),
+                   dict(key='a', sort_by_keys=False),
+                   ]
+
+        for kwargs in filters:
+            records = d1.attr_records(**kwargs)
+            attrs = d1.attrs(**kwargs)
+            self.assertEqual([r.attr_id for r in records],
+                             [a.attr_id for a in attrs])
+            self.assertEqual([r.to_tuple for r in records],
+                             [a.to_tuple for a in attrs])
+
+    def testAttrRecordsReadOnly(self):
+
+        d1 = clusto.get_by_name('d1')
+        record = d1.attr_records('d2')[0]
+
+        self.assertEqual(record.value, clusto.get_by_name('d2'))
+        self.assertTrue(record.is_relation)
+        self.assertRaises(AttributeError, setattr, record, 'value', 1)
+        self.assertRaises(AttributeError, setattr, record, 'foo', 1)
+
+    def testAttrsQueryCached(self):
+
+        d1 = clusto.get_by_name('d1')
+        cache = clusto.attr_cache()
+        cache.invalidate()
+        misses = cache.misses
+
+        d1.attrs('a', subkey='z')
+        d1.attrs('a', subkey='z')
+
+        self.assertEqual(cache.misses, misses + 1)
+
+
+class TestAttributeCache(testbase.ClustoTestBase):
+
+    def data(self):
+
+        d1 = Driver('d1')
+        d1.add_attr('foo', 'bar')
+        d1.add_attr('foo', 'baz', number=1)
+
+    def testRepeatedReadsHitCache(self):
+
+        d1 = clusto.get_by_name('d1')
+        cache = clusto.attr_cache()
+        misses = cache.misses
+        hits = cache.hits
+
+        d1.attrs()
+        d1.attrs('foo')
+        d1.attr_values('foo', number=1)
+
+        self.assertEqual(cache.misses, misses + 1)
+        self.assertEqual(cache.hits, hits + 2)
+
+    def testAddAttrInvalidates(self):
+
+        d1 = clusto.get_by_name('d1')
+
+        try:
+            clusto.begin_transaction()
+            self.assertEqual(len(d1.attrs('foo')), 2)
+            d1.add_attr('foo', 'qux', number=2)
+            self.assertEqual(len(d1.attrs('foo')), 3)
+            d1.del_attrs('foo', number=1)
+            self.assertEqual(len(d1.attrs('foo')), 2)
+            clusto.commit()
+        except:
+            clusto.rollback_transaction()
+            raise
+
+        self.assertEqual(sorted(d1.attr_values('foo')), ['bar', 'qux'])
+
+    def testRollbackInvalidates(self):
+
+        d1 = clusto.get_by_name('d1')
+
+        clusto.begin_transaction()
+        d1.add_attr('foo', 'qux', number=2)
+        self.assertEqual(len(d1.attrs('foo')), 3)
+        clusto.rollback_transaction()
+
+        self.assertEqual(clusto.attr_cache().stats()['entries'], 0)
+        self.assertEqual(len(d1.attrs('foo')), 2)
+
+    def testUnversionedNotCachedOutsideTransactions(self):
+
+        d1 = clusto.get_by_name('d1')
+        cache = clusto.attr_cache()
+
+        clusto.SESSION.clusto_versioning_enabled = False
+        try:
+            # other processes' writes can't be noticed without versions
+            d1.attrs('foo')
+            d1.attrs('foo')
+            self.assertEqual(cache.stats()['entries'], 0)
+
+            clusto.begin_transaction()
+            d1.attrs('foo')
+            hits = cache.hits
+            d1.attrs('foo')
+            self.assertEqual(cache.hits, hits + 1)
+            clusto.rollback_transaction()
+            self.assertEqual(cache.stats()['entries'], 0)
+        finally:
+            clusto.SESSION.clusto_versioning_enabled = True
+
+    def testNewCommitDropsEntries(self):
+
+        d1 = clusto.get_by_name('d1')
+        cache = clusto.attr_cache()
+
+        interval = clusto.cache.clock.interval
+        clusto.cache.clock.interval = 0
+        try:
+            d1.attrs('foo')
+            self.assertTrue(cache.stats()['entries'] > 0)
+
+            # another process committing moves the commit count
+            clusto.count_commit(clusto.SESSION())
+            d1.attrs('foo')
+            self.assertEqual(cache.stats()['entries'], 1)
+        finally:
+            clusto.cache.clock.interval = interval
+
+    def testCacheSize(self):
+
+        cache = clusto.attr_cache()
+        cache.size = 3
+        try:
+            for entity_id in range(5):
+                cache.set(entity_id, [])
+            self.assertEqual(cache.stats()['entries'], 3)
+            self.assertEqual(cache.get(0), None)
+            self.assertEqual(cache.get(4), [])
+        finally:
+            del cache.size
@@ -0,0 +1,10 @@
+"""Benchmarks
+
+These aren't part of the default test run, run them with
+
+  python clusto/test/alltests.py clusto.test.benchmarks
+"""
+
+from getbynames import *
+from counters import *
+from allocation import *
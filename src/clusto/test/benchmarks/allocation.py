@@ -0,0 +1,26 @@
+from clusto.test.usage import allocationusage
+
+import clusto
+
+import sys
+
+
+class BenchmarkAllocationLocking(allocationusage.AllocationLockingTest):
+
+    allocations = 50
+    delay = 0
+
+    def testCollisionsWithoutLocking(self):
+        pass
+
+    def testNoDuplicates(self):
+
+        clusto.SESSION.clusto_allocation_locking = True
+        found, errors, elapsed = self.run_threads()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(set(found)), len(found))
+
+        print >>sys.stderr
+        print >>sys.stderr, '%d allocations in %.3fs, %.1f/s' % (
+            len(found), elapsed, len(found) / elapsed)
@@ -0,0 +1,97 @@
+from clusto.test import testbase
+
+import clusto
+from clusto.schema import Counter, Entity, OperationalError
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+
+class BenchmarkCounterContention(testbase.ClustoTestBase):
+
+    threads = 4
+    values = 200
+    block_sizes = (1, 10, 100)
+
+    def setUp(self):
+
+        self.dsn = testbase.DB
+        self.path = None
+        if self.dsn == 'sqlite:///:memory:':
+            # every thread has its own connection, they have to share a file
+            fd, self.path = tempfile.mkstemp(suffix='.db')
+            os.close(fd)
+            testbase.DB = 'sqlite:///' + self.path
+
+        testbase.ClustoTestBase.setUp(self)
+
+    def tearDown(self):
+
+        clusto.SESSION.clusto_counter_block_size = 1
+        try:
+            testbase.ClustoTestBase.tearDown(self)
+        finally:
+            testbase.DB = self.dsn
+            if self.path:
+                os.remove(self.path)
+
+    def data(self):
+
+        Entity('counters')
+
+    def take(self, entity_id, key, found, conflicts):
+
+        entity = clusto.SESSION.query(Entity).get(entity_id)
+        try:
+            for i in xrange(self.values):
+                while True:
+                    try:
+                        found.extend(Counter.take(entity, key))
+                        break
+                    except OperationalError:
+                        # sqlite's "database is locked", MySQL's deadlocks
+                        conflicts.append(1)
+                        clusto.SESSION.rollback()
+                        time.sleep(0.001)
+        finally:
+            clusto.SESSION.close()
+
+    def run_threads(self, key):
+
+        entity_id = clusto.get_entities(names=['counters'])[0].entity.entity_id
+        found = []
+        conflicts = []
+        threads = [threading.Thread(target=self.take,
+                                    args=(entity_id, key, found, conflicts))
+                   for i in range(self.threads)]
+
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        return found, len(conflicts), elapsed
+
+    def testBlocks(self):
+
+        results = []
+        for size in self.block_sizes:
+            clusto.SESSION.clusto_counter_block_size = size
+            found, conflicts, elapsed = self.run_threads('block%d' % size)
+
+            # no value is handed out twice
+            self.assertEqual(len(found), self.threads * self.values)
+            self.assertEqual(len(set(found)), len(found))
+            results.append((size, elapsed, conflicts))
+
+        print >>sys.stderr
+        print >>sys.stderr, '%8s %10s %12s %10s' % ('block', 'seconds',
+                                                   'values/s', 'conflicts')
+        for size, elapsed, conflicts in results:
+            print >>sys.stderr, '%8d %10.3f %12.1f %10d' % (
+                size, elapsed, self.threads * self.values / elapsed, conflicts)
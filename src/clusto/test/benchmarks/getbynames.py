@@ -0,0 +1,55 @@
+from clusto.test import testbase
+
+import clusto
+from clusto.schema import ENTITY_TABLE
+
+import random
+import sys
+import time
+
+
+class BenchmarkGetByNames(testbase.ClustoTestBase):
+
+    sizes = (1000, 2000, 4000, 8000, 16000)
+
+    def data(self):
+
+        clusto.SESSION.execute(ENTITY_TABLE.insert(),
+                               [{'name': u'host%05d' % i,
+                                 'driver': 'basicserver',
+                                 'type': 'server',
+                                 'version': 1}
+                                for i in xrange(max(self.sizes))])
+
+    def timeit(self, func, names, repeat=3):
+
+        best = None
+        for i in range(repeat):
+            clusto.clear()
+            start = time.time()
+            func(names)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def testLinearScaling(self):
+
+        results = []
+        for size in self.sizes:
+            names = [u'host%05d' % i for i in xrange(size)]
+            random.shuffle(names)
+            elapsed = self.timeit(clusto.get_by_names, names)
+            results.append((size, elapsed))
+
+        print >>sys.stderr
+        print >>sys.stderr, '%8s %10s %12s' % ('names', 'seconds', 'us/name')
+        for size, elapsed in results:
+            print >>sys.stderr, '%8d %10.3f %12.1f' % (size, elapsed,
+                                                       elapsed * 1e6 / size)
+
+        # quadratic behaviour would make the per name cost grow with size
+        smallest, largest = results[0], results[-1]
+        self.assertTrue(largest[1] / largest[0] < 3 * smallest[1] / smallest[0])
+
+        names = [u'host%05d' % i for i in xrange(max(self.sizes))]
+        self.assertTrue(None not in clusto.get_by_names(names))
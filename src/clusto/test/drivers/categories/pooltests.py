@@ -5,6 +5,11 @@ from clusto.test import testbase
 from clusto.drivers import *
 from clusto.exceptions import PoolException
 
+
+class ATestUniquePool(UniquePool):
+    _driver_name = "atestuniquepool"
+
+
 class PoolTests(testbase.ClustoTestBase):
 
     def data(self):
@@ -118,7 +123,7 @@ class PoolTests(testbase.ClustoTestBase):
         clusto.flush()
 
         self.assertEqual([x.name for x in Pool.get_pools(d1)],
-                         [u'A', u'B', u'C', u'A1', u'B2', u'B1', u'A1', u'C1'])
+                         [u'A', u'B', u'C', u'A1', u'B2', u'B1', u'C1'])
 
         self.assertEqual([x.name for x in Pool.get_pools(d1, allPools=False)],
                          [u'A', u'B', u'C'])
@@ -242,6 +247,68 @@ class PoolTests(testbase.ClustoTestBase):
         # lax joining in get_from_entities should return an empty list in this case because s1 has no children
         self.assertEqual([], sorted(clusto.get_from_entities(['p1', 's1'])))
 
+    def testGetFromPoolsOperators(self):
+        p1 = clusto.get_by_name('p1')
+        p2 = Pool('p2')
+        p3 = Pool('p3')
+
+        s1 = BasicServer('s1')
+        s2 = BasicServer('s2')
+        s3 = BasicServer('s3')
+        d1 = clusto.get_by_name('d1')
+
+        p1.insert(s1)
+        p1.insert(p3)
+        p3.insert(s2)
+        p3.insert(d1)
+        p2.insert(s2)
+        p2.insert(s3)
+
+        def names(**kwargs):
+            return sorted(x.name for x in
+                          clusto.get_from_pools(['p1', p2], **kwargs))
+
+        self.assertEqual(names(), ['s2'])
+        self.assertEqual(names(operator='union'),
+                         ['d1', 'p3', 's1', 's2', 's3'])
+        self.assertEqual(names(operator='union', clusto_types=[BasicServer]),
+                         ['s1', 's2', 's3'])
+        self.assertEqual(names(operator='difference'), ['d1', 'p3', 's1'])
+        self.assertEqual(names(operator='difference', search_children=False),
+                         ['p3', 's1'])
+        self.assertEqual(names(search_children=False), [])
+
+        self.assertEqual(sorted(clusto.get_from_pools([p2, 'p1'],
+                                                      operator='difference')),
+                         [s3])
+        self.assertEqual(sorted(clusto.get_from_pools([p2, p2],
+                                                      operator='difference')),
+                         [s2, s3])
+
+        recursive = clusto.containment.recursive_queries
+        clusto.containment.recursive_queries = lambda: False
+        try:
+            self.assertEqual(names(operator='difference'), ['d1', 'p3', 's1'])
+            self.assertEqual(sorted(clusto.get_from_pools(
+                                 [p2, p2], operator='difference')),
+                             [s2, s3])
+            self.assertEqual(names(clusto_types=[BasicServer]), ['s2'])
+        finally:
+            clusto.containment.recursive_queries = recursive
+
+        self.assertRaises(ValueError, clusto.get_from_pools, [p1, p2],
+                          operator='xor')
+
+    def testUniquePool(self):
+
+        d1 = clusto.get_by_name('d1')
+        UniquePool('u1').insert(d1)
+        self.assertRaises(PoolException, UniquePool('u2').insert, d1)
+
+        # subclasses are unique among their own kind
+        ATestUniquePool('t1').insert(d1)
+        self.assertRaises(PoolException, ATestUniquePool('t2').insert, d1)
+
     def testPoolDelete(self):
 
         p5 = Pool('p5')
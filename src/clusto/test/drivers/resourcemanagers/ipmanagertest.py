@@ -1,8 +1,13 @@
 
 import clusto
+import clusto.cache
+import IPy
 from clusto.test import testbase
 
 from clusto.drivers import IPManager, BasicServer, ResourceTypeException, ResourceException
+from clusto.drivers.resourcemanagers.ipmanager import SubnetIndex
+from clusto.exceptions import ResourceNotAvailableException
+
 
 
 class IPManagerTest(testbase.ClustoTestBase):
@@ -57,6 +62,10 @@ class IPManagerTest(testbase.ClustoTestBase):
         self.assertEqual([ip4], IPManager.get_ip_managers('172.16.0.2'))
         self.assertEqual([], IPManager.get_ip_managers('192.168.40.1'))
 
+        # IPy gives longs for many addresses
+        num = long(IPManager._ipy_to_int(IPy.IP('172.16.40.2')))
+        self.assertEqual([ip3, ip4], IPManager.get_ip_managers(num))
+
     def testGetIP(self):
 
         ip1, ip2, s1 = map(clusto.get_by_name, ['a1', 'b1', 's1'])
@@ -82,3 +91,181 @@ class IPManagerTest(testbase.ClustoTestBase):
 
         self.assertEqual(str(s1.attr_value(key='ip', subkey='ipstring')), '192.168.1.20')
         self.assertEqual(str(s1.attr_value(key='ip', subkey='cidr')), '192.168.1.20/24')
+
+    def testAllocatorNearlyFull(self):
+
+        ip1, s1 = map(clusto.get_by_name, ['a1', 's1'])
+
+        ip1.allocate_many([s1] * 252)
+        self.assertEqual(len(ip1.allocated()), 252)
+
+        statements = self.count_statements(
+            lambda statement: 'int_value >=' in statement
+                              or 'int_value =' in statement)
+
+        # one range query instead of an availability check per candidate
+        ip1.allocate(s1)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(ip1.owners('192.168.1.254'), [s1])
+
+        self.assertRaises(ResourceNotAvailableException, ip1.allocate, s1)
+
+    def testAllocatorWrapsAround(self):
+
+        ip1, s1 = map(clusto.get_by_name, ['a1', 's1'])
+        s2 = BasicServer('s2')
+
+        ip1.allocate_many([s1] * 10)
+        ip1.deallocate(s1, '192.168.1.3')
+
+        # the gateway (192.168.1.1) is skipped
+        self.assertEqual(ip1.allocated(),
+                         [ip1.ensure_type('192.168.1.%d' % i)[0]
+                          for i in [2] + range(4, 12)])
+
+        ip1.allocate(s2)
+        self.assertEqual(IPManager.get_ips(s2), ['192.168.1.12'])
+
+        ip1.allocate_many([s2] * 242)
+        ip1.allocate(s2)
+        self.assertEqual(len(IPManager.get_ips(s2)), 244)
+        self.assertEqual(ip1.owners('192.168.1.3'), [s2])
+
+    def testAllocateMany(self):
+
+        ip2, s1 = map(clusto.get_by_name, ['b1', 's1'])
+        s2 = BasicServer('s2')
+
+        ip2.allocate(s1, '10.0.128.3')
+        attrs = ip2.allocate_many([s1, s2, s2])
+
+        self.assertEqual([a.entity.name for a in attrs], ['s1', 's2', 's2'])
+        self.assertEqual(sorted(IPManager.get_ips(s2)),
+                         ['10.0.128.4', '10.0.128.5'])
+        self.assertEqual(str(s2.attr_value(key='ip', subkey='ipstring',
+                                           number=attrs[1].number)),
+                         '10.0.128.4')
+        self.assertEqual(ip2.allocate_many([]), [])
+
+        # nothing is allocated when there aren't enough ips
+        c1 = clusto.get_by_name('c1')
+        self.assertRaises(ResourceNotAvailableException, c1.allocate_many,
+                          [s1] * 255)
+        self.assertEqual(c1.allocated(), [])
+
+    def testSubnetIndex(self):
+
+        ip1, ip3, ip4 = map(clusto.get_by_name, ['a1', 'c1', 'c2'])
+        clusto.cache.clock.interval = 60
+        try:
+            self.assertEqual(IPManager.get_ip_managers('172.16.40.2'),
+                             [ip3, ip4])
+
+            statements = self.count_statements()
+
+            self.assertEqual(IPManager.get_ip_managers('172.16.41.2'), [ip4])
+            self.assertEqual(IPManager.get_ip_manager('192.168.1.23'), ip1)
+            self.assertEqual(IPManager.get_ip_managers('172.16.40.0/25'),
+                             [ip3, ip4])
+            self.assertEqual(IPManager.get_ip_managers('172.16.0.0/15'), [])
+            self.assertEqual(IPManager.get_ip_managers('not an ip'), [])
+            self.assertEqual(statements, [])
+
+            # changes are picked up with the next version
+            ip5 = IPManager('c3', baseip='172.16.40.0', netmask='255.255.255.128')
+            self.assertEqual(IPManager.get_ip_managers('172.16.40.2'),
+                             [ip5, ip3, ip4])
+            ip3.baseip = '172.16.41.0'
+            self.assertEqual(IPManager.get_ip_managers('172.16.41.2'),
+                             [ip3, ip4])
+            self.assertEqual(ip3.ipy.strNormal(), '172.16.41.0/24')
+        finally:
+            clusto.cache.clock.interval = 1.0
+
+    def testSubnetIndexNesting(self):
+
+        index = SubnetIndex([(0, 255, 1), (0, 127, 2), (128, 255, 3),
+                             (130, 131, 4), (300, 400, 5), (0, 1000, 6)])
+
+        self.assertEqual(index.find(5), [2, 1, 6])
+        self.assertEqual(index.find(131), [4, 3, 1, 6])
+        self.assertEqual(index.find(132), [3, 1, 6])
+        self.assertEqual(index.find(256), [6])
+        self.assertEqual(index.find(128, 255), [3, 1, 6])
+        self.assertEqual(index.find(1001), [])
+        self.assertEqual(index.find(-1), [])
+
+    def testUtilization(self):
+
+        ip1, s1 = map(clusto.get_by_name, ['a1', 's1'])
+        s2 = BasicServer('s2')
+
+        ip1.allocate(s1)
+        ip1.allocate(s1)
+        ip1.allocate(s2, '192.168.1.10')
+
+        usage = ip1.utilization()
+        self.assertEqual(usage['size'], 254)
+        self.assertEqual(usage['used'], 3)
+        # the gateway can't be allocated either
+        self.assertEqual(usage['free'], 250)
+        self.assertEqual(usage['free_blocks'], 2)
+        self.assertEqual(usage['largest_free_block'], 244)
+        self.assertAlmostEqual(usage['utilization'], 400.0 / 254)
+
+        self.assertEqual(ip1.stats(), {'count': 3, 'things': 2})
+        self.assertEqual(ip1.count, 3)
+
+        self.assertRaises(ResourceTypeException,
+                          IPManager('nobase').utilization)
+
+    def testUtilizationReport(self):
+
+        ip1, ip3, s1 = map(clusto.get_by_name, ['a1', 'c1', 's1'])
+        ip1.allocate(s1)
+        ip3.allocate(s1, '172.16.40.5')
+        IPManager('nobase')
+
+        statements = self.count_statements()
+
+        report = IPManager.utilization_report()
+        self.assertEqual(len(statements), 4)
+
+        self.assertEqual([(r['name'], r['network']) for r in report],
+                         [('b1', '10.0.128.0/22'), ('c2', '172.16.0.0/16'),
+                          ('c1', '172.16.40.0/24'), ('a1', '192.168.1.0/24')])
+
+        b1, c2, c1, a1 = report
+        self.assertEqual((b1['size'], b1['used'], b1['count']), (1022, 0, 0))
+        self.assertEqual(b1['free'], 1021)
+        # c1's address is inside c2's range, but was allocated from c1
+        self.assertEqual((c2['used'], c2['count'], c2['things']), (1, 0, 0))
+        self.assertEqual((c1['used'], c1['count'], c1['things']), (1, 1, 1))
+        self.assertEqual((c1['free'], c1['free_blocks']), (253, 2))
+        self.assertEqual((a1['used'], a1['free'], a1['count']), (1, 252, 1))
+        self.assertEqual(a1, dict(ip1.utilization(), name='a1',
+                                  network='192.168.1.0/24', **ip1.stats()))
+
+    def testDevicesIn(self):
+
+        ip1, ip2, s1 = map(clusto.get_by_name, ['a1', 'b1', 's1'])
+        s2 = BasicServer('s2')
+        s3 = BasicServer('s3')
+
+        ip1.allocate(s1, '192.168.1.20')
+        ip2.allocate(s2, '10.0.129.7')
+        ip2.allocate(s2, '10.0.130.7')
+        ip2.allocate(s3, '10.0.131.7')
+        ip2.deallocate(s3)
+
+        statements = self.count_statements()
+
+        self.assertEqual(IPManager.devices_in('10.0.0.0/8'), [s2])
+        self.assertEqual(len(statements), 1)
+        self.assertTrue('BETWEEN' in statements[0])
+
+        self.assertEqual(IPManager.devices_in('0.0.0.0/0'), [s1, s2])
+        self.assertEqual(IPManager.devices_in('192.168.1.20'), [s1])
+        self.assertEqual(IPManager.devices_in('192.168.1.21'), [])
+        self.assertEqual(IPManager.devices_in('10.0.130.0/24'), [s2])
+        self.assertRaises(ValueError, IPManager.devices_in, '10.0.0.1/8')
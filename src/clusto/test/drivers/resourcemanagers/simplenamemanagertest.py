@@ -102,6 +102,24 @@ class SimpleEntityNameManagerTests(testbase.ClustoTestBase):
 
         self.assertEqual(d.name, 'testname')
 
+    def testAllocateMany(self):
+
+        ngen = clusto.get_by_name('foonamegen')
+
+        objs = ngen.allocate_many(Driver, 3)
+        self.assertEqual([d.name for d in objs],
+                         ['foo0001', 'foo0002', 'foo0003'])
+        self.assertEqual(clusto.get_by_name('foo0002'), objs[1])
+        self.assertEqual(ngen.allocate(Driver).name, 'foo0004')
+
+        objs = ngen.allocate_many(Driver, resources=['a', 'b'])
+        self.assertEqual([d.name for d in objs], ['a', 'b'])
+
+        ngen = clusto.get_by_name('barnamegen')
+        self.assertRaises(SimpleNameManagerException,
+                          ngen.allocate_many, Driver, 6)
+        self.assertRaises(LookupError, clusto.get_by_name, 'bar95')
+
 class SimpleNameManagerTests(testbase.ClustoTestBase):
 
     def data(self):
@@ -124,3 +142,13 @@ class SimpleNameManagerTests(testbase.ClustoTestBase):
             
         
         self.assertEqual(len(SimpleNameManager.resources(d)), 50)
+
+    def testAllocatorMany(self):
+
+        ngen = clusto.get_by_name('foonamegen')
+
+        d = Driver('foo')
+        attrs = ngen.allocate_many([d] * 50)
+
+        self.assertEqual(len(SimpleNameManager.resources(d)), 50)
+        self.assertEqual(attrs[-1].value, 'foo0050')
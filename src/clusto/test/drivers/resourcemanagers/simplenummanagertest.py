@@ -48,3 +48,31 @@ class SimpleNumManagerTests(testbase.ClustoTestBase):
         self.assertRaises(SimpleNumManagerException, ngen.allocate, d)
         
         
+
+    def testAllocateMany(self):
+
+        d1 = Driver('foo')
+        d2 = Driver('bar')
+
+        ngen = clusto.get_by_name('numgen1')
+        attrs = ngen.allocate_many([d1, d2, d2])
+        self.assertEqual([a.value for a in attrs], [1, 2, 3])
+        self.assertEqual(ngen.owners(3), [d2])
+        self.assertEqual(ngen.allocate(d1).value, 4)
+
+        ngen = clusto.get_by_name('numgen2')
+        self.assertRaises(SimpleNumManagerException,
+                          ngen.allocate_many, [d1] * 6)
+        self.assertEqual(ngen.count, 0)
+
+    def testOutOfNumbersTakesNone(self):
+
+        d = Driver('foo')
+        ngen = clusto.get_by_name('numgen2')
+
+        # outside of an allocation's transaction
+        self.assertRaises(SimpleNumManagerException, ngen.allocator_many,
+                          [d] * 6)
+        self.assertRaises(SimpleNumManagerException, ngen.allocator_many,
+                          [d] * 6)
+        self.assertEqual(ngen.allocator(d), (0, True))
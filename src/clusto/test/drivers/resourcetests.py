@@ -1,9 +1,25 @@
 from clusto.test import testbase 
 
+import clusto
 from clusto.drivers import *
 
 
 
+
+class ATestPortManager(ResourceManager):
+    """Picks the lowest port that isn't allocated yet."""
+
+    _driver_name = "atestportmanager"
+    _attr_name = "atestport"
+
+    def allocator(self, thing=None):
+
+        port = 1
+        while not self.available(port):
+            port += 1
+        return (port, True)
+
+
 class ResourceManagerTests(testbase.ClustoTestBase):
 
     def testAllocate(self):
@@ -109,3 +125,110 @@ class ResourceManagerTests(testbase.ClustoTestBase):
 
         self.assertRaises(ResourceException, rm.allocate, d, 'bar')
         
+
+    def testResourceAttrsQuery(self):
+
+        rm1 = ResourceManager('test1')
+        ip1 = IPManager('ip1', baseip='10.0.0.0', netmask='255.255.255.0')
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+
+        rm1.allocate(d1, 'foo')
+        ip1.allocate(d1, '10.0.0.5')
+        ip1.allocate(d2, '10.0.0.6')
+        rm1.allocate(d2, 'bar')
+        d1_id, d2_id = d1.entity.entity_id, d2.entity.entity_id
+
+        statements = self.count_statements()
+
+        pairs = ResourceManager.resource_attrs([d1, d2])
+        self.assertEqual([(a.entity_id, a.value, m.name) for a, m in pairs],
+                         [(d1_id, 'foo', 'test1'), (d2_id, 'bar', 'test1')])
+        self.assertEqual(len(statements), 1)
+
+        # the resources of the managers' attribute key, from managers of
+        # the class (and its subclasses)
+        self.assertEqual(IPManager.get_ips_for([d1, d2]),
+                         {d1: ['10.0.0.5'], d2: ['10.0.0.6']})
+        self.assertEqual(IPManager.get_ips(d2), ['10.0.0.6'])
+        self.assertEqual(len(statements), 3)
+
+        ipattr = IPManager.resources(d1)[0]
+        self.assertEqual(ResourceManager.get_resource_manager(ipattr), ip1)
+        self.assertEqual(ResourceManager.get_resource_manager(pairs[1][0]), rm1)
+        self.assertEqual(ResourceManager.resource_attrs([]), [])
+
+        rm1.deallocate(d2)
+        self.assertEqual(ResourceManager.resources(d2), [])
+        self.assertEqual(ip1.owners('10.0.0.6'), [d2])
+
+    def testAllocateMany(self):
+
+        rm = ResourceManager('test')
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+        rm.allocate(d1, 'taken')
+
+        allocated = []
+        rm.post_allocation = lambda thing, resource, number: \
+            allocated.append((thing.name, resource))
+
+        inserts = self.count_statements(
+            lambda statement: statement.startswith('INSERT INTO entity_attrs'))
+
+        attrs = rm.allocate_many([d1, d2, d2], ['foo', 'bar', 'baz'])
+
+        self.assertEqual(inserts.executemany, [True])
+        self.assertEqual([(a.entity.name, a.value) for a in attrs],
+                         [('d1', 'foo'), ('d2', 'bar'), ('d2', 'baz')])
+        self.assertEqual(len(set(a.number for a in attrs)), 3)
+        self.assertEqual(allocated, [('d1', 'foo'), ('d2', 'bar'),
+                                     ('d2', 'baz')])
+        self.assertEqual(rm.owners('baz'), [d2])
+        self.assertEqual(sorted(x.value for x in rm.resources(d2)),
+                         ['bar', 'baz'])
+        self.assertEqual(rm.stats(), {'count': 4, 'things': 2})
+
+        # nothing is allocated when one of the resources isn't available
+        self.assertRaises(ResourceException, rm.allocate_many,
+                          [d1, d2], ['new', 'taken'])
+        self.assertRaises(ResourceException, rm.allocate_many,
+                          [d1, d2], ['new', 'new'])
+        self.assertRaises(ResourceException, rm.allocate_many, [d1], [])
+        self.assertEqual(rm.owners('new'), [])
+        self.assertEqual(rm.allocate_many([]), [])
+
+    def testAllocateManyFromAvailable(self):
+
+        pm = ATestPortManager('ports')
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+        d3 = Driver('d3')
+        pm.allocate(d1, 1)
+
+        attrs = pm.allocate_many([d1, d2, d3])
+
+        self.assertEqual([a.value for a in attrs], [2, 3, 4])
+        self.assertEqual(pm.owners(3), [d2])
+
+    def testDeallocateMany(self):
+
+        rm1 = ResourceManager('test1')
+        rm2 = ResourceManager('test2')
+        d1 = Driver('d1')
+        d2 = Driver('d2')
+
+        rm1.allocate_many([d1, d1, d2], ['foo1', 'bar1', 'baz1'])
+        rm2.allocate(d2, 'foo2')
+
+        rm1.deallocate_many([d1, d2], ['bar1', 'baz1'])
+        self.assertEqual(rm1.count, 1)
+        self.assertEqual([x.value for x in rm1.resources(d1)], ['foo1'])
+
+        rm1.allocate(d2, 'baz1')
+        rm1.deallocate_many([d1, d2])
+        self.assertEqual(rm1.count, 0)
+        self.assertEqual(rm2.count, 1)
+        self.assertEqual(d1.attrs(), [])
+        self.assertEqual([x.value for x in ResourceManager.resources(d2)],
+                         ['foo2'])
@@ -10,6 +10,8 @@ import clusto
 
 import ConfigParser
 
+from sqlalchemy import event
+
 DB='sqlite:///:memory:'
 ECHO=False
 
@@ -24,6 +26,50 @@ class ClustoTestResult(unittest.TestResult):
         
 
 
+class StatementCounter(list):
+    """The SQL statements run while listening, as a list.
+
+    Only the statements match(statement) is true for are kept when match
+    is given.  Whether each was run with executemany is kept in the
+    executemany list.  Listens inside a with block or between start() and
+    stop().
+    """
+
+    # the listener (a bound method) is hashed along with its counter
+    __hash__ = object.__hash__
+
+    def __init__(self, match=None):
+        list.__init__(self)
+        self.match = match
+        self.executemany = []
+        self.bind = None
+
+    def _execute(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        if self.match is None or self.match(statement):
+            self.append(statement)
+            self.executemany.append(executemany)
+        return statement, parameters
+
+    def start(self):
+        self.bind = clusto.SESSION.bind
+        # retval=True listeners aren't wrapped, so they can be removed again
+        event.listen(self.bind, 'before_cursor_execute', self._execute,
+                     retval=True)
+        return self
+
+    def stop(self):
+        if self.bind is not None:
+            self.bind.dispatch.before_cursor_execute.remove(self._execute,
+                                                            self.bind)
+            self.bind = None
+
+    __enter__ = start
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
 class ClustoTestBase(unittest.TestCase):
 
 
@@ -44,6 +90,13 @@ class ClustoTestBase(unittest.TestCase):
         self.data()
 
 
+    def count_statements(self, match=None):
+        """Return a StatementCounter listening until the test ends."""
+
+        counter = StatementCounter(match).start()
+        self.addCleanup(counter.stop)
+        return counter
+
     def tearDown(self):
         if clusto.SESSION.is_active:
             raise Exception("SESSION IS STILL ACTIVE in %s" % str(self.__class__))
@@ -1,3 +1,4 @@
 from serverinstallation import *
 from concurrentusage import *
-from clusterusage import * 
+from clusterusage import *
+from allocationusage import * 
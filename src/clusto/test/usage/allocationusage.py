@@ -0,0 +1,122 @@
+from clusto.test import testbase
+
+import clusto
+from clusto.drivers import IPManager, BasicServer
+from clusto.schema import Entity
+
+import os
+import tempfile
+import threading
+import time
+
+
+class AllocationLockingTest(testbase.ClustoTestBase):
+    """Allocate ips from one manager in several threads at once.
+
+    Every thread waits a moment between picking its first ip and recording
+    it, so without the lock they all pick the same one.
+    """
+
+    threads = 4
+    allocations = 5
+    delay = 0.2
+
+    def setUp(self):
+
+        self.dsn = testbase.DB
+        self.path = None
+        if self.dsn == 'sqlite:///:memory:':
+            # every thread has its own connection, they have to share a file
+            fd, self.path = tempfile.mkstemp(suffix='.db')
+            os.close(fd)
+            testbase.DB = 'sqlite:///' + self.path
+
+        # connect() only binds sessions created after it
+        clusto.SESSION.remove()
+        testbase.ClustoTestBase.setUp(self)
+
+        # the versioning row written when a transaction begins would
+        # serialize sqlite's writers on its own
+        clusto.SESSION.clusto_versioning_enabled = False
+
+    def tearDown(self):
+
+        clusto.SESSION.clusto_allocation_locking = False
+        clusto.SESSION.clusto_versioning_enabled = True
+        try:
+            testbase.ClustoTestBase.tearDown(self)
+        finally:
+            clusto.SESSION.remove()
+            testbase.DB = self.dsn
+            if self.path:
+                os.remove(self.path)
+
+    def data(self):
+
+        IPManager('net', baseip='10.1.0.0', netmask='255.255.252.0',
+                  gateway='10.1.0.1')
+        for i in range(self.threads):
+            BasicServer('s%d' % i)
+
+    def allocate(self, manager_id, server_id, errors):
+
+        try:
+            query = clusto.SESSION.query(Entity)
+            manager = clusto.Driver(query.get(manager_id))
+            server = clusto.Driver(query.get(server_id))
+
+            picks = []
+            def allocator(thing=None):
+                picked = IPManager.allocator(manager, thing)
+                if not picks:
+                    time.sleep(self.delay)
+                picks.append(picked)
+                return picked
+            manager.allocator = allocator
+
+            for i in xrange(self.allocations):
+                manager.allocate(server)
+        except Exception, x:
+            errors.append(x)
+        finally:
+            clusto.SESSION.close()
+
+    def run_threads(self):
+        """Allocate in all the threads, return the ips allocated, the
+        exceptions raised and the seconds it took."""
+
+        manager = clusto.get_by_name('net')
+        servers = [clusto.get_by_name('s%d' % i) for i in range(self.threads)]
+        errors = []
+        threads = [threading.Thread(target=self.allocate,
+                                    args=(manager.entity.entity_id,
+                                          server.entity.entity_id, errors))
+                   for server in servers]
+
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+
+        clusto.clear()
+        ips = IPManager.get_ips_for(servers)
+        return sum(ips.values(), []), errors, elapsed
+
+    def testCollisionsWithoutLocking(self):
+
+        found, errors, elapsed = self.run_threads()
+
+        # the same ip picked twice, or conflicting _lastip attributes
+        self.assertTrue(errors or len(set(found)) < len(found))
+
+    def testNoDuplicates(self):
+
+        clusto.SESSION.clusto_allocation_locking = True
+        found, errors, elapsed = self.run_threads()
+
+        # no allocation had to be retried
+        self.assertEqual(errors, [])
+        self.assertEqual(len(found), self.threads * self.allocations)
+        self.assertEqual(len(set(found)), len(found))